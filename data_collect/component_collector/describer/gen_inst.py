@@ -7,6 +7,7 @@ import cv2
 from tqdm import tqdm
 from utils.util import postprocess_code_reponse
 from utils.llm import chat
+from utils.bundle_store import BundleStore
 import os
 import re
 from PIL import Image
@@ -44,7 +45,7 @@ def generate_inst_with_llm(comp_code, style_code):
     prompt = 'Based on the following React code and its associated CSS, please analyze and generate the following two parts of the description:\n\n1. Describe the possible appearance of the page rendered by this code. Provide a detailed account of the layout configuration, including the arrangement, size, color, and type of components. Specify the exact position of each component (e.g., at the top, centered, or at the bottom of the page), as well as the relationships and interactions between these components.\n\n2.Parse the functional requirements of this code. Assume this corresponds to a specific user requirement; please describe this requirement in the user\'s voice. For example, if the code implements a registration form, the requirement could be described as: "I need a simple user registration form where users can enter their name, email, and password, along with a submit button."\n\nPlease output the analysis results in JSON format, including two fields: \'layout\' and \'requirement.\' The \'layout\' field should provide a detailed description of the page layout and the appearance of the components, while the \'requirement\' field should explain the user need that the code fulfills.\n\nNote:\n\n- The content of the fields in the JSON should be described in English.\n- Ensure the JSON format is correct; otherwise, your response cannot be parsed.\n- Include only one JSON object in your response; do not add any comments, explanations, or additional content.\n- Do not generate duplicate content.\n- The contents of the layout and requirement fields in the JSON object should be confirmed as a single string each, with no additional formatting (no JSON, markdown, etc.).'
     prompt += f'\n\nReact code: \n{comp_code}\n\nCSS code: \n{style_code}'
 
-    reponse = chat(prompt)
+    reponse = chat(prompt, stop_at_fence=True)
     if not reponse:
         return None
 
@@ -103,19 +104,25 @@ def crop_image_cv2(source_img_path, cropped_img_path):
         return 0, 0
 
 
-def process_file(file, root, processed_images, pregenerated_inst, code_dir, ori_img_dir, cropped_img_dir):
+def process_file(file, root, processed_images, pregenerated_inst, code_dir, ori_img_dir, cropped_img_dir, bundle_store=None):
     if file in processed_images or not file.lower().endswith('.png'):
         return None
 
     repo_name, comp_name = file.replace('.png', '').split('-_-_-')
-    code_file_path = os.path.join(code_dir, repo_name, comp_name)
-
-    if not os.path.exists(code_file_path):
-        return None
+    if bundle_store:
+        if (repo_name, comp_name) not in bundle_store:
+            return None
+    else:
+        code_file_path = os.path.join(code_dir, repo_name, comp_name)
+        if not os.path.exists(code_file_path):
+            return None
 
     try:
-        with open(code_file_path, 'r') as f:
-            code = json.load(f)
+        if bundle_store:
+            code = bundle_store.get(repo_name, comp_name)
+        else:
+            with open(code_file_path, 'r') as f:
+                code = json.load(f)
 
         source_img_path = os.path.join(root, file)
         shutil.copy2(source_img_path, ori_img_dir)
@@ -188,6 +195,8 @@ def parse_args():
     parser.add_argument('--inst_path', type=str)
     parser.add_argument('--ori_img_path', type=str)
     parser.add_argument('--cropped_img_path', type=str)
+    parser.add_argument('--bundle_store', type=str, default='',
+                        help='read the component code from this bundle store instead of code_path')
     return parser.parse_args()
 
 
@@ -198,6 +207,7 @@ if __name__ == "__main__":
     inst_path = args.inst_path
     ori_img_path = args.ori_img_path
     cropped_img_path = args.cropped_img_path
+    bundle_store = BundleStore(args.bundle_store) if args.bundle_store else None
 
     os.makedirs(inst_path, exist_ok=True)
     os.makedirs(ori_img_path, exist_ok=True)
@@ -218,7 +228,7 @@ if __name__ == "__main__":
         for root, _, files in tqdm(os.walk(screenshot_path), desc='Walking files'):
             for file in files:
                 futures.append(executor.submit(
-                    process_file, file, root, processed_images, pregenerated_inst, code_path, ori_img_path, cropped_img_path))
+                    process_file, file, root, processed_images, pregenerated_inst, code_path, ori_img_path, cropped_img_path, bundle_store))
 
         for future in tqdm(as_completed(futures), total=len(futures), desc='Processing images'):
             result = future.result()
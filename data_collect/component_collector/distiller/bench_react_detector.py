@@ -0,0 +1,93 @@
+import argparse
+import os
+import re
+import time
+
+from data_collect.component_collector.distiller.react_detector import is_minified_bundle, is_react_source
+from data_collect.component_collector.distiller.repo_index import SCRIPT_EXTENSIONS
+
+
+def legacy_react_identification(file_content):
+    # the detector Distiller.rule_based_react_identification used before react_detector.py
+    patterns = [
+        r'class\s+\w+\s+extends\s+(React\.Component|Component)\b',
+        r'import\s+React\b',
+        r'import\s+\{[^}]*\}\s+from\s+[\'"]react[\'"]',
+        r'React\.createElement\b',
+        r'function\s+[A-Z]\w*\s*\(',
+        r'const\s+[A-Z]\w*\s*=\s*\([^)]*\)\s*=>',
+        r'return\s*\([^\)]',
+        r'(\.jsx|\.tsx)\b',
+        r'\/>\s*$',
+        r'<\w+\s*\/>',
+        r'(useState|useEffect|useContext|useReducer|useMemo|useCallback)\(',
+        r'\bPropTypes\b',
+        r'<\w+',
+        r'<\/\w+>',
+        r'from\s+[\'"]@material-ui/core',
+    ]
+    jsx_patterns = [
+        r'<\w+[^>]*>',
+        r'<\w+.*?>.*?<\/\w+>',
+    ]
+    react_checks = any(re.search(pattern, file_content,
+                                 re.MULTILINE | re.DOTALL) for pattern in patterns)
+    jsx_checks = any(re.search(pattern, file_content,
+                               re.MULTILINE | re.DOTALL) for pattern in jsx_patterns)
+    return react_checks or jsx_checks
+
+
+def load_corpus(corpus_path, max_files):
+    contents = []
+    for root, dirs, files in os.walk(corpus_path):
+        for file in files:
+            if not file.endswith(SCRIPT_EXTENSIONS):
+                continue
+            try:
+                with open(os.path.join(root, file), 'r', encoding='utf-8') as f:
+                    contents.append((os.path.join(root, file), f.read()))
+            except Exception:
+                continue
+            if len(contents) >= max_files:
+                return contents
+    return contents
+
+
+def bench(detector, contents):
+    start = time.perf_counter()
+    results = [detector(content) for path, content in contents]
+    return results, time.perf_counter() - start
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--corpus_path', type=str,
+                        help='directory of crawled repos to read .js/.jsx/.ts/.tsx files from')
+    parser.add_argument('--max_files', type=int, default=20000)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    contents = load_corpus(args.corpus_path, args.max_files)
+    total_bytes = sum(len(content) for path, content in contents)
+    print(f"Loaded {len(contents)} files, {total_bytes / 1024 / 1024:.1f} MB")
+
+    legacy_results, legacy_time = bench(legacy_react_identification, contents)
+    new_results, new_time = bench(is_react_source, contents)
+
+    mismatches = []
+    skipped_bundles = []
+    for (path, content), legacy, new in zip(contents, legacy_results, new_results):
+        if is_minified_bundle(content):
+            skipped_bundles.append(path)
+        elif legacy != new:
+            mismatches.append(path)
+
+    print(f"legacy detector: {legacy_time:.3f}s")
+    print(f"new detector:    {new_time:.3f}s ({legacy_time / max(new_time, 1e-9):.1f}x)")
+    print(f"react files: {sum(new_results)} (legacy {sum(legacy_results)})")
+    print(f"minified bundles skipped: {len(skipped_bundles)}")
+    print(f"mismatches on regular files: {len(mismatches)}")
+    for path in mismatches:
+        print(f"  {path}")
@@ -0,0 +1,162 @@
+import json
+import os
+
+from utils.util import estimate_token_count
+from data_collect.component_collector.distiller.prompts_distiller import DEBUG_CODE_FIX_PROMPT, DEBUG_CODE_REVIEW_PROMPT, DEBUG_CODE_SYSTEM_PROMPT, MOCK_INPUT_PARAMS_PROMPT, MOCK_INPUT_VALUES_PROMPT, REACT_IDENTIFICATION_PROMPT
+
+
+# seconds per llm request when no earlier statistic.json has measured them
+DEFAULT_REQUEST_SECONDS = 10
+
+LLM_TEMPLATES = ('react_identification', 'mock_input_params', 'mock_input_values',
+                 'filter_css', 'debug_code_review', 'debug_code_fix')
+
+
+def load_request_seconds(statistic_path, default_seconds=DEFAULT_REQUEST_SECONDS):
+    # mean latency per prompt template from the `llm_seconds.*` histograms of an earlier run
+    request_seconds = {template_id: default_seconds for template_id in LLM_TEMPLATES}
+    if not os.path.exists(statistic_path):
+        return request_seconds
+    try:
+        with open(statistic_path, 'r') as f:
+            histograms = json.load(f).get('histograms', {})
+    except (OSError, ValueError) as e:
+        print(f"Ignoring unreadable {statistic_path}: {e}")
+        return request_seconds
+    for template_id in LLM_TEMPLATES:
+        histogram = histograms.get(f'llm_seconds.{template_id}')
+        if histogram and histogram['count']:
+            request_seconds[template_id] = histogram['sum'] / histogram['count']
+    return request_seconds
+
+
+class CostEstimator():
+    """
+    Predicts the llm requests, input tokens and wall time of distilling a repository without
+    calling the llm. It walks the same rule-based components, dependency graph, levels and
+    styles as `Distiller.process_repo`, and counts the prompts each component would send with
+    `estimate_token_count`.
+
+    Rounds that only happen depending on an answer (mock input values, code fix) give a
+    min/max range: min assumes none of them run, max assumes all of them do. Every component
+    is assumed to pass the llm react check, and reused child bundles are counted by the
+    size of their sources.
+    """
+
+    def __init__(self, request_seconds=None):
+        self._request_seconds = request_seconds or {
+            template_id: DEFAULT_REQUEST_SECONDS for template_id in LLM_TEMPLATES}
+        self._prompt_tokens = {
+            'react_identification': estimate_token_count(REACT_IDENTIFICATION_PROMPT),
+            'mock_input_params': estimate_token_count(MOCK_INPUT_PARAMS_PROMPT),
+            'mock_input_values': estimate_token_count(MOCK_INPUT_VALUES_PROMPT),
+            'debug_code_system': estimate_token_count(DEBUG_CODE_SYSTEM_PROMPT),
+            'debug_code_review': estimate_token_count(DEBUG_CODE_REVIEW_PROMPT),
+            'debug_code_fix': estimate_token_count(DEBUG_CODE_FIX_PROMPT),
+        }
+
+    def new_cost(self):
+        return {'requests_min': 0, 'requests_max': 0, 'input_tokens_min': 0, 'input_tokens_max': 0,
+                'seconds_min': 0, 'seconds_max': 0}
+
+    def add_request(self, cost, template_id, input_tokens, optional=False):
+        cost['requests_max'] += 1
+        cost['input_tokens_max'] += input_tokens
+        cost['seconds_max'] += self._request_seconds[template_id]
+        if not optional:
+            cost['requests_min'] += 1
+            cost['input_tokens_min'] += input_tokens
+            cost['seconds_min'] += self._request_seconds[template_id]
+
+    def file_tokens(self, distiller, file_path, token_counts):
+        if file_path not in token_counts:
+            try:
+                token_counts[file_path] = estimate_token_count(
+                    distiller._repo_index.read(file_path))
+            except (OSError, ValueError):
+                token_counts[file_path] = 0
+        return token_counts[file_path]
+
+    def component_cost(self, distiller, component_path, component_files, token_counts):
+        cost = self.new_cost()
+        files = distiller.recursive_imports(component_path)
+        code_tokens = 0
+        css_paths = []
+        for file_path in sorted(files):
+            if not os.path.exists(file_path):
+                continue
+            tokens = self.file_tokens(distiller, file_path, token_counts)
+            code_tokens += tokens
+            # child components are distilled first and their bundles reused without mock inputs
+            if file_path == component_path or file_path not in component_files:
+                params_prompt = self._prompt_tokens['mock_input_params'] + tokens
+                self.add_request(cost, 'mock_input_params', params_prompt)
+                self.add_request(cost, 'mock_input_values', params_prompt +
+                                 self._prompt_tokens['mock_input_values'], optional=True)
+            for css_path in distiller.css_imports(file_path):
+                full_css_path, is_local = distiller.resolve_import_path(
+                    file_path, {'source': {'value': css_path}})
+                if full_css_path:
+                    css_paths.append(full_css_path)
+        css_paths += distiller.collect_style_dependencies(component_path)
+        css_tokens = sum(estimate_token_count(content)
+                         for content in distiller.concat_styles(css_paths, set()))
+
+        # the raw style always holds at least a newline, so every component with code is filtered
+        if code_tokens:
+            self.add_request(cost, 'filter_css', estimate_token_count(
+                distiller.filter_css_prompt('', '')) + code_tokens + css_tokens)
+        review_prompt = self._prompt_tokens['debug_code_system'] + \
+            self._prompt_tokens['debug_code_review'] + code_tokens
+        self.add_request(cost, 'debug_code_review', review_prompt)
+        self.add_request(cost, 'debug_code_fix', review_prompt + self._prompt_tokens['debug_code_review'] +
+                         code_tokens + self._prompt_tokens['debug_code_fix'], optional=True)
+        return cost
+
+    def estimate_repo(self, distiller, component_concurrency=1):
+        token_counts = {}
+        repo_cost = self.new_cost()
+        component_files = distiller.find_react_components(use_llm=False)
+        for component_path in component_files:
+            self.add_request(repo_cost, 'react_identification', self._prompt_tokens['react_identification'] +
+                             self.file_tokens(distiller, component_path, token_counts))
+
+        distiller._dependency_graph = distiller.build_dependency_graph()
+        component_set = set(component_files)
+        for level in distiller.component_levels(component_files):
+            level_costs = [self.component_cost(distiller, component_path, component_set, token_counts)
+                           for component_path in level]
+            for key in ('requests_min', 'requests_max', 'input_tokens_min', 'input_tokens_max'):
+                repo_cost[key] += sum(cost[key] for cost in level_costs)
+            # components of a level run `component_concurrency` at a time, the level ends with its slowest one
+            for key in ('seconds_min', 'seconds_max'):
+                repo_cost[key] += max(max(cost[key] for cost in level_costs),
+                                      sum(cost[key] for cost in level_costs) / component_concurrency)
+
+        repo_cost['components'] = len(component_files)
+        repo_cost['files'] = len(distiller.find_all_files())
+        # expected yield: bundled components per thousand input tokens (at the max estimate)
+        repo_cost['components_per_1k_tokens'] = round(
+            1000 * len(component_files) / repo_cost['input_tokens_max'], 4) if repo_cost['input_tokens_max'] else 0
+        distiller._repo_index.release_contents()
+        return repo_cost
+
+
+def summarize_costs(repo_costs, max_workers):
+    total = {}
+    for key in ('components', 'files', 'requests_min', 'requests_max', 'input_tokens_min', 'input_tokens_max'):
+        total[key] = sum(cost[key] for cost in repo_costs.values())
+    # repositories run `max_workers` at a time, the run ends with the slowest one
+    for key in ('seconds_min', 'seconds_max'):
+        total[key] = max(max((cost[key] for cost in repo_costs.values()), default=0),
+                         sum(cost[key] for cost in repo_costs.values()) / max_workers)
+    total['repos'] = len(repo_costs)
+    return total
+
+
+def write_cost_report(path, repo_costs, total):
+    # one line per repo, best expected yield first, and a last line with the totals
+    with open(path, 'w') as f:
+        for repo_path, cost in sorted(repo_costs.items(), key=lambda item: -item[1]['components_per_1k_tokens']):
+            f.write(json.dumps(dict(cost, repo=repo_path)) + '\n')
+        f.write(json.dumps(dict(total, repo=None)) + '\n')
@@ -1,105 +1,141 @@
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import heapq
 import json
+import multiprocessing
+import queue
 import re
+import signal
+import time
+import threading
 from threading import Lock
 import traceback
-import concurrent.futures
 import os
-import subprocess
-from utils.util import postprocess_code_reponse
-from utils.llm import llm_chat
+from typing import NamedTuple
+from utils.util import estimate_token_count, postprocess_code_reponse
+from utils.llm import llm_chat, BUDGET_EXCEEDED_ERROR, SUCCESS_CODE
+from utils.llm_budget import BUDGET_HARD
+from utils.llm_cache import LLMResponseCache, content_hash
+from utils.llm_metrics import llm_labels
+from utils.bundle_store import BundleStoreWriter
 from tqdm import tqdm
 import networkx as nx
 import argparse
+from data_collect.component_collector.distiller.cost_estimator import CostEstimator, load_request_seconds, summarize_costs, write_cost_report
+from data_collect.component_collector.distiller.import_parser import ImportParserPool, parse_imports_subprocess
+from data_collect.component_collector.distiller.import_resolver import ImportResolver
+from data_collect.component_collector.distiller.manifest import BundleManifest
+from data_collect.component_collector.distiller.prompts_distiller import DEBUG_CODE_FIX_PROMPT, DEBUG_CODE_REVIEW_PROMPT, DEBUG_CODE_SYSTEM_PROMPT, FILTER_CSS_EXAMPLE_COMPONENT_CODE, FILTER_CSS_EXAMPLE_INPUT_CSS, FILTER_CSS_EXAMPLE_OUTPUT_CSS, FILTER_CSS_PROMPT, MOCK_INPUT_PARAMS_PROMPT, MOCK_INPUT_VALUES_PROMPT, REACT_IDENTIFICATION_PROMPT
+from data_collect.component_collector.distiller.react_detector import is_react_source
+from data_collect.component_collector.distiller.repo_index import RepoIndex, SCRIPT_EXTENSIONS, STYLE_EXTENSIONS
+from data_collect.component_collector.distiller.stats_collector import StatsCollector, merge_snapshot, write_statistic_snapshot
+
+# seconds a terminated worker gets to close its parsers, caches and stores before it is killed
+WORKER_TERMINATE_GRACE = 10
+
+
+class LLMBudgetExceeded(Exception):
+    # a request refused by the token budget, the component is left for a run with budget
+    pass
 
 
 class Distiller():
-    def __init__(self, base_path, repo_path, output_dir, statistic, lock):
+    def __init__(self, base_path, repo_path, output_dir, statistic, lock, import_parser=None, repo_index=None, llm_cache=None, component_concurrency=1, bundle_store=None):
         self._base_path = base_path
+        self._bundle_store = bundle_store
+        self._component_concurrency = component_concurrency
+        self._import_parser = import_parser
+        self._llm_cache = llm_cache
         self._repo_path = os.path.normpath(repo_path)
+        self._repo_index = repo_index if repo_index is not None else RepoIndex(
+            self._repo_path)
+        self._import_resolver = ImportResolver(self._repo_index)
+        # a StatsCollector, updated without taking `lock`
         self._statistic = statistic
         self._lock = lock
-        self._output_dir = os.path.join(
-            output_dir, os.path.basename(self._repo_path))
-        if not os.path.exists(self._output_dir):
-            os.makedirs(self._output_dir)
+        self._llm_usage = threading.local()
+        # without an output_dir the distiller only analyses the repo (dry run) and writes nothing
+        self._output_dir = None
+        self._manifest = None
+        if output_dir is not None:
+            self._output_dir = os.path.join(
+                output_dir, os.path.basename(self._repo_path))
+            if not os.path.exists(self._output_dir):
+                os.makedirs(self._output_dir)
+            self._manifest = BundleManifest(
+                self._output_dir + '.manifest', self._repo_path)
         self._dependency_graph = None
+        self._reachable_imports = None
+        self._style_condensation = None
+        self._inherited_styles = {}
         self._processed_files = {}
+        # a component was refused by the token budget
+        self._budget_refused = False
 
     def update_statistic(self, key, value):
-        with self._lock:
-            # If the key doesn't exist in the dictionary, initialize it with the incoming value
-            if key not in self._statistic:
-                self._statistic[key] = value
-            else:
-                # If the existing value is a list, append the new value if it is also a list, or extend if the new value is an item
-                if isinstance(self._statistic[key], list):
-                    if isinstance(value, list):
-                        self._statistic[key].extend(value)
-                    else:
-                        self._statistic[key].append(value)
-                # If the existing value is a number, add the new value to it
-                elif isinstance(self._statistic[key], (int, float)):
-                    self._statistic[key] += value
+        # numbers are added up, anything else is collected in a list
+        if isinstance(value, (int, float)):
+            self._statistic.incr(key, value)
+        elif isinstance(value, list):
+            for item in value:
+                self._statistic.append(key, item)
+        else:
+            self._statistic.append(key, value)
 
     def add_statistic(self, key, value):
-        with self._lock:
-            if key not in self._statistic:
-                self._statistic[key] = value
-            self._statistic[key] += value
+        self._statistic.incr(key, value)
+
+    def observe_statistic(self, name, value):
+        self._statistic.observe(name, value)
+
+    def chat(self, template_id, prompt, chat_hist=[]):
+        start_time = time.time()
+        with llm_labels(template=template_id, repo=os.path.basename(self._repo_path)):
+            response = self.cached_chat(template_id, prompt, chat_hist)
+        self.observe_statistic(
+            f'llm_seconds.{template_id}', time.time() - start_time)
+        # tokens are attributed to the component distilled by the calling thread
+        self._llm_usage.tokens = getattr(self._llm_usage, 'tokens', 0) + \
+            estimate_token_count(prompt) + (response.get('output_token_len') or 0)
+        if response['error_code'] == BUDGET_EXCEEDED_ERROR:
+            raise LLMBudgetExceeded(f'{template_id} request of {self._repo_path} refused by the token budget')
+        return response
+
+    def cached_chat(self, template_id, prompt, chat_hist=[]):
+        # llm_chat.chat behind the content-addressed response cache, only successful responses are stored
+        if not self._llm_cache:
+            return llm_chat.chat(prompt, chat_hist=chat_hist)
+
+        key = content_hash(chat_hist, prompt)
+        cached = self._llm_cache.get(template_id, llm_chat.model_name, key)
+        if cached is not None:
+            self.add_statistic('llm_cache_hits', 1)
+            return cached
+        self.add_statistic('llm_cache_misses', 1)
+
+        response = llm_chat.chat(prompt, chat_hist=chat_hist)
+        if response['error_code'] == SUCCESS_CODE and response['content'] is not None:
+            self._llm_cache.put(template_id, llm_chat.model_name, key, response)
+        return response
 
     def rule_based_react_identification(self, file_content):
-        # Enhanced and more specific patterns to better identify React components
-        patterns = [
-            # Class components
-            r'class\s+\w+\s+extends\s+(React\.Component|Component)\b',
-            r'import\s+React\b',  # Import React statement
-            # Import specific from React (destructuring)
-            r'import\s+\{[^}]*\}\s+from\s+[\'"]react[\'"]',
-            r'React\.createElement\b',  # Explicit React createElement usage
-            # Function component (capitalized functions)
-            r'function\s+[A-Z]\w*\s*\(',
-            # Arrow function components with explicit return
-            r'const\s+[A-Z]\w*\s*=\s*\([^)]*\)\s*=>',
-            # Return in a function that likely returns JSX
-            r'return\s*\([^\)]',
-            # File extensions for React components (optional heuristic)
-            r'(\.jsx|\.tsx)\b',
-            r'\/>\s*$',  # Closing JSX tag check at the end of the line
-            r'<\w+\s*\/>',  # Self-closing JSX tag
-            # Hooks usage
-            r'(useState|useEffect|useContext|useReducer|useMemo|useCallback)\(',
-            r'\bPropTypes\b',  # Usage of PropTypes
-            r'<\w+',  # JSX element start
-            r'<\/\w+>',  # JSX closing tag
-            # Using Material-UI (common in React projects)
-            r'from\s+[\'"]@material-ui/core',
-        ]
-
-        # Enhance readability and maintenance by separating JSX checks into a clear pattern
-        jsx_patterns = [
-            r'<\w+[^>]*>',  # Generic JSX opening tag
-            r'<\w+.*?>.*?<\/\w+>',  # JSX with closing tag
-        ]
-
-        # Check both general React and JSX specific patterns
-        react_checks = any(re.search(pattern, file_content,
-                                     re.MULTILINE | re.DOTALL) for pattern in patterns)
-        jsx_checks = any(re.search(pattern, file_content,
-                                   re.MULTILINE | re.DOTALL) for pattern in jsx_patterns)
-
-        return react_checks or jsx_checks
+        return is_react_source(file_content)
 
     def llm_based_react_identification(self, file_content):
-        prompt = 'You will be given a code snippet. You need to check if it is implemented with React or not. You need to return a boolean value, true if it is a React component, false otherwise. For example, if the component is defined as follows: function MyComponent() { return <div>test</div>; }, then the output should be: true. REPLY WITH the boolean value only, no explanations, comments, or any other text needed. Here is the code snippet: '
-        is_react_component = llm_chat.chat(
-            prompt + file_content)
+        try:
+            is_react_component = self.chat(
+                'react_identification', REACT_IDENTIFICATION_PROMPT + file_content)
+        except LLMBudgetExceeded:
+            return True
         if is_react_component is None:
             return True
         result = postprocess_code_reponse(is_react_component['content']).lower()
         return True if result == 'true' else False
 
-    def is_react_component(self, file_content, use_llm):
-        rule_based_result = self.rule_based_react_identification(file_content)
+    def is_react_component(self, file_content, use_llm, rule_based_result=None):
+        if rule_based_result is None:
+            rule_based_result = self.rule_based_react_identification(
+                file_content)
         print(f'--- rule_based_result: {rule_based_result}')
         if not use_llm:
             return rule_based_result
@@ -114,48 +150,40 @@ class Distiller():
     def find_all_files(self):
         # the file can not be under the node_modules, and must be under the src folder
         all_files = []
-        for root, dirs, files in os.walk(self._repo_path):
-            for file in files:
-                if 'node_modules' in root:
-                    continue
-                if file.endswith(('.js', '.jsx', '.ts', '.tsx')):
-                    path = os.path.join(root, file)
-                    all_files.append(path)
-
-                    # statistics
-                    if file.endswith('.js'):
-                        self.add_statistic('total_js_files', 1)
-                    elif file.endswith('.jsx'):
-                        self.add_statistic('total_jsx_files', 1)
-                    elif file.endswith('.ts'):
-                        self.add_statistic('total_ts_files', 1)
-                    elif file.endswith('.tsx'):
-                        self.add_statistic('total_tsx_files', 1)
+        for path in self._repo_index.files(SCRIPT_EXTENSIONS, include_node_modules=False):
+            all_files.append(path)
+
+            # statistics
+            if path.endswith('.js'):
+                self.add_statistic('total_js_files', 1)
+            elif path.endswith('.jsx'):
+                self.add_statistic('total_jsx_files', 1)
+            elif path.endswith('.ts'):
+                self.add_statistic('total_ts_files', 1)
+            elif path.endswith('.tsx'):
+                self.add_statistic('total_tsx_files', 1)
         self.add_statistic('total_files', len(all_files))
         return all_files
 
     def find_react_components(self, use_llm=True):
         component_files = set()
-        for root, dirs, files in os.walk(self._repo_path):
-            for file in files:
-                if 'node_modules' in root:
+        for path in self._repo_index.files(SCRIPT_EXTENSIONS, include_node_modules=False):
+            try:
+                # the rule-based verdict is kept on the index, so the sorting pass and
+                # the processing pass only run the detector once per file
+                rule_based_result = self._repo_index.cached_is_react(path)
+                if rule_based_result is None:
+                    rule_based_result = self.rule_based_react_identification(
+                        self._repo_index.read(path))
+                    self._repo_index.set_is_react(path, rule_based_result)
+                if not rule_based_result:
                     continue
-                if file.endswith(('.js', '.jsx', '.ts', '.tsx')):
-                    path = os.path.join(root, file)
-                    try:
-                        if not os.path.exists(path):
-                            continue
-                        with open(path, 'r', encoding='utf-8') as f:
-                            content = f.read()
-                            if self.is_react_component(content, use_llm):
-                                # print(f"Found React component: {path}")
-                                # component_files.append(path)
-                                component_files.add(path)
-                            # else:
-                            #     print(f"Not a React component: {path}")
-                    except Exception as e:
-                        print(f"Error reading file {path}: {e}")
-                        pass
+                content = self._repo_index.read(path) if use_llm else None
+                if self.is_react_component(content, use_llm, rule_based_result):
+                    component_files.add(path)
+            except Exception as e:
+                print(f"Error reading file {path}: {e}")
+                pass
         # statistics
         component_files = list(component_files)
         self.add_statistic('total_component_files', len(component_files))
@@ -164,25 +192,34 @@ class Distiller():
         return component_files
 
     def find_imports(self, file_path):
-        try:
-            # Call the Node.js script passing the file path
-            # print(f"Extracting imports from {file_path}")
-            # print(f"Node.js script path: {os.path.join(self._base_path, 'js_parser.js')}")
-            result = subprocess.run(
-                ['node', os.path.join(self._base_path, 'js_parser.js'), file_path], capture_output=True, text=True)
-            if result.stderr:
-                print(f"Error running Node.js script: {result.stderr}")
-                return []
-            if result.stdout:
-                # print(f"Output received from Node.js script: {result.stdout}")
-                imports = json.loads(result.stdout)
-                return imports
+        imports = self._repo_index.cached_imports(file_path)
+        if imports is not None:
+            return imports
+        if self._import_parser:
+            imports = self._import_parser.parse(file_path)
+        else:
+            imports = parse_imports_subprocess(self._base_path, file_path)
+        self._repo_index.set_imports(file_path, imports)
+        return imports
+
+    def find_imports_batch(self, file_paths):
+        all_imports = {}
+        missing = []
+        for file_path in file_paths:
+            imports = self._repo_index.cached_imports(file_path)
+            if imports is None:
+                missing.append(file_path)
             else:
-                print("No output received from Node.js script.")
-                return []
-        except Exception as e:
-            print(f"Failed to extract imports: {e}")
-            return []
+                all_imports[file_path] = imports
+        if self._import_parser:
+            parsed = self._import_parser.parse_many(missing)
+        else:
+            parsed = {file_path: parse_imports_subprocess(self._base_path, file_path)
+                      for file_path in missing}
+        for file_path, imports in parsed.items():
+            self._repo_index.set_imports(file_path, imports)
+        all_imports.update(parsed)
+        return all_imports
 
     def resolve_import_path(self, current_file_path, import_statement, import_statement_str=None):
         try:
@@ -193,7 +230,14 @@ class Distiller():
             else:
                 return import_statement_str, False
 
+            # extension/index probing and tsconfig/jsconfig aliases against the indexed repo files
+            resolved_path = self._import_resolver.resolve(
+                current_file_path, module_name)
+            if resolved_path:
+                return resolved_path, True
+
             if module_name.startswith('.'):
+                # not a known file, keep the old guess so the graph still records the edge
                 directory_of_current_file = os.path.dirname(current_file_path)
                 resolved_path = os.path.join(
                     directory_of_current_file, module_name)
@@ -209,26 +253,39 @@ class Distiller():
         except AttributeError as e:
             return import_statement_str, False
 
-    def recursive_imports(self, current_file_path, visited=None):
-        if not current_file_path.endswith(('.js', '.jsx', '.ts', '.tsx')):
-            return set()
-        if visited is None:
-            visited = set()
-
-        if current_file_path in visited:
+    def is_traversable_import(self, file_path):
+        # an import is followed only if it is an existing local script under src
+        return file_path.endswith(SCRIPT_EXTENSIONS) and file_path in self._repo_index \
+            and 'node_modules' not in file_path and 'src' in file_path
+
+    def build_reachable_imports(self):
+        # transitive closure of the traversable part of the dependency graph, computed once per repo:
+        # import cycles are collapsed into strongly connected components, and the reachable set of each
+        # component is the union of its successors' sets, shared by all of its members
+        traversable = [node for node in self._dependency_graph.nodes()
+                       if self.is_traversable_import(node)]
+        condensed = nx.condensation(self._dependency_graph.subgraph(traversable))
+        reachable_by_scc = {}
+        for scc in reversed(list(nx.topological_sort(condensed))):
+            reachable = set(condensed.nodes[scc]['members'])
+            for successor in condensed.successors(scc):
+                reachable |= reachable_by_scc[successor]
+            reachable_by_scc[scc] = frozenset(reachable)
+        return {node: reachable_by_scc[scc] for node, scc in condensed.graph['mapping'].items()}
+
+    def recursive_imports(self, current_file_path):
+        if not current_file_path.endswith(SCRIPT_EXTENSIONS):
             return set()
-        visited.add(current_file_path)
+        if self._dependency_graph is None:
+            self._dependency_graph = self.build_dependency_graph()
+        if self._reachable_imports is None:
+            self._reachable_imports = self.build_reachable_imports()
 
-        imports = self.find_imports(current_file_path)
-        print(f'imports for {current_file_path}: {len(imports)}')
         all_files = {current_file_path}
-
-        for imp in imports:
-            imp_path, is_local = self.resolve_import_path(
-                current_file_path, imp)
-            if imp_path and os.path.exists(imp_path) and not 'node_modules' in imp_path and 'src' in imp_path:
-                all_files.update(self.recursive_imports(imp_path, visited))
-
+        if current_file_path in self._dependency_graph:
+            for imp_path in self._dependency_graph.successors(current_file_path):
+                all_files |= self._reachable_imports.get(imp_path, frozenset())
+        print(f'imports for {current_file_path}: {len(all_files) - 1}')
         return all_files
 
     def find_css_imports(self, file_content):
@@ -242,10 +299,39 @@ class Distiller():
                               file_content, flags=re.MULTILINE)
         return css_paths, file_content
 
-    def distill_style_and_code(self, files):
+    def css_imports(self, file_path):
+        # css import specifiers of a script, scanned once per repo and kept on its graph node
+        node = self._dependency_graph.nodes[file_path] if self._dependency_graph is not None \
+            and file_path in self._dependency_graph else None
+        if node is not None and 'css_imports' in node:
+            return node['css_imports']
+        css_paths, _ = self.find_css_imports(self._repo_index.read(file_path))
+        css_paths = tuple(css_paths)
+        if node is not None:
+            node['css_imports'] = css_paths
+        return css_paths
+
+    def style_key(self, css_path):
+        # a stylesheet reached through several paths, or copied under another name, is bundled once
+        return self._repo_index.content_hash(css_path) or css_path
+
+    def concat_styles(self, css_paths, seen_styles):
+        contents = []
+        for css_path in css_paths:
+            if not os.path.exists(css_path):
+                continue
+            key = self.style_key(css_path)
+            if key in seen_styles:
+                continue
+            seen_styles.add(key)
+            contents.append(self._repo_index.read(css_path))
+        return contents
+
+    def distill_style_and_code(self, files, seen_styles=None):
         component_content = {}
         css_content = ""
-        processed_css_files = set()  # Set to track processed CSS files
+        # content hashes of the css files taken in so far, shared with the importer styles by bundle_files
+        processed_css_files = seen_styles if seen_styles is not None else set()
 
         for file_path in files:
             print(f'--- extracting file: {file_path} ---')
@@ -267,8 +353,7 @@ class Distiller():
                 print('processing file:', file_path)
                 if not os.path.exists(file_path):
                     continue
-                with open(file_path, 'r') as file:
-                    content = file.read()
+                content = self._repo_index.read(file_path)
                 css_paths, content = self.find_css_imports(content)
 
                 if file_path.endswith(('.js', '.jsx', '.ts', '.tsx')):
@@ -280,12 +365,11 @@ class Distiller():
                 for css_path in css_paths:
                     full_css_path, is_local = self.resolve_import_path(
                         file_path, {'source': {'value': css_path}})
-                    if full_css_path and os.path.exists(full_css_path) and full_css_path not in processed_css_files:
-                        with open(full_css_path, 'r') as css_file:
-                            raw_css = css_file.read()
-                            if raw_css:
-                                css_content += raw_css + "\n"
-                        processed_css_files.add(full_css_path)
+                    if full_css_path and os.path.exists(full_css_path) and self.style_key(full_css_path) not in processed_css_files:
+                        raw_css = self._repo_index.read(full_css_path)
+                        if raw_css:
+                            css_content += raw_css + "\n"
+                        processed_css_files.add(self.style_key(full_css_path))
 
                         # statistics
                         self.add_statistic('total_css_files', 1)
@@ -306,14 +390,19 @@ class Distiller():
                 return True
         return False
 
+    def filter_css_prompt(self, component_code, raw_style):
+        return FILTER_CSS_PROMPT.format(
+            example_component_code=FILTER_CSS_EXAMPLE_COMPONENT_CODE,
+            example_input_css=FILTER_CSS_EXAMPLE_INPUT_CSS,
+            example_output_css=FILTER_CSS_EXAMPLE_OUTPUT_CSS,
+            component_code=component_code,
+            raw_style=raw_style)
+
     def gpt_filter_css(self, component_code, raw_style):
         if not component_code or not raw_style or raw_style == '':
             return raw_style, False
-        example_component_code = 'function MyComponent() { return <div class="comp">comp test</div>; }'
-        example_input_css = 'html {font-size: 16px;} \n img { width: 100px } \n .comp { color: red; } \n .footer { color: green }'
-        example_output_css = 'html {font-size: 16px;} \n .comp { color: red; }'
-        prompt = f'You will be given a self-contained React component code snippet and a CSS code snippet. You need to check the CSS code snippet and see if it could affect React component code snippet (according to the selector mechanism of CSS, for example style specification by tag name, id, class name, or even more complecated selection sepecification). You need to return a CSS code snippet that contains only the CSS properties that could affect the provided React component code snippet in rendering. For example, if the React component code snippet is defined as follows: \n{example_component_code}\n, and the CSS code snippet is defined as follows: \n{example_input_css}\n, then the output should be: \n{example_output_css}\n. REPLY WITH the filtered CSS code snippet only, no explanations, no comments, no qoutes wrapping the result code, no labels, and no any other text needed. Here is the React component code snippet: \n{component_code}\n\n and here is the CSS code snippet: \n{raw_style}\n\n, the filtered CSS code snippet should be:\n'
-        gpt_result = llm_chat.chat(prompt)
+        gpt_result = self.chat(
+            'filter_css', self.filter_css_prompt(component_code, raw_style))
         if gpt_result['content'] is None:
             return raw_style, False
         filtered_css = postprocess_code_reponse(gpt_result['content'])
@@ -322,8 +411,8 @@ class Distiller():
     # return the filtered css content and has_gpt_err
     def add_mock_inputs(self, content):
         # 1st round to locate the input parameters
-        prompt = 'You will be given a self-contained React component code snippet. You need to check all the components and see if they have any input parameters. you need to return a json object with the component name as the key and the value as a list of input parameters. If the component does not have any input parameters, the value should be an empty list. For example, if the component is defined as follows: function MyComponent(props) { return <div>{props.name}</div>; } The output should be: { "MyComponent": ["name"] }, REPLY WITH this json object only, no explanations, no comments, and no any other text needed. Here is the code snippet: '
-        params_list_response = llm_chat.chat(prompt + content)
+        params_list_response = self.chat(
+            'mock_input_params', MOCK_INPUT_PARAMS_PROMPT + content)
 
         # 2nd round to create mock input parameters
         if params_list_response['content'] is None:
@@ -337,16 +426,15 @@ class Distiller():
                     has_params = True
                     break
             if has_params:
-                prompt2 = 'Generate the necessary mock inputs for this React component based on the input parameters identified in the previous step. For each expected parameter, create appropriate mock data. If the parameter is a function, provide a function with the correct number of arguments and an empty body; for functions without parameters, use an empty function. For example, given the component definition function MyComponent(props) { return <div>{props.name}</div>; } and the parameters { "MyComponent": ["name"] }, the mock input should be { "name": "John" }. Update the component to use this mock input as its default, like so: function MyComponent(props = { "name": "John" }) { return <div>{props.name}</div>; }. Modify the original code minimally to incorporate these mock inputs, and do not change or ommit any part of the code if it is not related to incorporating the mock inputs. The response should include only the modified component code, without additional text, comments, or explanations.'
                 chat_history = [{
                     'role': 'user',
-                    'content': prompt + content
+                    'content': MOCK_INPUT_PARAMS_PROMPT + content
                 }, {
                     'role': 'assistant',
                     'content': params_list
                 }]
-                updated_content = llm_chat.chat(
-                    prompt2, chat_hist=chat_history)
+                updated_content = self.chat(
+                    'mock_input_values', MOCK_INPUT_VALUES_PROMPT, chat_hist=chat_history)
                 updated_content = postprocess_code_reponse(
                     updated_content['content'])
                 if updated_content is None:
@@ -358,16 +446,12 @@ class Distiller():
 
     # return the fixed code content, whether the code is error free, code review result, and has_gpt_err
     def debug_code(self, content):
-        system_prompt = 'We are conducting a static code review to ensure that a React component and all its sub-components are self-contained and error-free. This will involve checking if the default exported component can function independently by importing it without any additional local dependencies (third-party dependencies not included), ensuring all sub-components are also error-free. The review will proceed in two rounds: an initial evaluation followed by bug fixing if necessary.'
-        round_1_prompt = 'Please assess the provided React component code, which includes the main component and its sub-components. Determine if the default exported component, including any third-party library imports, can be rendered as self-contained and without errors. Reply with "Yes" if there are no issues. If you find any problems, respond with "No" first and then describe the issues along with possible solutions. Here is the code snippet: \n'
-        round_2_prompt = 'Please provide the entire corrected code for the default exported component and its sub-components, ensuring all parts are now self-contained and error-free. When addressing any missing elements, directly add the exact necessary content (e.g., defining missing variables or functions) within the code itself, instead of just including import statements. Change the code as less as possible to fix the errors, do not change or ommit any code that is not related to fixing the errors, Meanwhile the "default" export statement needs to be kept. Include both the revised and the error-free sections of the code to ensure the complete component is functional. REPLY ONLY WITH the complete code, no explanations, no labels, no qoutes wrapping the result code, no comments, and no any other text needed.'
-
         chat_history = [{
             'role': 'system',
-            'content': system_prompt
+            'content': DEBUG_CODE_SYSTEM_PROMPT
         }]
-        code_review_result = llm_chat.chat(
-            round_1_prompt + content, chat_hist=chat_history)
+        code_review_result = self.chat(
+            'debug_code_review', DEBUG_CODE_REVIEW_PROMPT + content, chat_hist=chat_history)
 
         if code_review_result['content'] is None:
             return content, False, 'Error in code review should skip', False
@@ -377,13 +461,14 @@ class Distiller():
         else:
             chat_history.append({
                 'role': 'user',
-                'content': round_1_prompt + content
+                'content': DEBUG_CODE_REVIEW_PROMPT + content
             })
             chat_history.append({
                 'role': 'assistant',
                 'content': code_review_result['content']
             })
-            fixed_code = llm_chat.chat(round_2_prompt, chat_hist=chat_history)
+            fixed_code = self.chat(
+                'debug_code_fix', DEBUG_CODE_FIX_PROMPT, chat_hist=chat_history)
             fixed_code = postprocess_code_reponse(fixed_code['content'])
             if fixed_code is None:
                 return content, False, 'Error in code fixing should skip', False
@@ -392,24 +477,22 @@ class Distiller():
 
     def build_dependency_graph(self):
         graph = nx.DiGraph()
-        for root, dirs, files in os.walk(self._repo_path):
-            for file in files:
-                if file.endswith(('.js', '.jsx', '.ts', '.tsx', '.css', '.scss', '.sass', '.less', '.styl')):
-                    full_path = os.path.join(root, file)
-                    graph.add_node(full_path)
-                    try:
-                        imports = []
-                        if file.endswith(('.js', '.jsx', '.ts', '.tsx')):
-                            imports = self.find_imports(full_path)
-                        for imp in imports:
-                            imp_path, is_local = self.resolve_import_path(
-                                full_path, imp)
-                            if imp_path:
-                                graph.add_edge(full_path, imp_path)
-                    except Exception as e:
-                        print(f"Error processing file {full_path}: {e}")
-                        tb = traceback.format_exc()
-                        print(tb)
+        graph.add_nodes_from(self._repo_index.files())
+        script_files = self._repo_index.files(SCRIPT_EXTENSIONS)
+
+        # parse all the scripts in one go so the parser daemons can batch them
+        all_imports = self.find_imports_batch(script_files)
+        for full_path in script_files:
+            try:
+                for imp in all_imports.get(full_path, []):
+                    imp_path, is_local = self.resolve_import_path(
+                        full_path, imp)
+                    if imp_path:
+                        graph.add_edge(full_path, imp_path)
+            except Exception as e:
+                print(f"Error processing file {full_path}: {e}")
+                tb = traceback.format_exc()
+                print(tb)
         print('------------------- dependency graph -------------------- ')
         for node in graph.nodes():
             print(f"File: {node}")
@@ -418,36 +501,69 @@ class Distiller():
         print('------------------- end dependency graph -------------------- ')
         return graph
 
+    def node_styles(self, node):
+        # the stylesheet itself, or the stylesheets a script imports
+        if node.endswith(STYLE_EXTENSIONS):
+            return (node,)
+        if node.endswith(SCRIPT_EXTENSIONS) and node in self._repo_index:
+            return tuple(os.path.normpath(os.path.join(os.path.dirname(node), css_path))
+                         for css_path in self.css_imports(node))
+        return ()
+
+    def inherited_styles(self, scc):
+        # styles of every ancestor of a condensed component, memoized per component: each is the
+        # union of its predecessors' own and inherited styles, so files are scanned once per repo.
+        # Components are filled in lazily (predecessors first) to leave unrelated files unread
+        condensed = self._style_condensation
+        stack = [scc]
+        while stack:
+            current = stack[-1]
+            if current in self._inherited_styles:
+                stack.pop()
+                continue
+            missing = [predecessor for predecessor in condensed.predecessors(current)
+                       if predecessor not in self._inherited_styles]
+            if missing:
+                stack.extend(missing)
+                continue
+            stack.pop()
+            styles = set()
+            for predecessor in condensed.predecessors(current):
+                styles |= self._inherited_styles[predecessor]
+                for member in condensed.nodes[predecessor]['members']:
+                    styles.update(self.node_styles(member))
+            self._inherited_styles[current] = frozenset(styles)
+        return self._inherited_styles[scc]
+
     def collect_style_dependencies(self, start_node):
-        styles = []
-        # Collect paths from start node to all reachable nodes
-        # Traverse all ancestors of the node
-        for node in nx.ancestors(self._dependency_graph, start_node):
-            if node.endswith(('.css', '.scss', '.sass', '.less', '.styl')):
-                styles.append(node)
-            elif node.endswith(('js', 'jsx', 'ts', 'tsx')):
-                with open(node, 'r') as file:
-                    content = file.read()
-                    css_paths, file_content = self.find_css_imports(content)
-                    styles += [os.path.join(os.path.dirname(node), css_path)
-                               for css_path in css_paths]
-        return styles
+        # styles of all ancestors of the node (the files importing it, directly or not)
+        if self._dependency_graph is None:
+            self._dependency_graph = self.build_dependency_graph()
+        if start_node not in self._dependency_graph:
+            return []
+        with self._lock:
+            if self._style_condensation is None:
+                self._style_condensation = nx.condensation(
+                    self._dependency_graph)
+        scc = self._style_condensation.graph['mapping'][start_node]
+        styles = set(self.inherited_styles(scc))
+        # in an import cycle the other members are ancestors too
+        for member in self._style_condensation.nodes[scc]['members']:
+            if member != start_node:
+                styles.update(self.node_styles(member))
+        return sorted(styles)
 
     def bundle_files(self, files, full_entry_component_path, entry_component_path):
         gpt_err = False
+        seen_styles = set()
         css_content, component_content = self.distill_style_and_code(
-            files)
+            files, seen_styles)
 
         extra_css_paths = self.collect_style_dependencies(
             full_entry_component_path)
 
-        extra_css_content = ''
-        for extra_css_path in extra_css_paths:
-            if not os.path.exists(extra_css_path):
-                continue
-            with open(extra_css_path, 'r') as css_file:
-                raw_css = css_file.read()
-                extra_css_content += raw_css + '\n'
+        extra_css_content = ''.join(raw_css + '\n' for raw_css in self.concat_styles(
+            extra_css_paths, seen_styles))
 
         component_content_str = ''
         component_file_paths = list(component_content.keys())
@@ -560,6 +676,57 @@ class Distiller():
             print("A cycle was detected in the graph. Topological sort is not possible.")
             return filenames
 
+    def component_levels(self, component_files):
+        # a component only reuses the bundles of the components it transitively imports, so it is
+        # placed one level above the deepest of them; components of one level are independent.
+        # Components importing each other (a cycle) share a level.
+        components = set(component_files)
+        graph = nx.DiGraph()
+        graph.add_nodes_from(components)
+        for component_path in components:
+            for dependency in self.recursive_imports(component_path):
+                if dependency != component_path and dependency in components:
+                    graph.add_edge(component_path, dependency)
+
+        condensed = nx.condensation(graph)
+        level_by_scc = {}
+        for scc in reversed(list(nx.topological_sort(condensed))):
+            level_by_scc[scc] = max((level_by_scc[successor] + 1
+                                     for successor in condensed.successors(scc)), default=0)
+        levels = defaultdict(list)
+        for component_path, scc in condensed.graph['mapping'].items():
+            levels[level_by_scc[scc]].append(component_path)
+        return [sorted(levels[level]) for level in sorted(levels)]
+
+    def bundle_input_hashes(self, component_path, files):
+        # content hashes of everything bundle_files reads for the component: its scripts, their
+        # css imports, the styles of its importers, and the inputs of the child bundles it reuses
+        input_hashes = {}
+        for file_path in files:
+            input_hashes[file_path] = self._repo_index.content_hash(file_path)
+            if file_path != component_path and file_path in self._processed_files:
+                input_hashes[file_path + '#bundle'] = self._manifest.inputs_digest(
+                    file_path)
+            if not os.path.exists(file_path):
+                continue
+            for css_path in self.css_imports(file_path):
+                full_css_path, is_local = self.resolve_import_path(
+                    file_path, {'source': {'value': css_path}})
+                if full_css_path:
+                    input_hashes[full_css_path] = self._repo_index.content_hash(
+                        full_css_path)
+        for css_path in self.collect_style_dependencies(component_path):
+            input_hashes[css_path] = self._repo_index.content_hash(css_path)
+        return input_hashes
+
+    def write_bundle(self, output_path, bundled_json):
+        # write next to the repo output folder and rename, a crash never leaves a truncated bundle
+        # behind, and downstream stages never see the temp file inside the folder
+        tmp_path = f'{self._output_dir}.{os.path.basename(output_path)}.tmp'
+        with open(tmp_path, 'w') as output_file:
+            json.dump(bundled_json, output_file, indent=4)
+        os.replace(tmp_path, output_path)
+
     # return whether successfully processed the component, and has_gpt_err
     def process_component(self, component_path):
         print('=================================================================')
@@ -571,16 +738,35 @@ class Distiller():
             output_filename = os.path.basename(
                 component_path).replace(f'.{file_type}', '_bundled.json')
             output_path = os.path.join(self._output_dir, output_filename)
-            # check if the file already exists
-            if os.path.exists(output_path):
-                print(f"File {output_path} already exists. Skipping...")
-                return True, False
 
             all_files = self.recursive_imports(component_path)
             print(f'all files for {component_path}: {all_files}')
+            input_hashes = self.bundle_input_hashes(component_path, all_files)
+
+            # check if the file already exists and was built from the current inputs
+            if os.path.exists(output_path):
+                if self._manifest.get(component_path) is None and self._manifest.adopts_unrecorded:
+                    # bundled before manifests were kept, take it as built from the current inputs;
+                    # with a manifest, a bundle without an entry was written by a crashed run
+                    self._manifest.record(
+                        component_path, output_path, input_hashes)
+                if self._manifest.is_up_to_date(component_path, input_hashes):
+                    print(f"File {output_path} is up to date. Skipping...")
+                    with self._lock:
+                        self._processed_files[component_path] = output_path
+                    return True, False
+                print(
+                    f"Inputs of {output_path} changed since it was bundled, distilling again...")
+                self.add_statistic('total_components_redistilled', 1)
+
             # Bundle the files into a single chunk of content
+            start_time = time.time()
+            self._llm_usage.tokens = 0
             bundled_json, has_gpt_err = self.bundle_files(
                 all_files, component_path, os.path.basename(component_path))
+            self.observe_statistic(
+                'component_seconds', time.time() - start_time)
+            self.observe_statistic('component_tokens', self._llm_usage.tokens)
 
             if has_gpt_err:
                 return False, True
@@ -591,12 +777,22 @@ class Distiller():
             # identify the file type
             bundled_json['file_type'] = file_type
 
-            self._processed_files[component_path] = output_path
             print(f"-- Writing bundled content to {output_path}")
             os.makedirs(os.path.dirname(output_path), exist_ok=True)
-            with open(output_path, 'w') as output_file:
-                json.dump(bundled_json, output_file, indent=4)
+            self.write_bundle(output_path, bundled_json)
+            if self._bundle_store:
+                self._bundle_store.append(os.path.basename(
+                    self._repo_path), output_filename, bundled_json)
+            self._manifest.record(component_path, output_path, input_hashes)
+            with self._lock:
+                self._processed_files[component_path] = output_path
             return True, False
+        except LLMBudgetExceeded as e:
+            # no bundle and no manifest entry, so a later run with budget distills it
+            print(f"Skipping component {component_path}: {e}")
+            self.add_statistic('total_components_budget_refused', 1)
+            self._budget_refused = True
+            return False, False
         except Exception as e:
             print(f"Error processing component {component_path}: {e}")
             tb = traceback.format_exc()
@@ -607,61 +803,95 @@ class Distiller():
     def process_repo(self):
         print(
             f'----------- start processing {self._repo_path} -----------------')
-        # copy the package.json file to the output directory
-        self.copy_package_json()
-
-        # Build the dependency graph for the project
-        self._dependency_graph = self.build_dependency_graph()
+        try:
+            # copy the package.json file to the output directory
+            self.copy_package_json()
 
-        # Find all React components in the project
-        all_files = self.find_all_files()
+            # Build the dependency graph for the project
+            self._dependency_graph = self.build_dependency_graph()
+            self._reachable_imports = None
+            self._style_condensation = None
+            self._inherited_styles = {}
 
-        component_files = self.find_react_components()
-        print(
-            f"Found {len(component_files)}/{len(all_files)} components in {self._repo_path}.")
-        print('all_files:', all_files)
-        print('component_files:', component_files)
+            # Find all React components in the project
+            all_files = self.find_all_files()
 
-        sorted_component_files = self.topological_sort_files(component_files)
-        failed_components = set()
-        for component_path in tqdm(sorted_component_files, desc='Processing components'):
-            try:
-                success, has_gpt_err = self.process_component(component_path)
-                if has_gpt_err:
-                    failed_components.add(component_path)
+            component_files = self.find_react_components()
+            print(
+                f"Found {len(component_files)}/{len(all_files)} components in {self._repo_path}.")
+            print('all_files:', all_files)
+            print('component_files:', component_files)
+
+            # dependencies first: every level only needs the bundles of the levels below it
+            component_levels = self.component_levels(component_files)
+            failed_components = set()
+            progress = tqdm(total=len(component_files),
+                            desc='Processing components')
+            for level_index, level in enumerate(component_levels):
+                llm_down = False
+                with ThreadPoolExecutor(max_workers=self._component_concurrency) as executor:
+                    futures = {executor.submit(self.process_component, component_path): component_path
+                               for component_path in level}
+                    for future in as_completed(futures):
+                        component_path = futures[future]
+                        progress.update(1)
+                        try:
+                            success, has_gpt_err = future.result()
+                            if has_gpt_err:
+                                failed_components.add(component_path)
+                                llm_down = True
+                            elif not success:
+                                failed_components.add(component_path)
+                                print(
+                                    f"Failed to process component {component_path}")
+                        except Exception as e:
+                            print(
+                                f"Error processing component {component_path}: {e}")
+                            failed_components.add(component_path)
+                            tb = traceback.format_exc()
+                            print(tb)
+                if llm_down:
                     print(f"llm is down!!!!!")
+                    progress.close()
                     return False
-                if not success:
-                    failed_components.add(component_path)
-                    print(f"Failed to process component {component_path}")
-                # break
-            except Exception as e:
-                print(f"Error processing component {component_path}: {e}")
-                failed_components.add(component_path)
-                tb = traceback.format_exc()
-                print(tb)
-                continue
-
-        repo_component_count = {
-            'total_components': len(sorted_component_files),
-            'failed_components': list(failed_components),
-        }
-
-        self.update_statistic('failed_components', {
-            'repo': self._repo_path,
-            'count': repo_component_count
-        })
+                if self._budget_refused:
+                    # refused components were skipped, stop once no further request can pass
+                    if llm_chat.budget_status()[0] == BUDGET_HARD:
+                        print(f"llm token budget of the run used up, stopping at {self._repo_path}")
+                        progress.close()
+                        return False
+                    if llm_chat.budget_status(repo=os.path.basename(self._repo_path))[0] == BUDGET_HARD:
+                        print(f"llm token budget of {self._repo_path} used up, skipping its remaining components")
+                        for remaining_level in component_levels[level_index + 1:]:
+                            failed_components.update(remaining_level)
+                        break
+            progress.close()
+
+            repo_component_count = {
+                'total_components': len(component_files),
+                'failed_components': list(failed_components),
+            }
+
+            self.update_statistic('failed_components', {
+                'repo': self._repo_path,
+                'count': repo_component_count
+            })
 
-        # create a temp file to store the failed components
-        failed_components_file = os.path.join(
-            self._repo_path, 'failed_components.json')
-        with open(failed_components_file, 'w') as f:
-            json.dump(list(failed_components), f, indent=4)
+            # create a temp file to store the failed components
+            failed_components_file = os.path.join(
+                self._repo_path, 'failed_components.json')
+            with open(failed_components_file, 'w') as f:
+                json.dump(list(failed_components), f, indent=4)
 
-        print(
-            f'----------- end processing {self._repo_path} -----------------')
+            print(
+                f'----------- end processing {self._repo_path} -----------------')
 
-        return True
+            self._repo_index.release_contents()
+            return True
+        finally:
+            # the manifest is saved once per repo, not per component
+            if self._manifest is not None:
+                self._manifest.save()
 
     def read_file(self, base_path, file):
         path = os.path.join(base_path, file)
@@ -688,62 +918,309 @@ class Util():
         return repo_paths
 
 
-def count_components(base_path, repo_path, output_path, lock):
+def count_components(base_path, repo_path, output_path, lock, repo_index=None):
     tmp_distiller = Distiller(
         base_path=base_path,
         repo_path=repo_path,
         output_dir=output_path,
-        statistic={},
-        lock=lock)
+        statistic=StatsCollector(),
+        lock=lock,
+        repo_index=repo_index)
     component_files = tmp_distiller.find_react_components(False)
     return len(component_files)
 
 
-def sort_repos_by_components(base_path, repo_paths, output_path, lock):
-    return sorted(repo_paths, key=lambda x: count_components(base_path, x, output_path, lock))
-
-
-def process_repositories_in_batches(base_path, repo_paths, output_path, max_workers, lock, statistic):
-    # sort the repos based on the number of components
-    print('sorting repos based on the number of components...')
-    sorted_repo_paths = sort_repos_by_components(
-        base_path, repo_paths, output_path, lock)
-
-    # Split sorted_repo_paths into chunks of size max_workers
-    batches = [sorted_repo_paths[i:i + max_workers]
-               for i in range(0, len(sorted_repo_paths), max_workers)]
-
-    print(
-        f"Processing {len(sorted_repo_paths)} repositories in {len(batches)} batches.")
-    for batch_index, batch in tqdm(enumerate(batches), total=len(batches), desc='Processing Batches'):
-        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-            futures = {executor.submit(Distiller(
-                base_path=base_path,
-                repo_path=repo_path,
-                output_dir=output_path,
-                statistic=statistic,
-                lock=lock).process_repo): repo_path for repo_path in batch}
-            for future in tqdm(concurrent.futures.as_completed(futures), total=len(futures), desc=f'Processing Batch {batch_index + 1}/{len(batches)}'):
-                repo_path = futures[future]
-                try:
-                    success = future.result()
-                    if not success:
-                        print(
-                            f"Failed to process repository {repo_path} cause of gpt error")
-                        return
-                    print(f"Repository processed successfully: {repo_path}")
-                    # break
-                except Exception as e:
-                    print(f"Error processing repository {repo_path}: {e}")
-                    tb = traceback.format_exc()
-                    print(tb)
+def count_repo_components(base_path, repo_paths, output_path, lock, repo_indexes=None):
+    # the index built while counting is handed over to process_repo through `repo_indexes`,
+    # only the file contents are dropped in between to bound memory
+    component_counts = {}
+    for repo_path in tqdm(repo_paths, desc='Counting components'):
+        repo_index = RepoIndex(repo_path).build()
+        component_counts[repo_path] = count_components(
+            base_path, repo_path, output_path, lock, repo_index)
+        repo_index.release_contents()
+        if repo_indexes is not None:
+            repo_indexes[repo_path] = repo_index
+    return component_counts
+
+
+def sort_repos_by_components(base_path, repo_paths, output_path, lock, repo_indexes=None):
+    component_counts = count_repo_components(
+        base_path, repo_paths, output_path, lock, repo_indexes)
+    return sorted(repo_paths, key=lambda x: component_counts[x])
+
+
+class RepoWorkerConfig(NamedTuple):
+    base_path: str
+    output_path: str
+    parser_daemons: int
+    llm_cache_path: str
+    llm_cache_size_bytes: int
+    component_concurrency: int
+    bundle_store_path: str
+    bundle_store_codec: str
+
+
+def process_repo(config: RepoWorkerConfig, repo_path, repo_index, import_parser, llm_cache, bundle_store):
+    # (repo_path, success, statistic snapshot) of one repo
+    statistic = StatsCollector()
+    start_time = time.time()
+    success = None
+    try:
+        success = Distiller(
+            base_path=config.base_path,
+            repo_path=repo_path,
+            output_dir=config.output_path,
+            statistic=statistic,
+            lock=Lock(),
+            import_parser=import_parser,
+            repo_index=repo_index,
+            llm_cache=llm_cache,
+            component_concurrency=config.component_concurrency,
+            bundle_store=bundle_store).process_repo()
+    except Exception as e:
+        print(f"Error processing repository {repo_path}: {e}")
+        tb = traceback.format_exc()
+        print(tb)
+    finally:
+        statistic.observe('repo_seconds', time.time() - start_time)
+    return repo_path, success, statistic.snapshot()
+
+
+def raise_terminated(signum, frame):
+    # unwinds the worker so its finally blocks and finalizers run
+    raise SystemExit(128 + signum)
+
+
+def repo_worker(config: RepoWorkerConfig, repo_indexes, tasks, results):
+    # a long-lived child process: node parsers and the sqlite connection can not be shared
+    # across processes, so every worker opens its own once and keeps them for all its repos
+    # its own process group, so a worker that does not exit on SIGTERM is killed with its node parsers
+    os.setpgrp()
+    signal.signal(signal.SIGTERM, raise_terminated)
+    import_parser = ImportParserPool(
+        config.base_path, size=config.parser_daemons) if config.parser_daemons > 0 else None
+    llm_cache = LLMResponseCache(
+        config.llm_cache_path, max_size_bytes=config.llm_cache_size_bytes) if config.llm_cache_path else None
+    bundle_store = BundleStoreWriter(
+        config.bundle_store_path, codec=config.bundle_store_codec) if config.bundle_store_path else None
+    try:
+        while True:
+            repo_path = tasks.get()
+            if repo_path is None:
+                break
+            results.put(process_repo(config, repo_path, repo_indexes.pop(repo_path, None),
+                                     import_parser, llm_cache, bundle_store))
+    finally:
+        if import_parser:
+            import_parser.close()
+        if llm_cache:
+            llm_cache.close()
+        if bundle_store:
+            bundle_store.close()
+
+
+class RepoWorker(object):
+    __slots__ = ('process', 'tasks', 'repo_path', 'started_at')
+
+    def __init__(self, context, config, repo_indexes, results):
+        self.tasks = context.SimpleQueue()
+        self.process = context.Process(target=repo_worker, args=(
+            config, repo_indexes, self.tasks, results), daemon=True)
+        self.process.start()
+        self.repo_path = None
+        self.started_at = None
+
+    def assign(self, repo_path):
+        self.repo_path = repo_path
+        self.started_at = time.time()
+        self.tasks.put(repo_path)
+
+    def stop(self, grace=WORKER_TERMINATE_GRACE):
+        # SIGTERM first, the worker closes what it opened; then kill whatever is left of its group
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join(grace)
+        self.kill_group()
+        self.process.join()
+
+    def kill_group(self):
+        # node parsers left behind by a worker that was killed or crashed
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+
+def record_repo_statistic(statistic, repo_statistic, failed_components_path=None):
+    # per repo failure records go to an append-only jsonl instead of growing statistic.json
+    failed_components = repo_statistic.pop('failed_components', [])
+    if failed_components_path and failed_components:
+        with open(failed_components_path, 'a') as f:
+            for record in failed_components:
+                f.write(json.dumps(record) + '\n')
+    elif failed_components:
+        repo_statistic['failed_components'] = failed_components
+    merge_snapshot(statistic, repo_statistic)
+
+
+def process_repositories(repo_paths, max_workers, statistic, config: RepoWorkerConfig, repo_timeout=0, largest_first=False,
+                         statistic_path=None, statistic_interval=60):
+    """
+    Keep `max_workers` repositories in flight on as many long-lived worker processes, each
+    with its own node import parsers and llm cache connection, and hand the next repository
+    to a worker as soon as it finishes one. Repositories are scheduled by their rule-based
+    component count (fewest first unless `largest_first`). A repository running longer than
+    `repo_timeout` seconds is terminated with its worker (killed with its process group
+    when it does not exit within WORKER_TERMINATE_GRACE seconds), and a worker that was
+    terminated or died is replaced. Statistic snapshots of every repository are merged into
+    `statistic` by this process only, and `statistic` is written to `statistic_path` every
+    `statistic_interval` seconds while repositories are running.
+    """
+    failed_components_path = os.path.join(
+        config.output_path, 'failed_components.jsonl')
+    last_snapshot = time.time()
+    print('counting components of every repo...')
+    repo_indexes = {}
+    component_counts = count_repo_components(
+        config.base_path, repo_paths, config.output_path, Lock(), repo_indexes)
+    sign = -1 if largest_first else 1
+    pending = [(sign * component_counts[repo_path], i, repo_path)
+               for i, repo_path in enumerate(repo_paths)]
+    heapq.heapify(pending)
+
+    # fork so the repo indexes are inherited by the workers instead of pickled
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    workers = [RepoWorker(context, config, repo_indexes, results)
+               for _ in range(min(max_workers, len(repo_paths)))]
+    # the workers have their copies
+    repo_indexes.clear()
+    llm_down = False
+
+    def replace(worker):
+        worker.stop()
+        new_worker = workers[workers.index(worker)] = RepoWorker(
+            context, config, repo_indexes, results)
+        return new_worker
+
+    print(f"Processing {len(repo_paths)} repositories with {len(workers)} workers.")
+    progress = tqdm(total=len(repo_paths), desc='Processing repositories')
+    while any(worker.repo_path for worker in workers) or (pending and not llm_down):
+        if statistic_path and time.time() - last_snapshot >= statistic_interval:
+            write_statistic_snapshot(statistic_path, statistic)
+            last_snapshot = time.time()
+        for worker in list(workers):
+            if pending and not llm_down and worker.repo_path is None:
+                if not worker.process.is_alive():
+                    worker = replace(worker)
+                worker.assign(heapq.heappop(pending)[2])
+
+        try:
+            repo_path, success, repo_statistic = results.get(timeout=1)
+        except queue.Empty:
+            repo_path = None
+        worker = next((worker for worker in workers if repo_path and worker.repo_path == repo_path), None)
+        # a result of a repo already accounted for as timed out or crashed is dropped
+        if worker is not None:
+            worker.repo_path = None
+            record_repo_statistic(
+                statistic, repo_statistic, failed_components_path)
+            progress.update(1)
+            if success is False:
+                print(
+                    f"Failed to process repository {repo_path} cause of gpt error, waiting for the running ones...")
+                llm_down = True
+            elif success:
+                print(f"Repository processed successfully: {repo_path}")
+
+        # on every round, results of the other workers keep coming while one hangs
+        now = time.time()
+        for worker in list(workers):
+            if worker.repo_path is None:
+                continue
+            if repo_timeout > 0 and now - worker.started_at > repo_timeout:
+                print(
+                    f"Repository {worker.repo_path} exceeded its budget of {repo_timeout}s, terminating...")
+                merge_snapshot(statistic, {'total_repos_timed_out': 1, 'timed_out_repos': [worker.repo_path]})
+            elif not worker.process.is_alive():
+                print(f"Worker for repository {worker.repo_path} died with exit code {worker.process.exitcode}")
+                merge_snapshot(statistic, {'total_repos_crashed': 1, 'crashed_repos': [worker.repo_path]})
+            else:
+                continue
+            replace(worker)
+            progress.update(1)
+    for worker in workers:
+        worker.tasks.put(None)
+    for worker in workers:
+        worker.process.join()
+        worker.kill_group()
+    progress.close()
+
+
+def estimate_repositories(repo_paths, max_workers, config: RepoWorkerConfig, request_seconds, report_path):
+    # dry run: predict llm requests, tokens and wall time of every repo without calling the llm
+    estimator = CostEstimator(request_seconds)
+    import_parser = ImportParserPool(
+        config.base_path, size=config.parser_daemons) if config.parser_daemons > 0 else None
+    repo_costs = {}
+    try:
+        for repo_path in tqdm(repo_paths, desc='Estimating repositories'):
+            try:
+                distiller = Distiller(
+                    base_path=config.base_path,
+                    repo_path=repo_path,
+                    output_dir=None,
+                    statistic=StatsCollector(),
+                    lock=Lock(),
+                    import_parser=import_parser)
+                repo_costs[repo_path] = estimator.estimate_repo(
+                    distiller, config.component_concurrency)
+            except Exception as e:
+                print(f"Error estimating repository {repo_path}: {e}")
+                tb = traceback.format_exc()
+                print(tb)
+    finally:
+        if import_parser:
+            import_parser.close()
+
+    total = summarize_costs(repo_costs, max_workers)
+    write_cost_report(report_path, repo_costs, total)
+    print(f"dry run of {total['repos']} repos: {total['components']} components, "
+          f"{total['requests_min']}-{total['requests_max']} requests, "
+          f"{total['input_tokens_min']}-{total['input_tokens_max']} input tokens, "
+          f"{total['seconds_min'] / 3600:.2f}-{total['seconds_max'] / 3600:.2f} hours. report: {report_path}")
+    return total
 
 
 def parse_args():
     parser = argparse.ArgumentParser()
-    parser.add_argument('--threads', type=int, default=30)
+    parser.add_argument('--threads', type=int, default=30,
+                        help='number of repositories processed in parallel, each in its own process')
+    parser.add_argument('--component_concurrency', type=int, default=4,
+                        help='number of independent components of one repository distilled in parallel')
+    parser.add_argument('--repo_timeout', type=int, default=0,
+                        help='wall-clock budget of a single repository in seconds, 0 for no limit')
+    parser.add_argument('--largest_first', action='store_true',
+                        help='schedule repositories with the most components first')
     parser.add_argument('--repo_path', type=str)
     parser.add_argument('--output_path', type=str)
+    parser.add_argument('--parser_daemons', type=int, default=4,
+                        help='number of persistent node import parsers, 0 to spawn one node process per file')
+    parser.add_argument('--llm_cache_path', type=str, default='',
+                        help='sqlite file caching llm responses, defaults to <output_path>/llm_cache.sqlite')
+    parser.add_argument('--llm_cache_size_mb', type=int, default=1024,
+                        help='max size of the cached llm responses, 0 to disable the cache')
+    parser.add_argument('--bundle_store', type=str, default='',
+                        help='also append every bundle to a sharded jsonl bundle store at this path')
+    parser.add_argument('--bundle_store_codec', type=str, default='none', choices=['none', 'zstd'],
+                        help='compression of the bundle store shards')
+    parser.add_argument('--dry_run', '--dry-run', action='store_true',
+                        help='only estimate the llm requests, input tokens and wall time, written to <output_path>/dry_run_report.jsonl')
+    parser.add_argument('--dry_run_request_seconds', type=float, default=10,
+                        help='seconds per llm request for the dry run when no earlier statistic.json measured them')
+    parser.add_argument('--statistic_interval', type=int, default=60,
+                        help='seconds between snapshots of statistic.json while repositories are running')
     return parser.parse_args()
 
 
@@ -777,23 +1254,60 @@ if __name__ == "__main__":
         'model_tokens': 0,
         'failed_components': []
     }
-    lock = Lock()
+    statistic_path = os.path.join(output_path, 'statistic.json')
     # init statistics with existing data in file
-    if os.path.exists(os.path.join(output_path, 'statistic.json')):
-        with open(os.path.join(output_path, 'statistic.json'), 'r') as f:
+    if os.path.exists(statistic_path):
+        with open(statistic_path, 'r') as f:
             statistic = json.load(f)
 
     util = Util()
     repo_paths = util.get_repos(repo_path)
     print(f'found {len(repo_paths)} repos to process.')
-    statistic['total_repos'] += len(repo_paths)
 
-    process_repositories_in_batches(
+    if args.bundle_store and not args.dry_run:
+        # fail here rather than in every worker when the codec is unavailable
+        BundleStoreWriter(args.bundle_store, codec=args.bundle_store_codec).close()
+
+    llm_cache_path = ''
+    if args.llm_cache_size_mb > 0:
+        llm_cache_path = args.llm_cache_path or os.path.join(
+            output_path, 'llm_cache.sqlite')
+    config = RepoWorkerConfig(
         base_path=base_dir,
-        repo_paths=repo_paths,
         output_path=output_path,
-        max_workers=threads,
-        lock=lock,
-        statistic=statistic)
+        parser_daemons=args.parser_daemons,
+        llm_cache_path=llm_cache_path,
+        llm_cache_size_bytes=args.llm_cache_size_mb * 1024 * 1024,
+        component_concurrency=args.component_concurrency,
+        bundle_store_path=args.bundle_store,
+        bundle_store_codec=args.bundle_store_codec)
+
+    if args.dry_run:
+        estimate_repositories(
+            repo_paths=repo_paths,
+            max_workers=threads,
+            config=config,
+            request_seconds=load_request_seconds(
+                statistic_path, args.dry_run_request_seconds),
+            report_path=os.path.join(output_path, 'dry_run_report.jsonl'))
+    else:
+        statistic['total_repos'] += len(repo_paths)
+        process_repositories(
+            repo_paths=repo_paths,
+            max_workers=threads,
+            statistic=statistic,
+            config=config,
+            repo_timeout=args.repo_timeout,
+            largest_first=args.largest_first,
+            statistic_path=statistic_path,
+            statistic_interval=args.statistic_interval)
+
+        if llm_cache_path:
+            llm_cache = LLMResponseCache(
+                llm_cache_path, max_size_bytes=config.llm_cache_size_bytes)
+            statistic.update(llm_cache.statistics())
+            llm_cache.close()
+
+        write_statistic_snapshot(statistic_path, statistic)
 
     print('done')
@@ -0,0 +1,191 @@
+import json
+import os
+import queue
+import subprocess
+import threading
+from threading import Lock
+
+
+class ImportParserError(Exception):
+    pass
+
+
+def parse_imports_subprocess(base_path, file_path):
+    # one-shot `node js_parser.js <file>`, used when no daemon is available
+    try:
+        result = subprocess.run(
+            ['node', os.path.join(base_path, 'js_parser.js'), file_path], capture_output=True, text=True)
+        if result.stderr:
+            print(f"Error running Node.js script: {result.stderr}")
+            return []
+        if result.stdout:
+            return json.loads(result.stdout)
+        else:
+            print("No output received from Node.js script.")
+            return []
+    except Exception as e:
+        print(f"Failed to extract imports: {e}")
+        return []
+
+
+class ImportParserDaemon():
+    """A single `node js_parser_server.js` process speaking JSON lines over stdin/stdout."""
+
+    def __init__(self, base_path, timeout=60):
+        self._base_path = base_path
+        self._timeout = timeout
+        self._process = None
+        self._responses = None
+        self._request_id = 0
+
+    def start(self):
+        self._process = subprocess.Popen(
+            ['node', os.path.join(self._base_path, 'js_parser_server.js')],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            text=True,
+            encoding='utf-8',
+            bufsize=1)
+        self._responses = queue.Queue()
+        reader = threading.Thread(
+            target=self._read_responses, args=(self._process.stdout, self._responses), daemon=True)
+        reader.start()
+
+    def _read_responses(self, stdout, responses):
+        for line in stdout:
+            responses.put(line)
+        # EOF, the process is gone
+        responses.put(None)
+
+    def is_alive(self):
+        return self._process is not None and self._process.poll() is None
+
+    def parse(self, file_paths):
+        if not self.is_alive():
+            raise ImportParserError('import parser daemon is not running')
+
+        self._request_id += 1
+        request_id = self._request_id
+        try:
+            self._process.stdin.write(json.dumps(
+                {'id': request_id, 'files': list(file_paths)}) + '\n')
+            self._process.stdin.flush()
+        except (BrokenPipeError, OSError, ValueError) as e:
+            raise ImportParserError(f'failed to send request: {e}')
+
+        try:
+            line = self._responses.get(timeout=self._timeout)
+        except queue.Empty:
+            self.close()
+            raise ImportParserError(
+                f'no response within {self._timeout}s, daemon killed')
+        if line is None:
+            raise ImportParserError('import parser daemon exited')
+
+        try:
+            response = json.loads(line)
+        except ValueError:
+            # e.g. a console.log of a dependency on stdout, the stream is out of step with our requests
+            self.close()
+            raise ImportParserError(
+                f'invalid response line {line[:200]!r}, daemon killed')
+        if not isinstance(response, dict) or response.get('id') != request_id:
+            self.close()
+            raise ImportParserError(
+                f'out of order response {response.get("id") if isinstance(response, dict) else response} for request {request_id}')
+
+        for file_path, error in response.get('errors', {}).items():
+            print(f"Error running Node.js script: {error}")
+        results = response.get('results', {})
+        return {file_path: results.get(file_path, []) for file_path in file_paths}
+
+    def close(self):
+        if self._process is None:
+            return
+        try:
+            self._process.stdin.close()
+        except Exception:
+            pass
+        try:
+            self._process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self._process.kill()
+            self._process.wait()
+        self._process = None
+
+
+class ImportParserPool():
+    """
+    A pool of warm import parser daemons shared by all Distiller instances.
+    Requests are split into batches of `batch_size` files, each batch is served by
+    one idle daemon. A daemon that dies is restarted up to `max_restarts` times in
+    total; after that, or while a restart fails, files are parsed with the per-file
+    `node js_parser.js` subprocess.
+    """
+
+    def __init__(self, base_path, size=4, batch_size=64, timeout=60, max_restarts=10):
+        self._base_path = base_path
+        self._batch_size = batch_size
+        self._timeout = timeout
+        self._restarts_left = max_restarts
+        self._lock = Lock()
+        self._idle = queue.Queue()
+        self._daemons = []
+        for _ in range(size):
+            daemon = ImportParserDaemon(base_path, timeout)
+            try:
+                daemon.start()
+            except OSError as e:
+                print(f"Failed to start import parser daemon: {e}")
+                continue
+            self._daemons.append(daemon)
+            self._idle.put(daemon)
+        print(f"Started {len(self._daemons)}/{size} import parser daemons.")
+
+    def _restart(self, daemon):
+        with self._lock:
+            if self._restarts_left <= 0:
+                return False
+            self._restarts_left -= 1
+        daemon.close()
+        try:
+            daemon.start()
+            return True
+        except OSError as e:
+            print(f"Failed to restart import parser daemon: {e}")
+            return False
+
+    def _parse_batch(self, file_paths):
+        if not self._daemons:
+            return None
+        daemon = self._idle.get()
+        try:
+            if not daemon.is_alive() and not self._restart(daemon):
+                return None
+            try:
+                return daemon.parse(file_paths)
+            except ImportParserError as e:
+                print(f"Import parser daemon failed: {e}")
+                self._restart(daemon)
+                return None
+        finally:
+            self._idle.put(daemon)
+
+    def parse_many(self, file_paths):
+        file_paths = list(file_paths)
+        imports = {}
+        for i in range(0, len(file_paths), self._batch_size):
+            batch = file_paths[i:i + self._batch_size]
+            result = self._parse_batch(batch)
+            if result is None:
+                result = {file_path: parse_imports_subprocess(self._base_path, file_path)
+                          for file_path in batch}
+            imports.update(result)
+        return imports
+
+    def parse(self, file_path):
+        return self.parse_many([file_path])[file_path]
+
+    def close(self):
+        for daemon in self._daemons:
+            daemon.close()
@@ -0,0 +1,151 @@
+import json
+import os
+import re
+
+
+# probing order of extensionless imports, the same order bundlers try them in
+PROBE_EXTENSIONS = ('.js', '.jsx', '.ts', '.tsx')
+
+
+def load_jsonc(path):
+    # tsconfig/jsconfig allow comments and trailing commas
+    with open(path, 'r', encoding='utf-8') as f:
+        content = f.read()
+    content = re.sub(r'"(?:\\.|[^"\\])*"|//[^\n]*|/\*.*?\*/',
+                     lambda match: match.group(0) if match.group(0).startswith('"') else '',
+                     content, flags=re.DOTALL)
+    content = re.sub(r',(\s*[}\]])', r'\1', content)
+    return json.loads(content)
+
+
+class PathAliasConfig():
+    """`compilerOptions.baseUrl`/`paths` of one tsconfig.json or jsconfig.json, following relative `extends`."""
+
+    def __init__(self, config_path):
+        self.base_url = None
+        self.paths_base = os.path.dirname(config_path)
+        self.paths = {}
+        self._load(config_path, set())
+
+    def _load(self, config_path, seen):
+        if config_path in seen or not os.path.exists(config_path):
+            return
+        seen.add(config_path)
+        try:
+            config = load_jsonc(config_path)
+        except (OSError, ValueError) as e:
+            print(f"Error reading {config_path}: {e}")
+            return
+
+        # the extended config is loaded first so this one overrides it
+        extends = config.get('extends')
+        if isinstance(extends, str) and extends.startswith('.'):
+            if not extends.endswith('.json'):
+                extends += '.json'
+            self._load(os.path.normpath(os.path.join(
+                os.path.dirname(config_path), extends)), seen)
+
+        compiler_options = config.get('compilerOptions') or {}
+        config_dir = os.path.dirname(config_path)
+        if isinstance(compiler_options.get('baseUrl'), str):
+            self.base_url = os.path.normpath(
+                os.path.join(config_dir, compiler_options['baseUrl']))
+            self.paths_base = self.base_url
+        if isinstance(compiler_options.get('paths'), dict):
+            self.paths = compiler_options['paths']
+            if self.base_url is None:
+                self.paths_base = config_dir
+
+    def candidates(self, module_name):
+        # exact pattern first, then the wildcard pattern with the longest prefix, then baseUrl
+        candidates = []
+        if module_name in self.paths:
+            candidates += [os.path.join(self.paths_base, target)
+                           for target in self.paths[module_name]]
+        best_prefix = None
+        for pattern in self.paths:
+            if pattern.count('*') != 1:
+                continue
+            prefix, suffix = pattern.split('*')
+            if module_name.startswith(prefix) and module_name.endswith(suffix) \
+                    and len(module_name) >= len(prefix) + len(suffix) \
+                    and (best_prefix is None or len(prefix) > len(best_prefix[0])):
+                best_prefix = (prefix, suffix, pattern)
+        if best_prefix:
+            prefix, suffix, pattern = best_prefix
+            matched = module_name[len(prefix):len(module_name) - len(suffix)]
+            candidates += [os.path.join(self.paths_base, target.replace('*', matched))
+                           for target in self.paths[pattern] if isinstance(target, str)]
+        if self.base_url:
+            candidates.append(os.path.join(self.base_url, module_name))
+        return [os.path.normpath(candidate) for candidate in candidates]
+
+
+class ImportResolver():
+    """
+    Resolves import specifiers against the files of a RepoIndex. Extensionless imports are
+    probed with PROBE_EXTENSIONS and as `dir/index.*`, each probe being a set lookup.
+    Bare specifiers are resolved through the `baseUrl`/`paths` of the nearest
+    tsconfig.json or jsconfig.json and left alone (as packages) when nothing matches.
+    """
+
+    def __init__(self, repo_index):
+        self._repo_index = repo_index
+        self._configs = None
+        self._config_by_dir = {}
+
+    def _load_configs(self):
+        configs = {}
+        for config_path in self._repo_index.config_files():
+            config_dir = os.path.dirname(config_path)
+            # tsconfig.json wins over jsconfig.json in the same folder
+            if config_dir in configs and os.path.basename(config_path) == 'jsconfig.json':
+                continue
+            configs[config_dir] = PathAliasConfig(config_path)
+        self._configs = configs
+
+    def _nearest_config(self, file_path):
+        if self._configs is None:
+            self._load_configs()
+        directory = os.path.dirname(file_path)
+        if directory in self._config_by_dir:
+            return self._config_by_dir[directory]
+        config = None
+        current = directory
+        while True:
+            if current in self._configs:
+                config = self._configs[current]
+                break
+            if current == self._repo_index.repo_path or os.path.dirname(current) == current:
+                break
+            current = os.path.dirname(current)
+        self._config_by_dir[directory] = config
+        return config
+
+    def probe(self, base_path):
+        if base_path in self._repo_index:
+            return base_path
+        for ext in PROBE_EXTENSIONS:
+            if base_path + ext in self._repo_index:
+                return base_path + ext
+        for ext in PROBE_EXTENSIONS:
+            index_path = os.path.join(base_path, 'index' + ext)
+            if index_path in self._repo_index:
+                return index_path
+        return None
+
+    def resolve(self, current_file_path, module_name):
+        """Path of the imported repo file, or None if it is not a (known) local file."""
+        if module_name.startswith('.'):
+            return self.probe(os.path.normpath(os.path.join(
+                os.path.dirname(current_file_path), module_name)))
+        if module_name.startswith('/'):
+            return None
+        config = self._nearest_config(current_file_path)
+        if config is None:
+            return None
+        for candidate in config.candidates(module_name):
+            resolved = self.probe(candidate)
+            if resolved:
+                return resolved
+        return None
@@ -0,0 +1,62 @@
+// parseImportsServer.js
+// Long-lived variant of js_parser.js: keeps @babel/parser loaded and answers
+// JSON-lines requests on stdin, one response line per request on stdout.
+//
+// request:  {"id": 1, "files": ["/abs/a.js", "/abs/b.tsx"]}
+// response: {"id": 1, "results": {"/abs/a.js": [...], "/abs/b.tsx": [...]}, "errors": {}}
+const fs = require('fs');
+const readline = require('readline');
+const parser = require('@babel/parser');
+
+const PARSER_OPTIONS = {
+  sourceType: 'module',
+  plugins: ['jsx', 'typescript', ['decorators', { decoratorsBeforeExport: true }]]
+};
+
+function extractImports(filePath) {
+  const code = fs.readFileSync(filePath, 'utf8');
+  const ast = parser.parse(code, PARSER_OPTIONS);
+
+  // only the fields the python side reads are sent back, full AST nodes
+  // carry location info that dominates the payload size
+  return ast.program.body
+    .filter(node => node.type === 'ImportDeclaration')
+    .map(node => ({
+      type: node.type,
+      importKind: node.importKind,
+      source: { value: node.source.value },
+      specifiers: node.specifiers.map(spec => ({
+        type: spec.type,
+        local: spec.local ? { name: spec.local.name } : null
+      }))
+    }));
+}
+
+function handleRequest(line) {
+  let request;
+  try {
+    request = JSON.parse(line);
+  } catch (error) {
+    return { id: null, results: {}, errors: { '': `Invalid request: ${error}` } };
+  }
+
+  const results = {};
+  const errors = {};
+  for (const filePath of request.files || []) {
+    try {
+      results[filePath] = extractImports(filePath);
+    } catch (error) {
+      errors[filePath] = `Error parsing file: ${filePath}, ${error}`;
+    }
+  }
+  return { id: request.id, results, errors };
+}
+
+const rl = readline.createInterface({ input: process.stdin, crlfDelay: Infinity });
+rl.on('line', line => {
+  if (!line.trim()) {
+    return;
+  }
+  process.stdout.write(JSON.stringify(handleRequest(line)) + '\n');
+});
+rl.on('close', () => process.exit(0));
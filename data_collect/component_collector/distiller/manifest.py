@@ -0,0 +1,93 @@
+import hashlib
+import json
+import os
+from threading import Lock
+
+# records between two saves, the rest is saved once the repo is done
+MANIFEST_SAVE_EVERY = 50
+
+
+class BundleManifest():
+    """
+    Records, for every bundled component of a repo, the content hash of each file the
+    bundle was built from. Paths are stored relative to the repo so a moved workspace
+    keeps its manifest.
+
+    The manifest lives next to the repo output folder (`<output>/<repo>.manifest`)
+    because downstream stages treat every file inside that folder as a bundle.
+
+    `record` only updates memory, the file is rewritten every `save_every` records and by
+    `save` at the end of the repo. A crash loses at most those records; their bundles have
+    no entry in the next run and are distilled again, because bundles without an entry are
+    only adopted as up to date (`adopts_unrecorded`) for repos that had no manifest at all,
+    i.e. were bundled before manifests were kept. The manifest file is created when it is
+    opened, so a crash before the first save does not pass for such a repo.
+    """
+
+    def __init__(self, path, repo_path, save_every=MANIFEST_SAVE_EVERY):
+        self._path = path
+        self._repo_path = repo_path
+        self._save_every = save_every
+        self._lock = Lock()
+        # one writer of the file at a time
+        self._save_lock = Lock()
+        self._entries = {}
+        self._unsaved = 0
+        self.adopts_unrecorded = not os.path.exists(path)
+        if self.adopts_unrecorded:
+            self._write({})
+        else:
+            try:
+                with open(path, 'r') as f:
+                    self._entries = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"Ignoring unreadable manifest {path}: {e}")
+
+    def _key(self, file_path):
+        return os.path.relpath(file_path, self._repo_path)
+
+    def relative_hashes(self, input_hashes):
+        return {self._key(file_path): file_hash for file_path, file_hash in input_hashes.items()}
+
+    def get(self, component_path):
+        with self._lock:
+            return self._entries.get(self._key(component_path))
+
+    def inputs_digest(self, component_path):
+        # a single hash over everything a component's bundle was built from,
+        # used by parents that reuse this bundle
+        entry = self.get(component_path)
+        if entry is None:
+            return None
+        return hashlib.sha1(json.dumps(entry['inputs'], sort_keys=True).encode('utf-8')).hexdigest()
+
+    def is_up_to_date(self, component_path, input_hashes):
+        entry = self.get(component_path)
+        return entry is not None and entry['inputs'] == self.relative_hashes(input_hashes)
+
+    def record(self, component_path, output_path, input_hashes):
+        with self._lock:
+            self._entries[self._key(component_path)] = {
+                'output': os.path.basename(output_path),
+                'inputs': self.relative_hashes(input_hashes),
+            }
+            self._unsaved += 1
+            due = self._unsaved >= self._save_every
+        if due:
+            self.save()
+
+    def save(self):
+        with self._save_lock:
+            with self._lock:
+                if not self._unsaved:
+                    return
+                entries = dict(self._entries)
+                self._unsaved = 0
+            self._write(entries)
+
+    def _write(self, entries):
+        # write to a temp file and rename, a crash never leaves a truncated manifest
+        tmp_path = self._path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(entries, f, indent=4, sort_keys=True)
+        os.replace(tmp_path, self._path)
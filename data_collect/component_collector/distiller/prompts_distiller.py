@@ -0,0 +1,19 @@
+########################### distiller prompts ###########################
+
+# react identification, the file content is appended
+REACT_IDENTIFICATION_PROMPT = 'You will be given a code snippet. You need to check if it is implemented with React or not. You need to return a boolean value, true if it is a React component, false otherwise. For example, if the component is defined as follows: function MyComponent() { return <div>test</div>; }, then the output should be: true. REPLY WITH the boolean value only, no explanations, comments, or any other text needed. Here is the code snippet: '
+
+# css filtering
+FILTER_CSS_EXAMPLE_COMPONENT_CODE = 'function MyComponent() { return <div class="comp">comp test</div>; }'
+FILTER_CSS_EXAMPLE_INPUT_CSS = 'html {font-size: 16px;} \n img { width: 100px } \n .comp { color: red; } \n .footer { color: green }'
+FILTER_CSS_EXAMPLE_OUTPUT_CSS = 'html {font-size: 16px;} \n .comp { color: red; }'
+FILTER_CSS_PROMPT = 'You will be given a self-contained React component code snippet and a CSS code snippet. You need to check the CSS code snippet and see if it could affect React component code snippet (according to the selector mechanism of CSS, for example style specification by tag name, id, class name, or even more complecated selection sepecification). You need to return a CSS code snippet that contains only the CSS properties that could affect the provided React component code snippet in rendering. For example, if the React component code snippet is defined as follows: \n{example_component_code}\n, and the CSS code snippet is defined as follows: \n{example_input_css}\n, then the output should be: \n{example_output_css}\n. REPLY WITH the filtered CSS code snippet only, no explanations, no comments, no qoutes wrapping the result code, no labels, and no any other text needed. Here is the React component code snippet: \n{component_code}\n\n and here is the CSS code snippet: \n{raw_style}\n\n, the filtered CSS code snippet should be:\n'
+
+# mock inputs, 1st round to locate the input parameters (the code is appended), 2nd round to create them
+MOCK_INPUT_PARAMS_PROMPT = 'You will be given a self-contained React component code snippet. You need to check all the components and see if they have any input parameters. you need to return a json object with the component name as the key and the value as a list of input parameters. If the component does not have any input parameters, the value should be an empty list. For example, if the component is defined as follows: function MyComponent(props) { return <div>{props.name}</div>; } The output should be: { "MyComponent": ["name"] }, REPLY WITH this json object only, no explanations, no comments, and no any other text needed. Here is the code snippet: '
+MOCK_INPUT_VALUES_PROMPT = 'Generate the necessary mock inputs for this React component based on the input parameters identified in the previous step. For each expected parameter, create appropriate mock data. If the parameter is a function, provide a function with the correct number of arguments and an empty body; for functions without parameters, use an empty function. For example, given the component definition function MyComponent(props) { return <div>{props.name}</div>; } and the parameters { "MyComponent": ["name"] }, the mock input should be { "name": "John" }. Update the component to use this mock input as its default, like so: function MyComponent(props = { "name": "John" }) { return <div>{props.name}</div>; }. Modify the original code minimally to incorporate these mock inputs, and do not change or ommit any part of the code if it is not related to incorporating the mock inputs. The response should include only the modified component code, without additional text, comments, or explanations.'
+
+# code review (the code is appended) and bug fixing
+DEBUG_CODE_SYSTEM_PROMPT = 'We are conducting a static code review to ensure that a React component and all its sub-components are self-contained and error-free. This will involve checking if the default exported component can function independently by importing it without any additional local dependencies (third-party dependencies not included), ensuring all sub-components are also error-free. The review will proceed in two rounds: an initial evaluation followed by bug fixing if necessary.'
+DEBUG_CODE_REVIEW_PROMPT = 'Please assess the provided React component code, which includes the main component and its sub-components. Determine if the default exported component, including any third-party library imports, can be rendered as self-contained and without errors. Reply with "Yes" if there are no issues. If you find any problems, respond with "No" first and then describe the issues along with possible solutions. Here is the code snippet: \n'
+DEBUG_CODE_FIX_PROMPT = 'Please provide the entire corrected code for the default exported component and its sub-components, ensuring all parts are now self-contained and error-free. When addressing any missing elements, directly add the exact necessary content (e.g., defining missing variables or functions) within the code itself, instead of just including import statements. Change the code as less as possible to fix the errors, do not change or ommit any code that is not related to fixing the errors, Meanwhile the "default" export statement needs to be kept. Include both the revised and the error-free sections of the code to ensure the complete component is functional. REPLY ONLY WITH the complete code, no explanations, no labels, no qoutes wrapping the result code, no comments, and no any other text needed.'
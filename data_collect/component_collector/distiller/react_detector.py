@@ -0,0 +1,58 @@
+import re
+
+
+# Minified bundles are not component sources, and scanning them dominates detection time
+MINIFIED_SIZE_LIMIT = 512 * 1024
+MINIFIED_LINE_LENGTH = 1000
+
+# `<\w+` matches almost every React file, so it is tried on its own before anything else.
+# The former JSX patterns `<\w+[^>]*>`, `<\w+.*?>.*?<\/\w+>` and `<\w+\s*\/>` can only match where
+# `<\w+` matches too, so they are dropped: they never changed the result but could backtrack
+# quadratically over minified files.
+JSX_TAG_START = re.compile(r'<\w+')
+
+# Everything else is tried in order, each pattern guarded by a literal it cannot match without.
+# `literal in content` is a C-speed substring scan, and a single alternation of these patterns
+# measured ~4x slower than guarded individual searches because it loses re's literal-prefix scan.
+REACT_PATTERNS = [
+    # Class components
+    ('extends', r'class\s+\w+\s+extends\s+(?:React\.Component|Component)\b'),
+    ('React', r'import\s+React\b'),  # Import React statement
+    # Import specific from React (destructuring)
+    ('react', r'import\s+\{[^}]*\}\s+from\s+[\'"]react[\'"]'),
+    ('React.createElement', r'React\.createElement\b'),  # Explicit React createElement usage
+    # Function component (capitalized functions)
+    ('function', r'function\s+[A-Z]\w*\s*\('),
+    # Arrow function components with explicit return
+    ('=>', r'const\s+[A-Z]\w*\s*=\s*\([^)]*\)\s*=>'),
+    # Return in a function that likely returns JSX
+    ('return', r'return\s*\([^\)]'),
+    # File extensions for React components (optional heuristic)
+    ('.jsx', r'\.jsx\b'),
+    ('.tsx', r'\.tsx\b'),
+    ('/>', r'\/>\s*$'),  # Closing JSX tag check at the end of the line
+    # Hooks usage
+    ('use', r'(?:useState|useEffect|useContext|useReducer|useMemo|useCallback)\('),
+    ('PropTypes', r'\bPropTypes\b'),  # Usage of PropTypes
+    ('</', r'<\/\w+>'),  # JSX closing tag
+    # Using Material-UI (common in React projects)
+    ('@material-ui/core', r'from\s+[\'"]@material-ui/core'),
+]
+COMPILED_REACT_PATTERNS = [(literal, re.compile(pattern, re.MULTILINE))
+                           for literal, pattern in REACT_PATTERNS]
+
+
+def is_minified_bundle(content):
+    if len(content) <= MINIFIED_SIZE_LIMIT:
+        return False
+    lines = content.count('\n') + 1
+    return len(content) / lines > MINIFIED_LINE_LENGTH
+
+
+def is_react_source(content):
+    if not content or is_minified_bundle(content):
+        return False
+    if JSX_TAG_START.search(content):
+        return True
+    return any(literal in content and pattern.search(content)
+               for literal, pattern in COMPILED_REACT_PATTERNS)
@@ -0,0 +1,144 @@
+import hashlib
+import os
+from threading import Lock
+
+
+SCRIPT_EXTENSIONS = ('.js', '.jsx', '.ts', '.tsx')
+STYLE_EXTENSIONS = ('.css', '.scss', '.sass', '.less', '.styl')
+INDEXED_EXTENSIONS = SCRIPT_EXTENSIONS + STYLE_EXTENSIONS
+# path alias configs picked up by the walk for the import resolver
+CONFIG_FILENAMES = ('tsconfig.json', 'jsconfig.json')
+
+
+class IndexedFile():
+    __slots__ = ('path', 'ext', 'size', 'mtime', 'in_node_modules',
+                 'content_hash', 'content', 'imports', 'is_react')
+
+    def __init__(self, path, ext, size, mtime, in_node_modules):
+        self.path = path
+        self.ext = ext
+        self.size = size
+        self.mtime = mtime
+        self.in_node_modules = in_node_modules
+        self.content_hash = None
+        self.content = None
+        self.imports = None
+        self.is_react = None
+
+
+class RepoIndex():
+    """
+    One walk over a repository shared by every Distiller stage.
+    Each script/style file is stat'ed once; its content, content hash, parsed imports
+    and rule-based React verdict are filled in lazily the first time a stage asks for
+    them and kept until `release_contents` is called (the verdict survives it).
+    """
+
+    def __init__(self, repo_path):
+        self._repo_path = os.path.normpath(repo_path)
+        self._files = None
+        self._config_files = None
+        self._lock = Lock()
+
+    @property
+    def repo_path(self):
+        return self._repo_path
+
+    def is_built(self):
+        return self._files is not None
+
+    def build(self):
+        files = {}
+        config_files = []
+        for root, dirs, filenames in os.walk(self._repo_path):
+            in_node_modules = 'node_modules' in root
+            for filename in filenames:
+                if filename in CONFIG_FILENAMES and not in_node_modules:
+                    config_files.append(os.path.join(root, filename))
+                    continue
+                ext = os.path.splitext(filename)[1]
+                if ext not in INDEXED_EXTENSIONS:
+                    continue
+                path = os.path.join(root, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files[path] = IndexedFile(
+                    path, ext, stat.st_size, stat.st_mtime, in_node_modules)
+        self._files = files
+        self._config_files = config_files
+        return self
+
+    def _ensure_built(self):
+        if self._files is None:
+            self.build()
+
+    def __contains__(self, path):
+        self._ensure_built()
+        return path in self._files
+
+    def get(self, path):
+        self._ensure_built()
+        return self._files.get(path)
+
+    def files(self, extensions=INDEXED_EXTENSIONS, include_node_modules=True):
+        # walk order is kept so downstream stages see files in the same order as os.walk
+        self._ensure_built()
+        return [entry.path for entry in self._files.values()
+                if entry.ext in extensions and (include_node_modules or not entry.in_node_modules)]
+
+    def config_files(self):
+        self._ensure_built()
+        return list(self._config_files)
+
+    def read(self, path):
+        """Content of an indexed file, read from disk at most once. Non-indexed paths are read directly."""
+        entry = self.get(path)
+        if entry is None:
+            with open(path, 'r', encoding='utf-8') as f:
+                return f.read()
+        if entry.content is None:
+            with open(path, 'rb') as f:
+                raw = f.read()
+            content = raw.decode('utf-8')
+            with self._lock:
+                entry.content_hash = hashlib.sha1(raw).hexdigest()
+                entry.content = content
+        return entry.content
+
+    def content_hash(self, path):
+        entry = self.get(path)
+        if entry is None:
+            return None
+        if entry.content_hash is None:
+            try:
+                self.read(path)
+            except (OSError, ValueError):
+                return None
+        return entry.content_hash
+
+    def cached_imports(self, path):
+        entry = self.get(path)
+        return entry.imports if entry is not None else None
+
+    def set_imports(self, path, imports):
+        entry = self.get(path)
+        if entry is not None:
+            entry.imports = imports
+
+    def cached_is_react(self, path):
+        entry = self.get(path)
+        return entry.is_react if entry is not None else None
+
+    def set_is_react(self, path, is_react):
+        entry = self.get(path)
+        if entry is not None:
+            entry.is_react = is_react
+
+    def release_contents(self):
+        # keep metadata, hashes, imports and React verdicts; drop file contents to bound memory
+        self._ensure_built()
+        with self._lock:
+            for entry in self._files.values():
+                entry.content = None
@@ -0,0 +1,146 @@
+import json
+import math
+import os
+import threading
+from threading import Lock
+
+
+def bucket_of(value):
+    # exponential buckets: the upper bound is the next power of two (values <= 0 share bucket 0)
+    if value <= 0:
+        return 0
+    return 2 ** math.ceil(math.log2(value))
+
+
+def new_histogram():
+    return {'count': 0, 'sum': 0, 'min': None, 'max': None, 'buckets': {}}
+
+
+def merge_histogram(target, source):
+    target['count'] += source['count']
+    target['sum'] += source['sum']
+    for key, pick in (('min', min), ('max', max)):
+        if source[key] is not None:
+            target[key] = source[key] if target[key] is None else pick(
+                target[key], source[key])
+    for bucket, count in source['buckets'].items():
+        # json turns the bucket bounds into strings
+        bucket = str(bucket)
+        target['buckets'][bucket] = target['buckets'].get(bucket, 0) + count
+
+
+def histogram_percentile(histogram, percentile):
+    # upper bound of the bucket holding the percentile, exact enough for latency/token reports
+    if not histogram['count']:
+        return None
+    rank = percentile / 100 * histogram['count']
+    seen = 0
+    for bucket in sorted(histogram['buckets'], key=float):
+        seen += histogram['buckets'][bucket]
+        if seen >= rank:
+            return min(float(bucket), histogram['max'])
+    return histogram['max']
+
+
+def merge_snapshot(statistic, snapshot):
+    """
+    Merge a snapshot into a statistic.json style dict: numbers are added, lists
+    extended, and histograms (kept under 'histograms') merged bucket by bucket.
+    """
+    for key, value in snapshot.items():
+        if key == 'histograms':
+            histograms = statistic.setdefault('histograms', {})
+            for name, histogram in value.items():
+                merge_histogram(histograms.setdefault(
+                    name, new_histogram()), histogram)
+        elif key not in statistic:
+            statistic[key] = list(value) if isinstance(
+                value, list) else value
+        elif isinstance(statistic[key], list):
+            if isinstance(value, list):
+                statistic[key].extend(value)
+            else:
+                statistic[key].append(value)
+        elif isinstance(statistic[key], (int, float)):
+            statistic[key] += value
+
+
+class StatsShard():
+    __slots__ = ('counters', 'lists', 'histograms')
+
+    def __init__(self):
+        self.counters = {}
+        self.lists = {}
+        self.histograms = {}
+
+
+class StatsCollector():
+    """
+    Counters, lists and histograms written without locks: every thread updates its own
+    shard, and `snapshot` merges the shards on demand. A snapshot is a plain dict, so
+    worker processes send theirs to the parent, which folds them in with `merge`.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._shards = []
+        self._merged = {}
+        self._register_lock = Lock()
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = StatsShard()
+            # taken once per thread, never on the update path
+            with self._register_lock:
+                self._shards.append(shard)
+            self._local.shard = shard
+        return shard
+
+    def incr(self, key, value=1):
+        counters = self._shard().counters
+        counters[key] = counters.get(key, 0) + value
+
+    def append(self, key, value):
+        self._shard().lists.setdefault(key, []).append(value)
+
+    def observe(self, name, value):
+        histograms = self._shard().histograms
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = histograms[name] = new_histogram()
+        histogram['count'] += 1
+        histogram['sum'] += value
+        histogram['min'] = value if histogram['min'] is None else min(
+            histogram['min'], value)
+        histogram['max'] = value if histogram['max'] is None else max(
+            histogram['max'], value)
+        bucket = bucket_of(value)
+        histogram['buckets'][bucket] = histogram['buckets'].get(bucket, 0) + 1
+
+    def merge(self, snapshot):
+        with self._register_lock:
+            merge_snapshot(self._merged, snapshot)
+
+    def snapshot(self):
+        # list() copies are taken while holding the GIL, so owners may keep writing
+        with self._register_lock:
+            shards = list(self._shards)
+            result = {}
+            merge_snapshot(result, self._merged)
+        for shard in shards:
+            merge_snapshot(result, dict(list(shard.counters.items())))
+            merge_snapshot(result, {key: list(values)
+                                    for key, values in list(shard.lists.items())})
+            merge_snapshot(result, {'histograms': {
+                name: dict(histogram, buckets=dict(list(histogram['buckets'].items())))
+                for name, histogram in list(shard.histograms.items())}})
+        return result
+
+
+def write_statistic_snapshot(path, statistic):
+    # temp file + rename, readers never see a half written statistic.json
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(statistic, f, indent=4)
+    os.replace(tmp_path, path)
@@ -8,8 +8,11 @@ import time
 from collections import defaultdict, deque
 
 from tqdm import tqdm
+from utils.bundle_store import BundleStore
 from data_collect.component_collector.variater.variation_waterfall_types import GenCodeParams, ProjectInfo, EvolCodeParams, StageNPipelineParams, StageOnePipelineParams
-from utils.llm import llm_chat, MAX_LENGTH_EXCEEDED_ERROR, SUCCESS_CODE
+from utils.llm import chat, llm_chat
+from utils.llm_budget import BUDGET_HARD, BUDGET_SOFT
+from utils.llm_metrics import llm_labels
 import re
 import subprocess
 
@@ -51,8 +54,11 @@ def kill_variations():
 
 
 class ComponentVariation:
-    def __init__(self, assistant):
+    def __init__(self, assistant, bundle_store=None):
         self._assistant = assistant
+        self._bundle_store = bundle_store
+        # repo of the component being evolved, the token budget of each repo is capped separately
+        self._repo = None
 
     def postprocess_code_response(self, content):
         if not content:
@@ -105,44 +111,8 @@ class ComponentVariation:
         return content
 
     def chat(self, prompt, temperature=0.1):
-        response = self._assistant.chat(prompt, temp=temperature)
-        if response['error_code'] != SUCCESS_CODE:
-            if response['error_code'] == MAX_LENGTH_EXCEEDED_ERROR:
-                print('TOO LONG, breaking...')
-                return None
-            print('Error in generating response, breaking...')
-            return None
-
-        result = response['content']
-
-        max_continue = 5
-        continue_count = 0
-        while True:
-            if response['output_token_len'] >= 4095:
-                chat_hist = [
-                    {'role': 'user', 'content': prompt},
-                    {'role': 'assistant', 'content': response['content']}
-                ]
-                response = self._assistant.chat(
-                    'continue', chat_hist, temperature)
-                print('--- current output len: ', response['output_token_len'])
-                if response['error_code'] != SUCCESS_CODE:
-                    if response['error_code'] == MAX_LENGTH_EXCEEDED_ERROR:
-                        print('TOO LONG, breaking...')
-                        return result
-                    print('Error in generating response, breaking...')
-                    return result
-                result += response['content']
-                print('--- current result: ', result)
-                continue_count += 1
-                if continue_count >= max_continue:
-                    print('--- done generate all')
-                    break
-            else:
-                print('--- done generate all')
-                break
-
-        return result
+        with llm_labels(repo=self._repo):
+            return chat(prompt, temperature, assistant=self._assistant, max_continue=5)
 
     def extract_repo_comp_names(self, screenshot_path):
         repo_comp_record = {}
@@ -174,28 +144,39 @@ class ComponentVariation:
         pattern = re.compile(rf'<{component_name}(?:\s+[^>]*)?\s*/?>')
         return bool(pattern.search(content))
 
+    def load_bundle(self, repo_path, comp):
+        # one seek in the bundle store when given, otherwise <repo_path>/<comp>_bundled.json
+        if self._bundle_store:
+            comp_data = self._bundle_store.get(
+                os.path.basename(repo_path), f'{comp}_bundled.json')
+            if comp_data is None:
+                print('---- comp not in bundle store:', repo_path, comp)
+            return comp_data
+
+        comp_path = os.path.join(repo_path, f'{comp}_bundled.json')
+        # check if the component path exists
+        if not os.path.exists(comp_path):
+            print('---- comp_path does not exist:', comp_path)
+            return None
+
+        # load json
+        with open(comp_path, 'r') as f:
+            return json.load(f)
+
     def load_comp_and_label_depth(self, repo_path, comps):
         print('')
         print('-- repo_path:', repo_path)
         comp_data_record = []
         graph = ComponentGraph()
         for comp in comps:
-            comp_path = os.path.join(repo_path, f'{comp}_bundled.json')
-            # print('---- comp_path:', comp_path)
-
-            # check if the component path exists
-            if not os.path.exists(comp_path):
-                print('---- comp_path does not exist:', comp_path)
+            comp_data = self.load_bundle(repo_path, comp)
+            if comp_data is None:
                 continue
-
-            # load json
-            with open(comp_path, 'r') as f:
-                comp_data = json.load(f)
-                comp_data['comp_name_in_file'] = comp
-                comp_code = comp_data['code_with_ori_img'] if 'code_with_ori_img' in comp_data else comp_data['debug_component']
-                comp_name = self.extract_comp_name(comp_code)
-                comp_data['export_comp_name'] = comp_name
-                comp_data_record.append(comp_data)
+            comp_data['comp_name_in_file'] = comp
+            comp_code = comp_data['code_with_ori_img'] if 'code_with_ori_img' in comp_data else comp_data['debug_component']
+            comp_name = self.extract_comp_name(comp_code)
+            comp_data['export_comp_name'] = comp_name
+            comp_data_record.append(comp_data)
 
         for comp_data in comp_data_record:
             comp_name = comp_data['export_comp_name']
@@ -223,6 +204,7 @@ class ComponentVariation:
         total_processed_comp_current_batch = 0
         for repo_comp in tqdm(repo_comp_list, desc='repo variation'):
             repo = repo_comp['repo']
+            self._repo = repo
             repo_path = os.path.join(repo_dir, repo)
 
             # create the repo folder in the variation output path and copy the package.json and pkg_candidate.json
@@ -264,6 +246,17 @@ class ComponentVariation:
 
                 infer_num = min(math.floor(
                     (len(comp_data['parents']) / max_depth) * max_system_infer) + 1, max_system_infer) if max_depth > 0 else 1
+                # fewer systems once the token budget runs low, none once it is used up
+                budget_status, budget_reason = self._assistant.budget_status(repo=repo)
+                if budget_status == BUDGET_HARD:
+                    if self._assistant.budget_status()[0] == BUDGET_HARD:
+                        print(f'stopping the variation, {budget_reason}')
+                        return
+                    print(f'skipping the rest of repo {repo}, {budget_reason}')
+                    break
+                if budget_status == BUDGET_SOFT and infer_num > 1:
+                    print(f'inferring 1 system instead of {infer_num}, {budget_reason}')
+                    infer_num = 1
                 evol_start_time = time.time()
                 self.evol_code(EvolCodeParams(
                     style=style,
@@ -351,13 +344,15 @@ class ComponentVariation:
                 current_implementation=current_code_snippet,
                 next_task_description=f'Task {task_idx + 1}: {task}'
             )
-            tmp_code_snippet = self.chat(tmp_prompt, 0.1)
+            with llm_labels(template='gen_code_snippet'):
+                tmp_code_snippet = self.chat(tmp_prompt, 0.1)
             if not tmp_code_snippet:
                 return None
 
             double_check_prompt = DOUBLE_CHECK_PROMPT.format(
                 code_snippet=tmp_code_snippet)
-            double_check_response = self.chat(double_check_prompt, 0.0)
+            with llm_labels(template='double_check'):
+                double_check_response = self.chat(double_check_prompt, 0.0)
             if not double_check_response:
                 return None
             if 'passed' in double_check_response.lower():
@@ -644,6 +639,8 @@ def parse_args():
     parser.add_argument('--screenshot_path', type=str)
     parser.add_argument('--repo_path', type=str)
     parser.add_argument('--variation_path', type=str)
+    parser.add_argument('--bundle_store', type=str, default='',
+                        help='read bundles from this bundle store instead of <repo_path>/<repo>/*_bundled.json')
     return parser.parse_args()
 
 
@@ -654,7 +651,8 @@ if __name__ == '__main__':
     variation_path = args.variation_path
 
     assistant = llm_chat
-    cv = ComponentVariation(assistant)
+    bundle_store = BundleStore(args.bundle_store) if args.bundle_store else None
+    cv = ComponentVariation(assistant, bundle_store)
     repo_comp_counts = cv.extract_repo_comp_names(screenshot_path)
     cv.fetch_repo_and_comp(
         repo_path, repo_comp_counts, variation_path, args.iter_num, args.max_system_infer)
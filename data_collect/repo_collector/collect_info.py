@@ -1,66 +1,214 @@
 import base64
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import collections
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 import json
+import math
 import os
 import subprocess
-import requests
-import time
 from datetime import datetime, timedelta
+from data_collect.repo_collector.github_api import GitHubClient, GitHubResponseCache
 from utils.llm import chat
+from utils.llm_metrics import llm_labels
 from tqdm import tqdm
 from dotenv import load_dotenv
 
 load_dotenv()
 
-
-def fetch_repos_by_day(**kwargs):
-    github_key = os.getenv('GITHUB_KEY')
-    url = 'https://api.github.com/search/repositories'
-    headers = {
-        'Accept': 'application/vnd.github.v3+json',
-        'Authorization': f'token {github_key}',
+GITHUB_TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+github_client = GitHubClient(os.getenv('GITHUB_KEY'))
+
+
+SEARCH_URL = '/search/repositories'
+# the search api returns at most this many results of a query
+SEARCH_RESULT_CAP = 1000
+# windows are sized for this share of the cap, a bit of room for an uneven density
+WINDOW_FILL = 0.5
+# window sizes in seconds, each divides the next. Windows start at a multiple of their size
+# (counted from the epoch), so crawls of overlapping date ranges query the same windows and
+# hit the response cache
+WINDOW_LADDER = [60, 300, 900, 1800, 3600, 10800, 21600, 43200, 86400] + \
+    [86400 * 2 ** i for i in range(1, 11)]
+MIN_WINDOW = timedelta(seconds=WINDOW_LADDER[0])
+EPOCH = datetime(1970, 1, 1)
+# times a failed search page is tried again, after the retries of the client
+SEARCH_PAGE_RETRIES = 3
+# repos whose package.json is looked up in one graphql query
+PACKAGE_JSON_BATCH = 50
+
+
+def search_query(window, **kwargs):
+    # created is inclusive at both ends, windows are [start, end)
+    start, end = window
+    created = f'{start.strftime(GITHUB_TIME_FORMAT)}..{(end - timedelta(seconds=1)).strftime(GITHUB_TIME_FORMAT)}'
+    return f'language:{kwargs.get("language")} created:{created} {kwargs.get("kw")} in:description,readme stars:>{kwargs.get("star")} NOT native in:name,description,readme NOT learn in:name,description,readme NOT tutorial in:name,description,readme NOT example in:name,description,readme NOT demo in:name,description,readme'
+
+
+def fetch_search_page(window, page, **kwargs):
+    # (total_count, repos) of a page of the window, None on error
+    params = {
+        'q': search_query(window, **kwargs),
+        'sort': 'stars',
+        'order': 'desc',
+        'per_page': kwargs.get("per_page"),
+        'page': page,
     }
+    response = github_client.get(SEARCH_URL, params=params)
+    if response is None or response.status_code != 200:
+        print(f"Error: {response.status_code if response is not None else 'no response'} for {params['q']}")
+        if response is not None:
+            print(response.text[:500])
+        return None
+    result = response.json()
+    if result.get('incomplete_results'):
+        print(f"Search timed out, results of {window[0]}..{window[1]} page {page} may be incomplete")
+    return result['total_count'], result['items']
+
+
+def aligned_window(start, end, target):
+    # the largest ladder window at `start` not above `target` seconds and not past `end`
+    offset = (start - EPOCH).total_seconds()
+    span = None
+    for size in WINDOW_LADDER:
+        if size > max(target, WINDOW_LADDER[0]) or offset % size or start + timedelta(seconds=size) > end:
+            break
+        span = size
+    # a start or end off the ladder grid, only at the edges of the date range
+    return (start, start + timedelta(seconds=span) if span else min(end, start + MIN_WINDOW))
+
+
+def split_window(window, total_count):
+    # equal parts expected to fit the cap, assuming an even density inside the window
+    start, end = window
+    parts = max(2, math.ceil(total_count / (SEARCH_RESULT_CAP * WINDOW_FILL)))
+    target = (end - start).total_seconds() / parts
+    windows = []
+    while start < end:
+        windows.append(aligned_window(start, end, target))
+        start = windows[-1][1]
+    return windows
+
+
+class SearchWindowCrawler(object):
+    """
+    Crawls the search results of a date range in windows of creation time. The search api
+    only returns the first 1000 results of a query, so a window whose first page reports
+    more is split in parts that fit, and the parts are crawled instead. Window sizes come
+    from WINDOW_LADDER and windows are aligned to it.
+
+    Windows are planned `concurrency` at a time at the current size and fetched in
+    parallel, together with split parts and further pages, by `concurrency` threads paced
+    by the rate limit headers of the answers. Once all windows of a batch answered, the size
+    of the next batch follows their density, so dense periods get narrow windows and sparse
+    ones are merged into wide windows that need a single request. As the batches only depend
+    on the data and not on which answer came first, a rerun asks the same queries and hits
+    the response cache.
+    """
+
+    def __init__(self, start_date, end_date, initial_window, concurrency=4, **kwargs):
+        self._start = start_date
+        self._end = end_date
+        # seconds
+        self._span = initial_window.total_seconds()
+        self._concurrency = concurrency
+        self._kwargs = kwargs
+        self._per_page = kwargs.get("per_page")
+        self.stats = {'windows': 0, 'splits': 0, 'requests': 0, 'truncated_windows': 0,
+                      'retried_pages': 0, 'failed_windows': 0}
+        # (window, page) given up on, their repos are missing from the crawl
+        self.failed_pages = []
+
+    def _next_span(self, seconds, total_count, windows):
+        # window seconds expected to hold WINDOW_FILL of the cap at the density of a batch, growing at most 4x a batch
+        span = seconds / windows
+        target = seconds * (SEARCH_RESULT_CAP * WINDOW_FILL) / max(total_count, 1)
+        return min(target, span * 4)
+
+    def _page_count(self, total_count):
+        return math.ceil(min(total_count, SEARCH_RESULT_CAP) / self._per_page)
+
+    def crawl(self):
+        repos = {}
+        cursor = self._start
+        # split windows go before new ones, so memory and the in-flight set stay small
+        pending = collections.deque()
+        # windows of the current batch not answered yet, and the seconds, results and windows answered
+        batch_left = 0
+        batch = [0, 0, 0]
+        with ThreadPoolExecutor(max_workers=self._concurrency) as executor:
+            futures = {}
+            while cursor < self._end or pending or futures:
+                if not batch_left and cursor < self._end:
+                    while batch_left < self._concurrency and cursor < self._end:
+                        window = aligned_window(cursor, self._end, self._span)
+                        cursor = window[1]
+                        batch_left += 1
+                        pending.append((window, 1, True, 0))
+                    batch = [0, 0, 0]
+                while len(futures) < self._concurrency and pending:
+                    task = pending.popleft()
+                    futures[executor.submit(
+                        fetch_search_page, task[0], task[1], **self._kwargs)] = task
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    window, page, from_cursor, attempts = futures.pop(future)
+                    self.stats['requests'] += 1
+                    result = future.result()
+                    if result is None:
+                        if attempts < SEARCH_PAGE_RETRIES:
+                            # tried again after the tasks already queued
+                            self.stats['retried_pages'] += 1
+                            pending.append((window, page, from_cursor, attempts + 1))
+                        else:
+                            print(f"Giving up on page {page} of {window[0]}..{window[1]}, its repositories are missing")
+                            if all(failed_window != window for failed_window, _ in self.failed_pages):
+                                self.stats['failed_windows'] += 1
+                            self.failed_pages.append((window, page))
+                            if from_cursor:
+                                batch_left -= 1
+                                if not batch_left and batch[2]:
+                                    self._span = self._next_span(*batch)
+                        continue
+                    total_count, items = result
+                    if page > 1:
+                        repos.update((repo['id'], repo) for repo in items)
+                        continue
+                    if from_cursor:
+                        batch_left -= 1
+                        batch[0] += (window[1] - window[0]).total_seconds()
+                        batch[1] += total_count
+                        batch[2] += 1
+                        if not batch_left:
+                            self._span = self._next_span(*batch)
+                    if total_count > SEARCH_RESULT_CAP and window[1] - window[0] > MIN_WINDOW:
+                        print(f"{total_count} repositories created {window[0]}..{window[1]}, splitting the window")
+                        self.stats['splits'] += 1
+                        pending.extendleft(reversed(
+                            [(part, 1, False, 0) for part in split_window(window, total_count)]))
+                        continue
+                    if total_count > SEARCH_RESULT_CAP:
+                        print(f"Only the first {SEARCH_RESULT_CAP} of {total_count} repositories created {window[0]}..{window[1]} are reachable")
+                        self.stats['truncated_windows'] += 1
+                    self.stats['windows'] += 1
+                    print(f"Found {total_count} repositories created {window[0]}..{window[1]}")
+                    repos.update((repo['id'], repo) for repo in items)
+                    if len(items) >= self._per_page:
+                        pending.extend((window, page, False, 0)
+                                       for page in range(2, self._page_count(total_count) + 1))
+        return list(repos.values())
 
-    current_date = kwargs.get("start_date")
-    all_repos = []
-    while current_date <= kwargs.get("end_date"):
-        day_after = current_date + timedelta(days=kwargs.get("time_range"))
-        page = 1
-
-        while True:
-            params = {
-                'q': f'language:{kwargs.get("language")} created:{current_date.strftime("%Y-%m-%d")}..{day_after.strftime("%Y-%m-%d")} {kwargs.get("kw")} in:description,readme stars:>{kwargs.get("star")} NOT native in:name,description,readme NOT learn in:name,description,readme NOT tutorial in:name,description,readme NOT example in:name,description,readme NOT demo in:name,description,readme',
-                'sort': 'stars',
-                'order': 'desc',
-                'per_page': kwargs.get("per_page"),
-                'page': page,
-            }
-
-            print(
-                f"Fetching repositories created on {current_date.strftime('%Y-%m-%d')}, page {page} ...")
-            response = requests.get(url, headers=headers, params=params)
-            if response.status_code == 200:
-                repos = response.json()['items']
-                if not repos:
-                    break
-                print(f"Found {len(repos)} repositories")
-                # with open(kwargs.get("output_file_name"), 'a', encoding='utf-8') as file:
-                #     for repo in repos:
-                #         file.write(json.dumps(repo) + '\n')
-                all_repos.extend(repos)
-                if len(repos) < kwargs.get("per_page"):
-                    break
-                page += 1
-            else:
-                print(f"Error: {response.status_code}")
-                print(response.json())
-                break
-            # Sleep to avoid hitting the rate limit
-            time.sleep(kwargs.get("sleep_time"))
-        current_date += timedelta(days=kwargs.get("time_range"))
-        # Sleep to avoid hitting the rate limit
-        time.sleep(kwargs.get("sleep_time"))
 
+def fetch_repos_by_day(**kwargs):
+    # end_date is included
+    crawler = SearchWindowCrawler(kwargs.get("start_date"), kwargs.get("end_date") + timedelta(days=1),
+                                  timedelta(days=kwargs.get("time_range")), **{
+                                      key: value for key, value in kwargs.items()
+                                      if key not in ('start_date', 'end_date', 'time_range')})
+    all_repos = crawler.crawl()
+    if crawler.failed_pages:
+        print(f"Incomplete crawl, {len(crawler.failed_pages)} search pages failed: " +
+              ', '.join(f'{window[0]}..{window[1]} page {page}' for window, page in crawler.failed_pages))
+    print(f"Search crawl: {crawler.stats}, {github_client.rate_limits.waited_seconds:.0f}s spent waiting for rate limits (summed over threads)")
     return all_repos
 
 
@@ -81,22 +229,66 @@ def download_repo(repo, output_repo_path):
 
 
 def download_package_json(repo):
-    github_key = os.getenv('GITHUB_KEY')
-    url = f"https://api.github.com/repos/{repo}/contents/package.json"
-    headers = {"Authorization": f"token {github_key}"}
-    response = requests.get(url, headers=headers)
+    response = github_client.get(f"/repos/{repo}/contents/package.json")
 
-    if response.status_code == 200:
+    if response is not None and response.status_code == 200:
         content = response.json()
         package_json_content = base64.b64decode(
             content['content']).decode('utf-8')
         return json.loads(package_json_content)
     else:
         print(
-            f"Failed to download package.json for {repo}: {response.status_code}")
+            f"Failed to download package.json for {repo}: {response.status_code if response is not None else 'no response'}")
         return None
 
 
+def package_json_query(repos):
+    # one aliased lookup per repo, owners and names go in as variables
+    params = ', '.join(
+        f'$owner{i}: String!, $name{i}: String!' for i in range(len(repos)))
+    lookups = '\n'.join(
+        f'  repo{i}: repository(owner: $owner{i}, name: $name{i}) {{ object(expression: "HEAD:package.json") {{ ... on Blob {{ text isTruncated }} }} }}'
+        for i in range(len(repos)))
+    variables = {}
+    for i, repo in enumerate(repos):
+        variables[f'owner{i}'], variables[f'name{i}'] = repo.split('/', 1)
+    return f'query({params}) {{\n{lookups}\n}}', variables
+
+
+def fetch_package_json_batch(repos):
+    # full name -> package.json, None when there is none; repos left out are for the contents api
+    query, variables = package_json_query(repos)
+    data = github_client.graphql(query, variables)
+    if data is None:
+        return {}
+    package_jsons = {}
+    for i, repo in enumerate(repos):
+        blob = (data.get(f'repo{i}') or {}).get('object')
+        if blob and blob.get('isTruncated'):
+            continue
+        if not blob or blob.get('text') is None:
+            package_jsons[repo] = None
+            continue
+        try:
+            package_jsons[repo] = json.loads(blob['text'])
+        except ValueError:
+            print(f"Invalid package.json in {repo}")
+            package_jsons[repo] = None
+    return package_jsons
+
+
+def fetch_package_jsons(repos, concurrency=4):
+    """package.json of repos (full names), PACKAGE_JSON_BATCH repos per graphql query."""
+    batches = [repos[i:i + PACKAGE_JSON_BATCH]
+               for i in range(0, len(repos), PACKAGE_JSON_BATCH)]
+    package_jsons = {}
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for batch_package_jsons in executor.map(fetch_package_json_batch, batches):
+            package_jsons.update(batch_package_jsons)
+    print(f"Looked up {len(package_jsons)}/{len(repos)} package.json in {len(batches)} graphql queries")
+    return package_jsons
+
+
 def judge_dependencies(package_json):
     if 'dependencies' in package_json:
         if 'dependencies' in package_json and 'react' in package_json['dependencies']:
@@ -117,8 +309,12 @@ def judge_scripts(package_json):
     return False
 
 
-def judge_react(repo):
-    package_json = download_package_json(repo)
+def judge_react(repo, package_jsons=None):
+    # package.json looked up in batch, repos missing there are downloaded one by one
+    if package_jsons is not None and repo in package_jsons:
+        package_json = package_jsons[repo]
+    else:
+        package_json = download_package_json(repo)
     if package_json:
         return judge_dependencies(package_json) and judge_scripts(package_json)
     else:
@@ -126,11 +322,11 @@ def judge_react(repo):
         return False
 
 
-def rule_based_filter(repo, target):
+def rule_based_filter(repo, target, package_jsons=None):
     if repo['name'].lower() == target:
         return False
 
-    if not judge_react(repo['full_name']):
+    if not judge_react(repo['full_name'], package_jsons):
         return False
 
     return True
@@ -155,7 +351,8 @@ Target Repository Information:
     # print(f"repo_json: {repo_json}")
 
     prompt += json.dumps(repo_json, indent=4)
-    result = chat(prompt)
+    with llm_labels(template='filter_repo'):
+        result = chat(prompt)
     print(f'result: {result}')
 
     result_blocks = result.lower().split(' ')
@@ -168,10 +365,10 @@ Target Repository Information:
         return None
 
 
-def filtering(repo, target):
+def filtering(repo, target, package_jsons=None):
     print(f"Processing {repo['full_name']}")
 
-    if not rule_based_filter(repo, target):
+    if not rule_based_filter(repo, target, package_jsons):
         return None
 
     llm_suggest = filter_repo_llm(repo)
@@ -191,12 +388,14 @@ def filtering(repo, target):
 
 def filter_repo(repo_infos, target):
     print(f"Found {len(repo_infos)} repositories")
+    package_jsons = fetch_package_jsons(
+        [repo_info['full_name'] for repo_info in repo_infos if repo_info['name'].lower() != target])
     filtered_repos = []
     with ThreadPoolExecutor(max_workers=10) as executor:
         futures = []
         for repo_info in repo_infos:
             futures.append(executor.submit(
-                filtering, repo_info, target))
+                filtering, repo_info, target, package_jsons))
         for future in as_completed(futures):
             filtered_repo = future.result()
             if filtered_repo:
@@ -228,11 +427,20 @@ def parse_args():
     parser.add_argument('--start_date', type=str, default='2016-06-01')
     parser.add_argument('--end_date', type=str, default='2025-01-20')
     parser.add_argument('--per_page', type=int, default=100)
-    parser.add_argument('--sleep_time', type=int, default=3)
+    parser.add_argument('--sleep_time', type=float, default=0,
+                        help='min seconds between two search requests, on top of the pacing by the rate limit headers')
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help='search windows and pages fetched in parallel')
     parser.add_argument('--star', type=int, default=5)
     parser.add_argument('--time_range', type=int, default=30)
     parser.add_argument('--kw', type=str, default='react')
     parser.add_argument('--output_repo_path', type=str, default='data/original_repo')
+    parser.add_argument('--github_cache_path', type=str, default='data/github_cache.sqlite',
+                        help='sqlite file caching GitHub api responses, empty to disable it')
+    parser.add_argument('--github_cache_ttl_days', type=float, default=30,
+                        help='cached responses not revalidated for this long are evicted')
+    parser.add_argument('--github_cache_max_age', type=float, default=3600,
+                        help='seconds a cached response is used without asking GitHub, later it is revalidated')
     return parser.parse_args()
 
 
@@ -243,19 +451,28 @@ if __name__ == '__main__':
     end_date = datetime.strptime(args.end_date, '%Y-%m-%d')
     per_page = args.per_page
     sleep_time = args.sleep_time
+    github_client.rate_limits.set_min_interval('search', sleep_time)
     star = args.star
     time_range = args.time_range
     kw = args.kw
     output_repo_path = args.output_repo_path
     if not os.path.exists(output_repo_path):
         os.makedirs(output_repo_path)
+    github_cache = GitHubResponseCache(
+        args.github_cache_path, ttl=args.github_cache_ttl_days * 86400) if args.github_cache_path else None
+    github_client.set_cache(github_cache, max_age=args.github_cache_max_age)
 
     repo_infos = fetch_repos_by_day(language=language, start_date=start_date, end_date=end_date,
-                                    per_page=per_page, sleep_time=sleep_time, star=star, time_range=time_range, kw=kw)
+                                    per_page=per_page, star=star, time_range=time_range, kw=kw,
+                                    concurrency=args.concurrency)
     print(f'found {len(repo_infos)} repos with query schema')
 
     filtered_repos = filter_repo(repo_infos, 'react')
     print(f'found {len(filtered_repos)} repos after filtering')
+    print(f'GitHub api: {github_client.stats}')
+    if github_cache:
+        print(github_cache.statistics())
+        github_cache.close()
 
     downloaded_count = clone_repo(filtered_repos, output_repo_path)
     print(f"Downloaded {downloaded_count} repositories")
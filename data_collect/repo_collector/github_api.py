@@ -0,0 +1,332 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+from utils.llm_cache import content_hash
+from utils.llm_rate_limit import backoff_delay
+
+
+# e.g. https://github.example.com/api/v3 for GitHub Enterprise
+API_URL = os.getenv('GITHUB_API_URL', 'https://api.github.com').rstrip('/')
+# GitHub Enterprise serves graphql at /api/graphql next to /api/v3
+GRAPHQL_URL = API_URL[:-len('/v3')] + '/graphql' if API_URL.endswith('/v3') else API_URL + '/graphql'
+MAX_RETRIES = 5
+POOL_SIZE = 32
+# headers kept with a cached response
+CACHED_HEADERS = ('Content-Type', 'ETag', 'Last-Modified', 'Link')
+
+
+def rate_limit_resource(url):
+    # the X-RateLimit-Resource a request is counted against, until an answer tells
+    if '/search/' in url:
+        return 'search'
+    if url.endswith('/graphql'):
+        return 'graphql'
+    return 'core'
+
+
+class RateLimitScheduler(object):
+    """
+    Paces GitHub API requests by the `X-RateLimit-Remaining` / `X-RateLimit-Reset` headers
+    of the answers, per rate limit resource (search, core, graphql). Requests go out while
+    the last known remaining quota (less what was sent since) is above `reserve`, then wait
+    for the reset instead of sleeping a fixed time between requests. A `Retry-After`
+    (secondary rate limit) pauses the resource for that long. `min_intervals` optionally
+    spaces the requests of a resource on top of that, e.g. {'search': 2}.
+    """
+
+    def __init__(self, reserve=0, min_intervals=None):
+        self._reserve = reserve
+        self._min_intervals = dict(min_intervals or {})
+        self._cond = threading.Condition()
+        # resource -> {'remaining', 'reset' (epoch seconds), 'sent_at'}
+        self._limits = {}
+        self.waited_seconds = 0
+
+    def _state(self, resource):
+        state = self._limits.get(resource)
+        if state is None:
+            state = self._limits[resource] = {
+                'remaining': None, 'reset': 0, 'sent_at': 0}
+        return state
+
+    def acquire(self, resource):
+        """Block until a request on `resource` may go out."""
+        with self._cond:
+            state = self._state(resource)
+            announced = False
+            while True:
+                now = time.time()
+                if state['remaining'] is not None and now >= state['reset']:
+                    # a new window, the next answer tells its quota
+                    state['remaining'] = None
+                wait = 0
+                if state['remaining'] is not None and state['remaining'] <= self._reserve:
+                    wait = state['reset'] - now + 1
+                    if not announced:
+                        print(f"GitHub {resource} rate limit used up, waiting {wait:.0f}s for the reset")
+                        announced = True
+                else:
+                    wait = state['sent_at'] + \
+                        self._min_intervals.get(resource, 0) - now
+                if wait <= 0:
+                    break
+                self.waited_seconds += wait
+                self._cond.wait(wait)
+            if state['remaining'] is not None:
+                state['remaining'] -= 1
+            state['sent_at'] = time.time()
+
+    def update(self, resource, headers):
+        remaining = headers.get('X-RateLimit-Remaining')
+        reset = headers.get('X-RateLimit-Reset')
+        if remaining is None or reset is None:
+            return
+        resource = headers.get('X-RateLimit-Resource') or resource
+        remaining, reset = int(remaining), int(reset)
+        with self._cond:
+            state = self._state(resource)
+            # answers arrive out of order, within a window the lowest remaining is the latest
+            if reset > state['reset'] or state['remaining'] is None:
+                state['remaining'] = remaining
+            else:
+                state['remaining'] = min(state['remaining'], remaining)
+            state['reset'] = max(state['reset'], reset)
+            self._cond.notify_all()
+
+    def refund(self, resource):
+        # a request that did not count against the quota
+        with self._cond:
+            state = self._state(resource)
+            if state['remaining'] is not None:
+                state['remaining'] += 1
+                self._cond.notify_all()
+
+    def set_min_interval(self, resource, seconds):
+        with self._cond:
+            self._min_intervals[resource] = seconds
+
+    def pause(self, resource, seconds):
+        with self._cond:
+            state = self._state(resource)
+            state['remaining'] = 0
+            state['reset'] = max(state['reset'], time.time() + seconds)
+
+    def snapshot(self):
+        with self._cond:
+            return {resource: dict(state) for resource, state in self._limits.items()}
+
+
+class GitHubResponseCache(object):
+    """
+    Persistent cache of GitHub API GET responses backed by SQLite, keyed by a hash of the
+    request. Responses are revalidated with `If-None-Match` / `If-Modified-Since`, a 304
+    does not count against the rate limit. Entries not validated for `ttl` seconds are
+    evicted.
+    """
+
+    def __init__(self, path, ttl=30 * 86400):
+        self._path = path
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._puts = 0
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                url TEXT NOT NULL,
+                status INTEGER NOT NULL,
+                headers TEXT NOT NULL,
+                body BLOB NOT NULL,
+                validated_at REAL NOT NULL
+            )''')
+        self._conn.execute(
+            'CREATE INDEX IF NOT EXISTS responses_validated_at ON responses (validated_at)')
+        self._evict()
+        self._conn.commit()
+
+    def get(self, key):
+        # {'status', 'headers', 'body', 'validated_at'}, None when missing or expired
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT status, headers, body, validated_at FROM responses WHERE key = ?', (key,)).fetchone()
+        if row is None or time.time() - row[3] > self._ttl:
+            return None
+        return {'status': row[0], 'headers': json.loads(row[1]), 'body': row[2], 'validated_at': row[3]}
+
+    def put(self, key, url, response):
+        headers = {name: response.headers[name]
+                   for name in CACHED_HEADERS if name in response.headers}
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+                               (key, url, response.status_code, json.dumps(headers), response.content, time.time()))
+            self._puts += 1
+            if self._puts % 1000 == 0:
+                self._evict()
+            self._conn.commit()
+
+    def touch(self, key):
+        # revalidated by a 304
+        with self._lock:
+            self._conn.execute(
+                'UPDATE responses SET validated_at = ? WHERE key = ?', (time.time(), key))
+            self._conn.commit()
+
+    def _evict(self):
+        self._conn.execute(
+            'DELETE FROM responses WHERE validated_at < ?', (time.time() - self._ttl,))
+
+    def statistics(self):
+        with self._lock:
+            entries, size = self._conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(LENGTH(body)), 0) FROM responses').fetchone()
+        return {'github_cache_entries': entries, 'github_cache_bytes': size}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def cached_response(entry, url):
+    response = requests.Response()
+    response.status_code = entry['status']
+    response.headers = CaseInsensitiveDict(entry['headers'])
+    response._content = entry['body']
+    response.encoding = 'utf-8'
+    response.url = url
+    return response
+
+
+class GitHubClient(object):
+    """
+    Thread-safe GitHub REST client: requests are paced by a shared RateLimitScheduler and
+    retried on rate limit answers (403/429) and server errors. Connections are kept alive in
+    a pool shared by the threads. With a GitHubResponseCache, GET responses are cached,
+    served without a request for `max_age` seconds and revalidated after that.
+    """
+
+    def __init__(self, token=None, reserve=0, min_intervals=None, timeout=30, cache=None, max_age=0):
+        self._token = token
+        self._timeout = timeout
+        self.rate_limits = RateLimitScheduler(reserve, min_intervals)
+        self._cache = cache
+        self._max_age = max_age
+        self._session = requests.Session()
+        # retries are ours, the adapter only pools connections
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=POOL_SIZE)
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+        self._stats_lock = threading.Lock()
+        self.stats = {'requests': 0, 'cache_hits': 0, 'not_modified': 0}
+
+    def set_cache(self, cache, max_age=0):
+        self._cache = cache
+        self._max_age = max_age
+
+    def _count(self, stat):
+        with self._stats_lock:
+            self.stats[stat] += 1
+
+    def headers(self, extra=None):
+        headers = {'Accept': 'application/vnd.github.v3+json'}
+        if self._token:
+            headers['Authorization'] = f'token {self._token}'
+        headers.update(extra or {})
+        return headers
+
+    def _rate_limited(self, response):
+        if response.status_code == 429:
+            return True
+        # primary limits answer 403 with no quota left, secondary ones 403 with a Retry-After
+        return response.status_code == 403 and (
+            response.headers.get('X-RateLimit-Remaining') == '0' or 'Retry-After' in response.headers)
+
+    def request(self, method, url, **kwargs):
+        """The response, after waiting out rate limits; None if the request never got through."""
+        if not url.startswith('http'):
+            url = API_URL + url
+        resource = rate_limit_resource(url)
+        headers = self.headers(kwargs.pop('headers', None))
+        key = entry = None
+        if self._cache and method == 'GET':
+            # the token is part of the key, another token may see other repos
+            key = content_hash(url, kwargs.get('params'), headers)
+            entry = self._cache.get(key)
+            if entry and time.time() - entry['validated_at'] < self._max_age:
+                self._count('cache_hits')
+                return cached_response(entry, url)
+            if entry:
+                headers = dict(headers)
+                if 'ETag' in entry['headers']:
+                    headers['If-None-Match'] = entry['headers']['ETag']
+                if 'Last-Modified' in entry['headers']:
+                    headers['If-Modified-Since'] = entry['headers']['Last-Modified']
+        response = None
+        for attempt in range(MAX_RETRIES):
+            self.rate_limits.acquire(resource)
+            try:
+                response = self._session.request(
+                    method, url, headers=headers, timeout=self._timeout, **kwargs)
+            except requests.RequestException as e:
+                print(f"GitHub request {url} failed: {e}")
+                time.sleep(backoff_delay(attempt))
+                continue
+            self._count('requests')
+            self.rate_limits.update(resource, response.headers)
+            if response.status_code == 304 and entry:
+                self._count('not_modified')
+                # not counted against the rate limit
+                self.rate_limits.refund(resource)
+                self._cache.touch(key)
+                return cached_response(entry, url)
+            if self._rate_limited(response):
+                retry_after = response.headers.get('Retry-After')
+                if retry_after is not None:
+                    self.rate_limits.pause(resource, float(retry_after))
+                elif response.headers.get('X-RateLimit-Remaining') != '0':
+                    time.sleep(backoff_delay(attempt))
+                continue
+            if response.status_code >= 500:
+                time.sleep(backoff_delay(attempt))
+                continue
+            if key and response.status_code == 200:
+                self._cache.put(key, url, response)
+            return response
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def graphql(self, query, variables=None):
+        """
+        The `data` of a GraphQL query, None if the query failed. Lookups that failed (e.g. a
+        repo that does not exist) are null in it.
+        """
+        for _ in range(MAX_RETRIES):
+            response = self.request('POST', GRAPHQL_URL, json={
+                                    'query': query, 'variables': variables or {}})
+            if response is None or response.status_code != 200:
+                print(f"GraphQL query failed: {response.status_code if response is not None else 'no response'}")
+                return None
+            result = response.json()
+            errors = result.get('errors') or []
+            # the primary graphql limit answers 200, the rate limit headers tell when to go on
+            if any(error.get('type') == 'RATE_LIMITED' for error in errors):
+                continue
+            for error in errors:
+                if error.get('type') != 'NOT_FOUND':
+                    print(f"GraphQL error: {error.get('message')}")
+            return result.get('data')
+        return None
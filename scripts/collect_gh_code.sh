@@ -19,7 +19,8 @@ python3 -B data_collect/repo_collector/collect_info.py \
   --start_date 2024-02-01 \
   --end_date 2024-02-20 \
   --per_page 100 \
-  --sleep_time 3 \
+  --sleep_time 0 \
+  --concurrency 4 \
   --star 5 \
   --time_range 30 \
   --kw react \
@@ -0,0 +1,98 @@
+import json
+import os
+import tempfile
+import unittest
+
+from data_collect.component_collector.distiller.manifest import BundleManifest
+
+
+class BundleManifestTest(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.repo_path = os.path.join(self._dir.name, 'repo')
+        self.path = os.path.join(self._dir.name, 'out', 'repo.manifest')
+        os.makedirs(os.path.dirname(self.path))
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def repo_file(self, name):
+        return os.path.join(self.repo_path, 'src', name)
+
+    def record(self, manifest, name, file_hash='h1'):
+        component_path = self.repo_file(name)
+        manifest.record(component_path, os.path.join(self._dir.name, 'out', 'repo', os.path.splitext(name)[0] + '_bundled.json'),
+                        {component_path: file_hash})
+
+    def saved_entries(self):
+        with open(self.path) as f:
+            return json.load(f)
+
+    def test_up_to_date_only_with_the_same_inputs(self):
+        manifest = BundleManifest(self.path, self.repo_path)
+        self.record(manifest, 'App.jsx')
+        component_path = self.repo_file('App.jsx')
+        self.assertTrue(manifest.is_up_to_date(component_path, {component_path: 'h1'}))
+        self.assertFalse(manifest.is_up_to_date(component_path, {component_path: 'h2'}))
+        self.assertFalse(manifest.is_up_to_date(
+            component_path, {component_path: 'h1', self.repo_file('App.css'): 'h3'}))
+        self.assertFalse(manifest.is_up_to_date(self.repo_file('Other.jsx'), {}))
+
+    def test_paths_are_relative_to_the_repo(self):
+        manifest = BundleManifest(self.path, self.repo_path)
+        self.record(manifest, 'App.jsx')
+        manifest.save()
+        self.assertEqual(self.saved_entries(), {os.path.join('src', 'App.jsx'): {
+            'output': 'App_bundled.json', 'inputs': {os.path.join('src', 'App.jsx'): 'h1'}}})
+
+        moved_repo = os.path.join(self._dir.name, 'moved', 'repo')
+        moved = BundleManifest(self.path, moved_repo)
+        moved_path = os.path.join(moved_repo, 'src', 'App.jsx')
+        self.assertTrue(moved.is_up_to_date(moved_path, {moved_path: 'h1'}))
+
+    def test_inputs_digest_follows_the_inputs(self):
+        manifest = BundleManifest(self.path, self.repo_path)
+        self.assertIsNone(manifest.inputs_digest(self.repo_file('App.jsx')))
+        self.record(manifest, 'App.jsx', 'h1')
+        first = manifest.inputs_digest(self.repo_file('App.jsx'))
+        self.record(manifest, 'App.jsx', 'h2')
+        self.assertNotEqual(manifest.inputs_digest(self.repo_file('App.jsx')), first)
+
+    def test_saved_in_batches_and_on_save(self):
+        manifest = BundleManifest(self.path, self.repo_path, save_every=3)
+        self.assertEqual(self.saved_entries(), {})
+        for i in range(4):
+            self.record(manifest, f'C{i}.jsx')
+        self.assertEqual(len(self.saved_entries()), 3)
+        manifest.save()
+        self.assertEqual(len(self.saved_entries()), 4)
+        self.assertFalse(os.path.exists(self.path + '.tmp'))
+
+    def test_unrecorded_bundles_are_adopted_only_without_a_manifest(self):
+        # a repo bundled before manifests were kept
+        legacy = BundleManifest(self.path, self.repo_path)
+        self.assertTrue(legacy.adopts_unrecorded)
+        # the file exists from the start, a crash before the first save is not taken for a legacy repo
+        self.assertTrue(os.path.exists(self.path))
+
+        # records not saved by a crashed run leave their bundles without an entry
+        crashed = BundleManifest(self.path, self.repo_path, save_every=2)
+        self.assertFalse(crashed.adopts_unrecorded)
+        for i in range(3):
+            self.record(crashed, f'C{i}.jsx')
+        rerun = BundleManifest(self.path, self.repo_path)
+        self.assertFalse(rerun.adopts_unrecorded)
+        self.assertIsNotNone(rerun.get(self.repo_file('C1.jsx')))
+        self.assertIsNone(rerun.get(self.repo_file('C2.jsx')))
+
+    def test_unreadable_manifest_is_not_adopting(self):
+        with open(self.path, 'w') as f:
+            f.write('{"src/App.jsx": ')
+        manifest = BundleManifest(self.path, self.repo_path)
+        self.assertFalse(manifest.adopts_unrecorded)
+        self.assertIsNone(manifest.get(self.repo_file('App.jsx')))
+
+
+if __name__ == '__main__':
+    unittest.main()
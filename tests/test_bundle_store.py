@@ -0,0 +1,115 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+
+from utils.bundle_store import (INDEX_EXTENSION, SHARD_PREFIX, BundleStore, BundleStoreWriter, pack_bundle_dir,
+                                zstandard)
+
+
+def bundle(name, size=10):
+    return {'raw_component': f'export default function {name}() {{}}', 'raw_css': 'x' * size, 'bug_free': True}
+
+
+class BundleStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self._dir.name, 'store')
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def shards(self):
+        return sorted(filename for filename in os.listdir(self.path)
+                      if filename.startswith(SHARD_PREFIX) and not filename.endswith(INDEX_EXTENSION))
+
+    def write(self, records, codec='none', max_shard_bytes=256 * 1024 * 1024):
+        writer = BundleStoreWriter(self.path, codec=codec, max_shard_bytes=max_shard_bytes)
+        try:
+            for repo, component, content in records:
+                writer.append(repo, component, content)
+        finally:
+            writer.close()
+
+    def assert_round_trip(self, codec):
+        records = [(f'repo{i % 3}', f'C{i}_bundled.json', bundle(f'C{i}', i * 50)) for i in range(30)]
+        self.write(records, codec=codec, max_shard_bytes=2000)
+        self.assertGreater(len(self.shards()), 1)
+        store = BundleStore(self.path)
+        try:
+            self.assertEqual(len(store), 30)
+            self.assertEqual(store.repos(), ['repo0', 'repo1', 'repo2'])
+            self.assertEqual(store.components('repo1'), sorted(f'C{i}_bundled.json' for i in range(1, 30, 3)))
+            for repo, component, content in records:
+                self.assertIn((repo, component), store)
+                self.assertEqual(store.get(repo, component), content)
+            self.assertEqual(sorted(store.items()), sorted(records))
+            self.assertIsNone(store.get('repo0', 'Missing_bundled.json'))
+        finally:
+            store.close()
+
+    def test_round_trip_across_shards(self):
+        self.assert_round_trip('none')
+
+    @unittest.skipIf(zstandard is None, 'the zstd codec needs the zstandard package')
+    def test_round_trip_zstd(self):
+        self.assert_round_trip('zstd')
+
+    def test_index_entries_point_at_the_records(self):
+        self.write([('repo', 'A_bundled.json', bundle('A')), ('repo', 'B_bundled.json', bundle('B'))])
+        shard_path = os.path.join(self.path, self.shards()[0])
+        with open(shard_path, 'rb') as shard, open(shard_path + INDEX_EXTENSION) as index:
+            for line in index:
+                entry = json.loads(line)
+                shard.seek(entry['offset'])
+                record = json.loads(shard.read(entry['length']))
+                self.assertEqual((record['repo'], record['component']), (entry['repo'], entry['component']))
+
+    def test_latest_record_wins(self):
+        self.write([('repo', 'A_bundled.json', bundle('A', 1)), ('repo', 'A_bundled.json', bundle('A', 2))])
+        # a later writer (a rerun) opens later shards
+        time.sleep(0.002)
+        self.write([('repo', 'A_bundled.json', bundle('A', 3))])
+        store = BundleStore(self.path)
+        self.assertEqual(len(store), 1)
+        self.assertEqual(store.get('repo', 'A_bundled.json'), bundle('A', 3))
+        store.close()
+
+    def test_records_of_a_crashed_writer_are_skipped(self):
+        self.write([('repo', 'A_bundled.json', bundle('A')), ('repo', 'B_bundled.json', bundle('B'))])
+        shard_path = os.path.join(self.path, self.shards()[0])
+        # the last record is cut short and the index has a torn line
+        with open(shard_path, 'r+b') as shard:
+            shard.truncate(os.path.getsize(shard_path) - 5)
+        with open(shard_path + INDEX_EXTENSION, 'a') as index:
+            index.write('{"repo": "repo", "comp')
+        store = BundleStore(self.path)
+        self.assertEqual(len(store), 1)
+        self.assertEqual(store.get('repo', 'A_bundled.json'), bundle('A'))
+        self.assertNotIn(('repo', 'B_bundled.json'), store)
+        store.close()
+
+    def test_missing_store(self):
+        with self.assertRaises(FileNotFoundError):
+            BundleStore(self.path)
+
+    def test_pack_bundle_dir(self):
+        bundle_dir = os.path.join(self._dir.name, 'bundles')
+        os.makedirs(os.path.join(bundle_dir, 'repo'))
+        for name in ('A', 'B'):
+            with open(os.path.join(bundle_dir, 'repo', f'{name}_bundled.json'), 'w') as f:
+                json.dump(bundle(name), f)
+        with open(os.path.join(bundle_dir, 'repo', 'package.json'), 'w') as f:
+            f.write('{}')
+        with open(os.path.join(bundle_dir, 'repo', 'C_bundled.json'), 'w') as f:
+            f.write('{torn')
+        self.assertEqual(pack_bundle_dir(bundle_dir, self.path), 2)
+        store = BundleStore(self.path)
+        self.assertEqual(store.components('repo'), ['A_bundled.json', 'B_bundled.json'])
+        store.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+import os
+import tempfile
+import unittest
+
+from data_collect.component_collector.distiller.import_resolver import ImportResolver, load_jsonc
+from data_collect.component_collector.distiller.repo_index import RepoIndex
+
+
+FILES = {
+    'src/App.jsx': '',
+    'src/components/Header.tsx': '',
+    'src/components/Button/index.js': '',
+    'src/components/ui/Card.tsx': '',
+    'src/util/index.ts': '',
+    'src/config/settings.ts': '',
+    'packages/admin/src/Admin.jsx': '',
+    'packages/admin/src/lib/auth.js': '',
+}
+
+TSCONFIG = '''{
+    // shared options
+    "extends": "./tsconfig.base",
+    "compilerOptions": {
+        "paths": {
+            "@/*": ["src/*"],
+            "@ui/*": ["src/components/ui/*"],
+            "settings": ["src/config/settings.ts"],
+        },
+    },
+}'''
+
+TSCONFIG_BASE = '''{
+    "compilerOptions": {
+        /* imports like util or components/Header */
+        "baseUrl": "./",
+        "url": "http://example.com/*not-a-comment*/"
+    }
+}'''
+
+ADMIN_JSCONFIG = '''{
+    "compilerOptions": {"baseUrl": "src", "paths": {"~/*": ["lib/*"]}}
+}'''
+
+
+class ImportResolverTest(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.repo = os.path.join(self._dir.name, 'repo')
+        files = dict(FILES, **{'tsconfig.json': TSCONFIG, 'tsconfig.base.json': TSCONFIG_BASE,
+                               'packages/admin/jsconfig.json': ADMIN_JSCONFIG})
+        for name, content in files.items():
+            path = self.path(name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                f.write(content)
+        repo_index = RepoIndex(self.repo)
+        repo_index.build()
+        self.resolver = ImportResolver(repo_index)
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.repo, *name.split('/'))
+
+    def resolve(self, importer, module_name):
+        return self.resolver.resolve(self.path(importer), module_name)
+
+    def test_relative_imports_are_probed(self):
+        self.assertEqual(self.resolve('src/App.jsx', './components/Header'), self.path('src/components/Header.tsx'))
+        self.assertEqual(self.resolve('src/App.jsx', './components/Button'),
+                         self.path('src/components/Button/index.js'))
+        self.assertEqual(self.resolve('src/components/Header.tsx', '../util'), self.path('src/util/index.ts'))
+        self.assertEqual(self.resolve('src/App.jsx', './components/Header.tsx'),
+                         self.path('src/components/Header.tsx'))
+        self.assertIsNone(self.resolve('src/App.jsx', './Missing'))
+
+    def test_tsconfig_paths(self):
+        self.assertEqual(self.resolve('src/App.jsx', '@/components/Header'), self.path('src/components/Header.tsx'))
+        self.assertEqual(self.resolve('src/App.jsx', '@ui/Card'), self.path('src/components/ui/Card.tsx'))
+        self.assertEqual(self.resolve('src/App.jsx', 'settings'), self.path('src/config/settings.ts'))
+
+    def test_base_url_of_the_extended_config(self):
+        self.assertEqual(self.resolve('src/App.jsx', 'src/util'), self.path('src/util/index.ts'))
+
+    def test_packages_are_left_alone(self):
+        self.assertIsNone(self.resolve('src/App.jsx', 'react'))
+        self.assertIsNone(self.resolve('src/App.jsx', '@mui/material'))
+        self.assertIsNone(self.resolve('src/App.jsx', '/absolute/path'))
+
+    def test_nearest_config_wins(self):
+        self.assertEqual(self.resolve('packages/admin/src/Admin.jsx', '~/auth'),
+                         self.path('packages/admin/src/lib/auth.js'))
+        self.assertEqual(self.resolve('packages/admin/src/Admin.jsx', 'lib/auth'),
+                         self.path('packages/admin/src/lib/auth.js'))
+        # the root aliases do not apply under the admin package
+        self.assertIsNone(self.resolve('packages/admin/src/Admin.jsx', '@/util'))
+
+    def test_load_jsonc_keeps_comment_markers_inside_strings(self):
+        config = load_jsonc(self.path('tsconfig.base.json'))
+        self.assertEqual(config['compilerOptions']['url'], 'http://example.com/*not-a-comment*/')
+
+
+if __name__ == '__main__':
+    unittest.main()
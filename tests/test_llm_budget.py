@@ -0,0 +1,114 @@
+import json
+import os
+import tempfile
+import unittest
+
+from utils.llm_budget import BUDGET_HARD, BUDGET_OK, BUDGET_SOFT, TokenBudget
+
+
+LIMITS = {
+    'run': {'input_tokens': 1000, 'output_tokens': 500},
+    'stages': {'filter_css': {'output_tokens': 100}},
+    'repo': {'input_tokens': 400},
+    'repos': {'big/repo': {'input_tokens': 800}},
+    'soft_fraction': 0.5,
+}
+
+
+class TokenBudgetTest(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.state_path = os.path.join(self._dir.name, 'budget', 'state.json')
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def test_status_goes_soft_then_hard(self):
+        budget = TokenBudget(LIMITS)
+        self.assertEqual(budget.status('debug_code', 'a/repo'), (BUDGET_OK, None))
+        budget.charge('debug_code', 'a/repo', 250, 0)
+        status, reason = budget.status('debug_code', 'a/repo')
+        self.assertEqual(status, BUDGET_SOFT)
+        self.assertIn('repo a/repo', reason)
+        budget.charge('debug_code', 'a/repo', 150, 0)
+        status, reason = budget.status('debug_code', 'a/repo')
+        self.assertEqual(status, BUDGET_HARD)
+        self.assertIn('used up: 400/400', reason)
+        # the other repos only share the run cap
+        self.assertEqual(budget.status('debug_code', 'b/repo'), (BUDGET_OK, None))
+
+    def test_repo_override_and_stage_cap(self):
+        budget = TokenBudget(LIMITS)
+        budget.charge('debug_code', 'big/repo', 500, 0)
+        self.assertEqual(budget.status('debug_code', 'big/repo')[0], BUDGET_SOFT)
+        budget.charge('filter_css', 'c/repo', 10, 100)
+        self.assertEqual(budget.status('filter_css', 'd/repo')[0], BUDGET_HARD)
+        self.assertEqual(budget.status('debug_code', 'd/repo')[0], BUDGET_SOFT)
+
+    def test_request_larger_than_what_is_left(self):
+        budget = TokenBudget(LIMITS)
+        budget.charge('debug_code', 'a/repo', 100, 0)
+        status, reason = budget.status('debug_code', 'a/repo', estimated_input_tokens=301)
+        self.assertEqual(status, BUDGET_HARD)
+        self.assertIn('too small for the request', reason)
+        self.assertEqual(budget.status('debug_code', 'a/repo', estimated_input_tokens=300)[0], BUDGET_OK)
+
+    def test_remaining_is_the_tightest_cap(self):
+        budget = TokenBudget(LIMITS)
+        budget.charge('filter_css', 'a/repo', 300, 40)
+        self.assertEqual(budget.remaining('filter_css', 'a/repo'),
+                         {'input_tokens': 100, 'output_tokens': 60})
+        self.assertEqual(budget.remaining(), {'input_tokens': 700, 'output_tokens': 460})
+        self.assertEqual(TokenBudget({}).remaining('filter_css', 'a/repo'),
+                         {'input_tokens': None, 'output_tokens': None})
+
+    def test_usage_is_shared_through_the_state_file(self):
+        first = TokenBudget(LIMITS, self.state_path, flush_interval=3600)
+        second = TokenBudget(LIMITS, self.state_path, flush_interval=3600)
+        first.charge('debug_code', 'a/repo', 300, 10)
+        second.charge('debug_code', 'b/repo', 600, 20)
+        # nothing is read from the file before a flush
+        self.assertEqual(first.remaining()['input_tokens'], 700)
+        first.flush()
+        second.flush()
+        first.flush()
+        self.assertEqual(first.remaining()['input_tokens'], 100)
+        self.assertEqual(second.remaining()['input_tokens'], 100)
+        with open(self.state_path) as f:
+            usage = json.load(f)['usage']
+        self.assertEqual(usage['run'][''], [900, 30])
+        self.assertEqual(usage['repo'], {'a/repo': [300, 10], 'b/repo': [600, 20]})
+
+        restarted = TokenBudget(LIMITS, self.state_path)
+        self.assertEqual(restarted.status('debug_code', 'b/repo')[0], BUDGET_HARD)
+        self.assertEqual(restarted.remaining('debug_code', 'a/repo')['input_tokens'], 100)
+
+    def test_flushing_twice_does_not_count_twice(self):
+        budget = TokenBudget(LIMITS, self.state_path, flush_interval=3600)
+        budget.charge('debug_code', 'a/repo', 100, 0)
+        budget.flush()
+        budget.flush()
+        self.assertEqual(TokenBudget(LIMITS, self.state_path).remaining()['input_tokens'], 900)
+
+    def test_failed_flush_keeps_the_usage(self):
+        # the state directory can not be created under a file
+        blocker = os.path.join(self._dir.name, 'blocker')
+        open(blocker, 'w').close()
+        budget = TokenBudget(LIMITS, os.path.join(blocker, 'state.json'), flush_interval=3600)
+        budget.charge('debug_code', 'a/repo', 100, 0)
+        budget.flush()
+        self.assertEqual(budget.remaining()['input_tokens'], 900)
+        budget.charge('debug_code', 'a/repo', 50, 0)
+        self.assertEqual(budget.remaining()['input_tokens'], 850)
+
+    def test_unreadable_state_is_ignored(self):
+        os.makedirs(os.path.dirname(self.state_path))
+        with open(self.state_path, 'w') as f:
+            f.write('{not json')
+        budget = TokenBudget(LIMITS, self.state_path, flush_interval=3600)
+        self.assertEqual(budget.remaining()['input_tokens'], 1000)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import random
+import threading
+import unittest
+
+from utils.llm_metrics import (LATENCY_BUCKET_GROWTH, OUTPUT_LEN_LIMIT, LatencyHistogram, TokenAccounting,
+                               current_labels, llm_labels)
+
+
+def exact_percentile(values, percentile):
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * percentile // 100))
+    return ordered[int(rank) - 1]
+
+
+class LatencyHistogramTest(unittest.TestCase):
+
+    def test_percentiles_within_a_bucket_of_the_exact_ones(self):
+        rng = random.Random(3)
+        values = [rng.lognormvariate(0, 1) for _ in range(5000)]
+        histogram = LatencyHistogram()
+        for value in values:
+            histogram.observe(value)
+        for percentile in (50, 95, 99):
+            exact = exact_percentile(values, percentile)
+            estimate = histogram.percentile(percentile)
+            self.assertGreaterEqual(estimate, exact / LATENCY_BUCKET_GROWTH)
+            self.assertLessEqual(estimate, exact * LATENCY_BUCKET_GROWTH)
+
+    def test_percentiles_stay_in_the_observed_range(self):
+        histogram = LatencyHistogram()
+        for value in (0, 0, 0.5, 2.0):
+            histogram.observe(value)
+        self.assertEqual(histogram.percentile(50), 0)
+        self.assertEqual(histogram.percentile(100), 2.0)
+        summary = histogram.to_dict()
+        self.assertEqual((summary['count'], summary['sum'], summary['min'], summary['max']), (4, 2.5, 0, 2.0))
+        self.assertLessEqual(summary['p99'], 2.0)
+        self.assertIsNone(LatencyHistogram().percentile(50))
+
+
+class TokenAccountingTest(unittest.TestCase):
+
+    def test_totals_and_labels(self):
+        accounting = TokenAccounting()
+        with llm_labels(caller='distiller', template='filter_css', repo='a/repo'):
+            self.assertEqual(current_labels(), ('distiller', 'filter_css', 'a/repo'))
+            accounting.record(100, 10, endpoint='e1', latency=0.5)
+            accounting.record(300, OUTPUT_LEN_LIMIT, endpoint='e1', latency=1.5)
+            accounting.record_failure()
+        accounting.record(50, 5, labels=('distiller', 'debug_code', None))
+        totals = accounting.totals()
+        self.assertEqual((totals['requests'], totals['failures'], totals['tokens']),
+                         (3, 1, 465 + OUTPUT_LEN_LIMIT))
+        self.assertEqual(totals['output_len_over_limit'], 1)
+        self.assertEqual((totals['min_input_tokens_per_request'], totals['max_input_tokens_per_request']), (50, 300))
+        snapshot = accounting.snapshot()
+        by_template = {counters['template']: counters for counters in snapshot['by_label']}
+        self.assertEqual(by_template['filter_css']['requests'], 2)
+        self.assertEqual(by_template['filter_css']['failures'], 1)
+        self.assertEqual(by_template['filter_css']['seconds'], 2.0)
+        self.assertEqual(by_template['debug_code']['input_tokens'], 50)
+        self.assertEqual(snapshot['latency']['e1']['count'], 2)
+
+    def test_concurrent_records_are_not_lost(self):
+        accounting = TokenAccounting()
+
+        def record():
+            for _ in range(1000):
+                accounting.record(1, 2, labels=('caller', 'template', None))
+        threads = [threading.Thread(target=record) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        totals = accounting.totals()
+        self.assertEqual((totals['requests'], totals['input_tokens'], totals['output_tokens']), (8000, 8000, 16000))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+import asyncio
+import email.utils
+import time
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from utils.llm_rate_limit import AIMDLimiter, TokenBucket, backoff_delay, parse_retry_after
+
+
+def http_error(headers):
+    return SimpleNamespace(response=SimpleNamespace(headers=headers))
+
+
+class BackoffTest(unittest.TestCase):
+
+    def test_full_jitter_is_capped(self):
+        for attempt in range(10):
+            for _ in range(50):
+                delay = backoff_delay(attempt, base=2, cap=60)
+                self.assertGreaterEqual(delay, 0)
+                self.assertLessEqual(delay, min(60, 2 * 2 ** attempt))
+
+    def test_retry_after_is_a_floor(self):
+        for _ in range(50):
+            delay = backoff_delay(5, base=2, retry_after=30)
+            self.assertGreaterEqual(delay, 30)
+            self.assertLessEqual(delay, 32)
+
+    def test_parse_retry_after(self):
+        self.assertEqual(parse_retry_after(http_error({'retry-after-ms': '1500', 'retry-after': '9'})), 1.5)
+        self.assertEqual(parse_retry_after(http_error({'retry-after': '7'})), 7)
+        self.assertEqual(parse_retry_after(http_error({'retry-after': '-3'})), 0)
+        in_ten_seconds = email.utils.formatdate(time.time() + 10, usegmt=True)
+        self.assertAlmostEqual(parse_retry_after(http_error({'retry-after': in_ten_seconds})), 10, delta=1.5)
+        self.assertIsNone(parse_retry_after(http_error({'retry-after': 'soon'})))
+        self.assertIsNone(parse_retry_after(http_error({})))
+        self.assertIsNone(parse_retry_after(ValueError('no response')))
+
+
+class AIMDLimiterTest(unittest.TestCase):
+
+    def test_additive_increase_up_to_the_maximum(self):
+        limiter = AIMDLimiter(8, initial=4)
+        # about +1 per round of `limit` successes
+        for _ in range(4):
+            limiter.on_success()
+        self.assertEqual(limiter.limit, 4)
+        limiter.on_success()
+        self.assertEqual(limiter.limit, 5)
+        for _ in range(100):
+            limiter.on_success()
+        self.assertEqual(limiter.limit, 8)
+
+    def test_multiplicative_decrease_once_per_cooldown(self):
+        with mock.patch('utils.llm_rate_limit.time.monotonic', return_value=1000):
+            limiter = AIMDLimiter(16, minimum=2, cooldown=5)
+            self.assertTrue(limiter.on_throttle())
+            self.assertEqual(limiter.limit, 8)
+            # the rest of the burst
+            self.assertFalse(limiter.on_throttle())
+            self.assertEqual(limiter.limit, 8)
+        for now in (1006, 1012, 1018):
+            with mock.patch('utils.llm_rate_limit.time.monotonic', return_value=now):
+                self.assertTrue(limiter.on_throttle())
+        self.assertEqual(limiter.limit, 2)
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_acquire_waits_for_the_refill(self):
+        async def run():
+            # 20 a second, 1200 at most
+            bucket = TokenBucket(1200)
+            self.assertEqual(await bucket.acquire(1200), 0)
+            return await bucket.acquire(4)
+        waited = asyncio.run(run())
+        self.assertGreater(waited, 0.1)
+        self.assertLess(waited, 0.5)
+
+    def test_debit_leaves_the_bucket_in_debt(self):
+        bucket = TokenBucket(600)
+        bucket.debit(700)
+        self.assertLess(bucket.level, 0)
+
+    def test_zero_rate_disables_the_bucket(self):
+        bucket = TokenBucket(0)
+        self.assertFalse(bucket.enabled)
+        self.assertEqual(asyncio.run(bucket.acquire(10 ** 9)), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
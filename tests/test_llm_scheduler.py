@@ -0,0 +1,91 @@
+import asyncio
+import unittest
+from types import SimpleNamespace
+
+from utils.llm_scheduler import StageScheduler
+
+
+async def dispatch_order(scheduler, requests):
+    # hold the only slot, queue `requests` (stage, cost) and return the order they are admitted in
+    order = []
+
+    async def request(stage, cost, index):
+        async with scheduler.slot(stage, cost):
+            order.append(index)
+            await asyncio.sleep(0)
+
+    async with scheduler.slot('holder', 1):
+        tasks = [asyncio.ensure_future(request(stage, cost, index))
+                 for index, (stage, cost) in enumerate(requests)]
+        await asyncio.sleep(0)
+    await asyncio.gather(*tasks)
+    return order
+
+
+class StageSchedulerTest(unittest.TestCase):
+
+    def test_short_requests_do_not_wait_behind_long_ones(self):
+        scheduler = StageScheduler(SimpleNamespace(limit=1), long_request_tokens=10 ** 6)
+        order = asyncio.run(dispatch_order(
+            scheduler, [('generate', 8000), ('generate', 8000), ('generate', 8000), ('classify', 200)]))
+        self.assertEqual(order, [3, 0, 1, 2])
+
+    def test_weights_share_the_slots(self):
+        scheduler = StageScheduler(SimpleNamespace(limit=1), {'heavy': {'weight': 2}, 'light': {'weight': 1}})
+        requests = [('heavy', 100)] * 6 + [('light', 100)] * 6
+        order = asyncio.run(dispatch_order(scheduler, requests))
+        first_six = [requests[index][0] for index in order[:6]]
+        self.assertEqual(first_six.count('heavy'), 4)
+        self.assertEqual(first_six.count('light'), 2)
+
+    def test_requests_past_their_deadline_go_first(self):
+        scheduler = StageScheduler(SimpleNamespace(limit=1), {'urgent': {'deadline': 0}})
+        order = asyncio.run(dispatch_order(scheduler, [('bulk', 10), ('bulk', 10), ('urgent', 5000)]))
+        self.assertEqual(order[0], 2)
+        self.assertEqual(scheduler.metrics()['urgent']['deadline_misses'], 1)
+
+    def test_limit_and_admission(self):
+        limiter = SimpleNamespace(limit=4)
+        scheduler = StageScheduler(limiter, long_request_tokens=1000, reserved_fraction=0.25)
+        peaks = {'in_flight': 0, 'long': 0}
+        long_in_flight = [0]
+
+        async def request(cost):
+            async with scheduler.slot('stage', cost):
+                long_in_flight[0] += cost >= 1000
+                peaks['in_flight'] = max(peaks['in_flight'], scheduler.in_flight)
+                peaks['long'] = max(peaks['long'], long_in_flight[0])
+                await asyncio.sleep(0.01)
+                long_in_flight[0] -= cost >= 1000
+
+        async def run():
+            await asyncio.gather(*[request(5000) for _ in range(8)], *[request(10) for _ in range(8)])
+
+        asyncio.run(run())
+        self.assertEqual(peaks['in_flight'], 4)
+        # a quarter of the slots is kept for short requests
+        self.assertEqual(peaks['long'], 3)
+        self.assertEqual(scheduler.in_flight, 0)
+
+    def test_cancelled_waiters_leave_no_slot_behind(self):
+        scheduler = StageScheduler(SimpleNamespace(limit=1))
+
+        async def run():
+            async def wait_for_slot():
+                async with scheduler.slot('stage', 10):
+                    pass
+            async with scheduler.slot('stage', 10):
+                waiting = asyncio.ensure_future(wait_for_slot())
+                await asyncio.sleep(0)
+                waiting.cancel()
+                with self.assertRaises(asyncio.CancelledError):
+                    await waiting
+            self.assertEqual(scheduler.in_flight, 0)
+            self.assertEqual(scheduler.metrics()['stage']['waiting'], 0)
+            await asyncio.wait_for(wait_for_slot(), 1)
+
+        asyncio.run(run())
+
+
+if __name__ == '__main__':
+    unittest.main()
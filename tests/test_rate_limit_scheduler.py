@@ -0,0 +1,103 @@
+import threading
+import time
+import unittest
+
+from data_collect.repo_collector.github_api import RateLimitScheduler, rate_limit_resource
+
+
+def headers(remaining, reset, resource=None):
+    result = {'X-RateLimit-Remaining': str(remaining), 'X-RateLimit-Reset': str(int(reset))}
+    if resource:
+        result['X-RateLimit-Resource'] = resource
+    return result
+
+
+class RateLimitSchedulerTest(unittest.TestCase):
+
+    def test_resources_of_urls(self):
+        self.assertEqual(rate_limit_resource('https://api.github.com/search/repositories'), 'search')
+        self.assertEqual(rate_limit_resource('https://api.github.com/graphql'), 'graphql')
+        self.assertEqual(rate_limit_resource('https://api.github.com/repos/a/b'), 'core')
+
+    def test_requests_go_out_while_quota_is_left(self):
+        scheduler = RateLimitScheduler()
+        scheduler.acquire('search')
+        scheduler.update('search', headers(3, time.time() + 60))
+        for _ in range(3):
+            scheduler.acquire('search')
+        self.assertEqual(scheduler.snapshot()['search']['remaining'], 0)
+        self.assertEqual(scheduler.waited_seconds, 0)
+
+    def test_used_up_quota_waits_for_the_next_window(self):
+        scheduler = RateLimitScheduler()
+        scheduler.update('core', headers(0, time.time() + 60))
+        released = threading.Event()
+
+        def acquire():
+            scheduler.acquire('core')
+            released.set()
+        threading.Thread(target=acquire, daemon=True).start()
+        self.assertFalse(released.wait(0.3))
+        # the answer of a request of the next window wakes the waiters up
+        scheduler.update('core', headers(4999, time.time() + 3660))
+        self.assertTrue(released.wait(2))
+        self.assertGreater(scheduler.waited_seconds, 0)
+
+    def test_passed_reset_starts_a_new_window(self):
+        scheduler = RateLimitScheduler()
+        scheduler.update('core', headers(0, time.time() - 1))
+        started = time.time()
+        scheduler.acquire('core')
+        self.assertLess(time.time() - started, 0.1)
+        self.assertIsNone(scheduler.snapshot()['core']['remaining'])
+
+    def test_out_of_order_answers_keep_the_lowest_remaining(self):
+        scheduler = RateLimitScheduler()
+        reset = time.time() + 60
+        scheduler.update('search', headers(10, reset))
+        scheduler.update('search', headers(25, reset))
+        self.assertEqual(scheduler.snapshot()['search']['remaining'], 10)
+        # a new window
+        scheduler.update('search', headers(29, reset + 60))
+        self.assertEqual(scheduler.snapshot()['search']['remaining'], 29)
+
+    def test_resource_header_overrides_the_guess(self):
+        scheduler = RateLimitScheduler()
+        scheduler.update('core', headers(5, time.time() + 60, resource='code_search'))
+        self.assertEqual(scheduler.snapshot()['code_search']['remaining'], 5)
+        self.assertNotIn('core', scheduler.snapshot())
+
+    def test_refund_and_pause(self):
+        scheduler = RateLimitScheduler()
+        scheduler.update('core', headers(1, time.time() + 60))
+        scheduler.acquire('core')
+        scheduler.refund('core')
+        self.assertEqual(scheduler.snapshot()['core']['remaining'], 1)
+        scheduler.pause('graphql', 30)
+        state = scheduler.snapshot()['graphql']
+        self.assertEqual(state['remaining'], 0)
+        self.assertGreater(state['reset'], time.time() + 25)
+
+    def test_reserve_and_min_interval(self):
+        scheduler = RateLimitScheduler(reserve=2, min_intervals={'search': 0.1})
+        scheduler.update('search', headers(4, time.time() + 60))
+        started = time.time()
+        scheduler.acquire('search')
+        scheduler.acquire('search')
+        self.assertGreaterEqual(time.time() - started, 0.09)
+        self.assertEqual(scheduler.snapshot()['search']['remaining'], 2)
+
+        # at the reserve, requests wait for the reset
+        released = threading.Event()
+
+        def acquire():
+            scheduler.acquire('search')
+            released.set()
+        threading.Thread(target=acquire, daemon=True).start()
+        self.assertFalse(released.wait(0.3))
+        scheduler.update('search', headers(30, time.time() + 120))
+        self.assertTrue(released.wait(2))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,165 @@
+import random
+import threading
+import time
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+
+from data_collect.repo_collector import collect_info
+from data_collect.repo_collector.collect_info import (EPOCH, MIN_WINDOW, SEARCH_RESULT_CAP, WINDOW_LADDER,
+                                                      SearchWindowCrawler, aligned_window, split_window)
+
+
+START = datetime(2024, 1, 1)
+END = datetime(2024, 1, 11)
+PER_PAGE = 100
+
+
+def offset(moment):
+    return (moment - EPOCH).total_seconds()
+
+
+def make_repos(seed=7):
+    # 20 repos a day, and 3000 on the third day, which needs splitting
+    rng = random.Random(seed)
+    created = []
+    for day in range(10):
+        count = 3000 if day == 2 else 20
+        created.extend(START + timedelta(days=day, seconds=rng.randrange(86400)) for _ in range(count))
+    return [{'id': i, 'created_at': moment} for i, moment in enumerate(sorted(created))]
+
+
+class FakeSearch(object):
+    # answers like the search api: the total count of a window and one page of at most the first 1000 results
+    def __init__(self, repos, failures=None, jitter=0):
+        self._repos = repos
+        # (window, page) -> times it fails before answering, -1 for always
+        self._failures = dict(failures or {})
+        self._jitter = jitter
+        self._lock = threading.Lock()
+        self.queries = []
+
+    def __call__(self, window, page, **kwargs):
+        if self._jitter:
+            time.sleep(random.random() * self._jitter)
+        with self._lock:
+            self.queries.append((window, page))
+            failures = self._failures.get((window, page), 0)
+            if failures:
+                self._failures[(window, page)] = failures - 1
+                return None
+        matches = [repo for repo in self._repos if window[0] <= repo['created_at'] < window[1]]
+        reachable = matches[:SEARCH_RESULT_CAP]
+        return len(matches), reachable[(page - 1) * kwargs['per_page']:page * kwargs['per_page']]
+
+
+class WindowTest(unittest.TestCase):
+
+    def test_aligned_window_takes_the_largest_fitting_ladder_size(self):
+        # 2024-01-02 is 4 * 4931 days after the epoch, 2024-01-01 an odd number of days
+        second = START + timedelta(days=1)
+        self.assertEqual(aligned_window(second, END, 86400 * 3), (second, second + timedelta(days=2)))
+        self.assertEqual(aligned_window(second, END, 86400 * 5), (second, second + timedelta(days=4)))
+        self.assertEqual(aligned_window(START, END, 86400 * 5), (START, START + timedelta(days=1)))
+        self.assertEqual(aligned_window(START, END, 7200), (START, START + timedelta(hours=1)))
+        # never past the end of the range
+        self.assertEqual(aligned_window(START, START + timedelta(hours=5), 86400),
+                         (START, START + timedelta(hours=3)))
+
+    def test_aligned_window_starts_on_its_own_grid(self):
+        for target in (60, 3600, 86400, 86400 * 8):
+            cursor = START
+            while cursor < END:
+                window = aligned_window(cursor, END, target)
+                size = (window[1] - window[0]).total_seconds()
+                self.assertIn(size, WINDOW_LADDER)
+                self.assertEqual(offset(window[0]) % size, 0)
+                self.assertLessEqual(size, max(target, WINDOW_LADDER[0]))
+                cursor = window[1]
+            self.assertEqual(cursor, END)
+
+    def test_aligned_window_off_the_grid(self):
+        start = START + timedelta(seconds=30)
+        self.assertEqual(aligned_window(start, END, 86400), (start, start + MIN_WINDOW))
+        self.assertEqual(aligned_window(start, start + timedelta(seconds=10), 86400),
+                         (start, start + timedelta(seconds=10)))
+
+    def test_split_window_covers_the_window_in_aligned_parts(self):
+        window = (START, START + timedelta(days=1))
+        for total_count in (1001, 2600, 50000):
+            parts = split_window(window, total_count)
+            self.assertGreaterEqual(len(parts), 2)
+            self.assertEqual(parts[0][0], window[0])
+            self.assertEqual(parts[-1][1], window[1])
+            target = 86400 / max(2, -(-total_count // (SEARCH_RESULT_CAP * collect_info.WINDOW_FILL)))
+            for part, following in zip(parts, parts[1:]):
+                self.assertEqual(part[1], following[0])
+            for part in parts:
+                size = (part[1] - part[0]).total_seconds()
+                self.assertLessEqual(size, max(target, WINDOW_LADDER[0]))
+                self.assertEqual(offset(part[0]) % size, 0)
+
+
+class SearchWindowCrawlerTest(unittest.TestCase):
+
+    def crawl(self, search, concurrency=4):
+        crawler = SearchWindowCrawler(START, END, timedelta(days=1), concurrency=concurrency,
+                                      per_page=PER_PAGE, language='JavaScript', kw='react', star=10)
+        with mock.patch.object(collect_info, 'fetch_search_page', search):
+            repos = crawler.crawl()
+        return crawler, repos
+
+    def test_finds_every_repo_and_splits_dense_windows(self):
+        repos = make_repos()
+        search = FakeSearch(repos)
+        crawler, found = self.crawl(search)
+        self.assertEqual(sorted(repo['id'] for repo in found), [repo['id'] for repo in repos])
+        self.assertGreater(crawler.stats['splits'], 0)
+        self.assertEqual(crawler.stats['truncated_windows'], 0)
+        self.assertEqual(crawler.stats['failed_windows'], 0)
+        self.assertEqual(crawler.stats['requests'], len(search.queries))
+        # the whole range is queried
+        first_pages = sorted({window for window, page in search.queries if page == 1})
+        self.assertEqual(first_pages[0][0], START)
+        self.assertEqual(max(window[1] for window in first_pages), END)
+
+    def test_sparse_periods_are_crawled_in_wide_windows(self):
+        repos = [repo for repo in make_repos() if repo['created_at'].day != 3]
+        search = FakeSearch(repos)
+        crawler, found = self.crawl(search)
+        self.assertEqual(len(found), len(repos))
+        # 180 repos over 10 days fit in few requests once the windows widen
+        self.assertLess(crawler.stats['requests'], 10)
+
+    def test_queries_do_not_depend_on_answer_order(self):
+        repos = make_repos()
+        runs = []
+        for seed in range(3):
+            random.seed(seed)
+            search = FakeSearch(repos, jitter=0.002)
+            self.crawl(search)
+            runs.append(sorted(search.queries))
+        self.assertEqual(runs[0], runs[1])
+        self.assertEqual(runs[0], runs[2])
+
+    def test_failed_pages_are_retried(self):
+        repos = make_repos()
+        first = (START, START + timedelta(days=1))
+        crawler, found = self.crawl(FakeSearch(repos, failures={(first, 1): 2}))
+        self.assertEqual(len(found), len(repos))
+        self.assertEqual(crawler.stats['retried_pages'], 2)
+        self.assertEqual(crawler.failed_pages, [])
+
+    def test_pages_failing_every_retry_are_reported(self):
+        repos = make_repos()
+        first = (START, START + timedelta(days=1))
+        crawler, found = self.crawl(FakeSearch(repos, failures={(first, 1): -1}))
+        self.assertEqual(crawler.failed_pages, [(first, 1)])
+        self.assertEqual(crawler.stats['failed_windows'], 1)
+        self.assertEqual(crawler.stats['retried_pages'], collect_info.SEARCH_PAGE_RETRIES)
+        missing = {repo['id'] for repo in repos if first[0] <= repo['created_at'] < first[1]}
+        self.assertEqual({repo['id'] for repo in found}, {repo['id'] for repo in repos} - missing)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,209 @@
+import argparse
+import json
+import os
+import time
+from threading import Lock
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+SHARD_PREFIX = 'bundles-'
+SHARD_EXTENSIONS = {'none': '.jsonl', 'zstd': '.jsonl.zst'}
+INDEX_EXTENSION = '.idx'
+BUNDLE_SUFFIX = '_bundled.json'
+
+
+def shard_codec(shard_path):
+    return 'zstd' if shard_path.endswith(SHARD_EXTENSIONS['zstd']) else 'none'
+
+
+class BundleStoreWriter():
+    """
+    Appends distilled bundles to sharded JSONL files, one `{"repo", "component", "bundle"}`
+    record per line. With the zstd codec every record is its own zstd frame, so a record
+    can still be decompressed alone while the shard stays one valid zstd stream.
+
+    Every shard has a sidecar `<shard>.idx` with one `{"repo", "component", "offset", "length"}`
+    line per record, written after the record itself: a crash loses at most the last
+    record, never the index entries of the records before it.
+    Each writer (one per process) opens its own shards, and threads share a writer.
+    """
+
+    def __init__(self, path, codec='none', max_shard_bytes=256 * 1024 * 1024):
+        if codec not in SHARD_EXTENSIONS:
+            raise ValueError(f"Unknown bundle store codec {codec}")
+        if codec == 'zstd' and zstandard is None:
+            raise ImportError(
+                "the zstd bundle store codec needs the zstandard package: pip install zstandard")
+        self._path = path
+        self._codec = codec
+        self._max_shard_bytes = max_shard_bytes
+        self._compressor = zstandard.ZstdCompressor() if codec == 'zstd' else None
+        self._lock = Lock()
+        self._shard = None
+        self._index = None
+        self._shard_count = 0
+        os.makedirs(path, exist_ok=True)
+
+    def _open_shard(self):
+        self.close()
+        # time first so that the index of a later run overrides the one of an earlier run
+        name = f'{SHARD_PREFIX}{int(time.time() * 1000):015d}-{os.getpid()}-{self._shard_count:05d}'
+        self._shard_count += 1
+        shard_path = os.path.join(
+            self._path, name + SHARD_EXTENSIONS[self._codec])
+        self._shard = open(shard_path, 'ab')
+        self._index = open(shard_path + INDEX_EXTENSION, 'a')
+
+    def append(self, repo, component, bundle):
+        record = json.dumps({'repo': repo, 'component': component, 'bundle': bundle},
+                            ensure_ascii=False).encode('utf-8') + b'\n'
+        if self._compressor:
+            record = self._compressor.compress(record)
+        with self._lock:
+            if self._shard is None or self._shard.tell() >= self._max_shard_bytes:
+                self._open_shard()
+            offset = self._shard.tell()
+            self._shard.write(record)
+            self._shard.flush()
+            self._index.write(json.dumps({'repo': repo, 'component': component,
+                                          'offset': offset, 'length': len(record)}) + '\n')
+            self._index.flush()
+
+    def close(self):
+        if self._shard:
+            self._shard.close()
+            self._index.close()
+            self._shard = None
+            self._index = None
+
+
+class BundleStore():
+    """
+    Read side of a bundle store: loads every sidecar index once and then reads a bundle
+    with one seek by (repo, component), where component is the bundle filename
+    (e.g. `Header_bundled.json`). A component stored more than once resolves to the
+    latest record.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._entries = {}
+        self._files = {}
+        self._lock = Lock()
+        self._decompressor = None
+        self._load()
+
+    def _load(self):
+        if not os.path.isdir(self._path):
+            raise FileNotFoundError(f"Bundle store {self._path} does not exist")
+        for filename in sorted(os.listdir(self._path)):
+            if not (filename.startswith(SHARD_PREFIX) and filename.endswith(INDEX_EXTENSION)):
+                continue
+            shard_path = os.path.join(
+                self._path, filename[:-len(INDEX_EXTENSION)])
+            if not os.path.exists(shard_path):
+                continue
+            shard_size = os.path.getsize(shard_path)
+            with open(os.path.join(self._path, filename), 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # torn last line of a crashed writer
+                        continue
+                    if entry['offset'] + entry['length'] > shard_size:
+                        continue
+                    self._entries[(entry['repo'], entry['component'])] = (
+                        shard_path, entry['offset'], entry['length'])
+        if any(shard_codec(shard_path) == 'zstd' for shard_path, _, _ in self._entries.values()):
+            if zstandard is None:
+                raise ImportError(
+                    f"{self._path} holds zstd shards, install the zstandard package to read it")
+            self._decompressor = zstandard.ZstdDecompressor()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def repos(self):
+        return sorted({repo for repo, _ in self._entries})
+
+    def components(self, repo):
+        return sorted(component for entry_repo, component in self._entries if entry_repo == repo)
+
+    def _read(self, shard_path, offset, length):
+        with self._lock:
+            f = self._files.get(shard_path)
+            if f is None:
+                f = self._files[shard_path] = open(shard_path, 'rb')
+            f.seek(offset)
+            record = f.read(length)
+        if shard_codec(shard_path) == 'zstd':
+            record = self._decompressor.decompress(record)
+        return json.loads(record)['bundle']
+
+    def get(self, repo, component, default=None):
+        entry = self._entries.get((repo, component))
+        if entry is None:
+            return default
+        return self._read(*entry)
+
+    def items(self):
+        # (repo, component, bundle) in shard order, each shard read front to back
+        for (repo, component), entry in sorted(self._entries.items(), key=lambda item: item[1]):
+            yield repo, component, self._read(*entry)
+
+    def close(self):
+        with self._lock:
+            for f in self._files.values():
+                f.close()
+            self._files = {}
+
+
+def pack_bundle_dir(bundle_dir, store_path, codec='none'):
+    """Append every `<repo>/<component>_bundled.json` of a bundle folder to a store."""
+    writer = BundleStoreWriter(store_path, codec=codec)
+    count = 0
+    try:
+        for repo in sorted(os.listdir(bundle_dir)):
+            repo_dir = os.path.join(bundle_dir, repo)
+            if not os.path.isdir(repo_dir):
+                continue
+            for component in sorted(os.listdir(repo_dir)):
+                if not component.endswith(BUNDLE_SUFFIX):
+                    continue
+                try:
+                    with open(os.path.join(repo_dir, component), 'r') as f:
+                        bundle = json.load(f)
+                except (OSError, ValueError) as e:
+                    print(f"Skipping {os.path.join(repo_dir, component)}: {e}")
+                    continue
+                writer.append(repo, component, bundle)
+                count += 1
+    finally:
+        writer.close()
+    return count
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pack', type=str,
+                        help='bundle folder (<repo>/<component>_bundled.json) to append to the store')
+    parser.add_argument('--store', type=str)
+    parser.add_argument('--codec', type=str, default='none',
+                        choices=list(SHARD_EXTENSIONS))
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.pack:
+        print(f'packed {pack_bundle_dir(args.pack, args.store, args.codec)} bundles into {args.store}')
+    store = BundleStore(args.store)
+    print(f'{len(store)} bundles of {len(store.repos())} repos in {args.store}')
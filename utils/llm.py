@@ -1,8 +1,18 @@
+import asyncio
+import json
 import os
+import threading
 import time
-from openai import OpenAI
+from openai import APIConnectionError, AsyncOpenAI, DefaultAsyncHttpxClient
 import re
 from dotenv import load_dotenv
+from utils.llm_budget import BUDGET_HARD, BUDGET_OK, TokenBudget
+from utils.llm_cache import content_hash
+from utils.llm_metrics import OUTPUT_LEN_LIMIT, MetricsExporter, TokenAccounting, current_labels
+from utils.llm_replay import LLMRecorder
+from utils.llm_rate_limit import AIMDLimiter, TokenBucket, backoff_delay, parse_retry_after
+from utils.llm_scheduler import StageScheduler
+from utils.util import estimate_token_count
 
 load_dotenv()
 
@@ -37,13 +47,36 @@ BAD_REQUEST_ERROR = 400
 UNAUTHORIZED_ERROR = 401
 FORBIDDEN_ERROR = 403
 MAX_LENGTH_EXCEEDED_ERROR = 406
+RATE_LIMIT_ERROR = 429  # retry
 INTERNAL_SERVER_ERROR = 500  # retry
 BAD_GATEWAY_ERROR = 502
 SERVICE_UNAVAILABLE_ERROR = 503
 GATEWAT_TIMEOUT_ERROR = 504  # retry
+BUDGET_EXCEEDED_ERROR = 997  # refused by the token budget, terminate
 SKIP_ERROR = 998
 UNKNOWN_ERROR = 999
 
+# requests in flight over all endpoints, unless LLM_MAX_CONCURRENCY says otherwise
+DEFAULT_MAX_CONCURRENCY = 64
+RETRY_ERROR_CODES = (RATE_LIMIT_ERROR, INTERNAL_SERVER_ERROR, BAD_GATEWAY_ERROR,
+                     SERVICE_UNAVAILABLE_ERROR, GATEWAT_TIMEOUT_ERROR, MAX_LENGTH_EXCEEDED_ERROR)
+# scheduling of the prompt templates sharing the concurrency limit (see StageScheduler),
+# short pipeline-blocking classifications get a larger share and a deadline
+DEFAULT_STAGES = {
+    'react_identification': {'weight': 4, 'deadline': 30},
+    'filter_repo': {'weight': 4, 'deadline': 30},
+}
+# estimated prompt tokens from which a request counts as a long generation
+LONG_REQUEST_TOKENS = 2000
+# only requests this deterministic share an upstream call with an identical one in flight
+COALESCE_MAX_TEMPERATURE = 0.1
+# how much of a cut off answer is sent back to continue it
+CONTINUATION_TAIL_CHARS = 2000
+CONTINUE_PROMPT = 'Your previous answer was cut off at the output limit, it ends with the text above. Continue exactly where it stops: do not repeat anything already written and do not add any comment.'
+# errors that count against the health of the endpoint (besides connection errors and timeouts)
+ENDPOINT_ERROR_CODES = (INTERNAL_SERVER_ERROR, BAD_GATEWAY_ERROR,
+                        SERVICE_UNAVAILABLE_ERROR, GATEWAT_TIMEOUT_ERROR)
+
 
 def extract_error_code(error_message):
     match = re.search(r'Error code: (\d+)', error_message)
@@ -55,23 +88,514 @@ def extract_error_code(error_message):
         return UNKNOWN_ERROR
 
 
+def closed_fence_end(content, inside_fence=False):
+    # end of the line closing the first ``` block of content (or the one already open), None while unclosed
+    position = 0
+    for line in content.splitlines(keepends=True):
+        if line.lstrip().startswith('```'):
+            if inside_fence:
+                return position + len(line)
+            inside_fence = True
+        position += len(line)
+    return None
+
+
+def has_open_fence(content):
+    return sum(1 for line in content.splitlines() if line.lstrip().startswith('```')) % 2 == 1
+
+
+def is_truncated(response):
+    if response.get('finish_reason'):
+        return response['finish_reason'] == 'length'
+    return response['output_token_len'] >= OUTPUT_LEN_LIMIT
+
+
+def merge_continuation(result, continuation):
+    # drop the part of the continuation that repeats the end of the result
+    for overlap in range(min(len(result), len(continuation), CONTINUATION_TAIL_CHARS), 0, -1):
+        if result.endswith(continuation[:overlap]):
+            return result + continuation[overlap:]
+    return result + continuation
+
+
+def create_http_client(max_connections):
+    # one pooled http client per endpoint, sized to the endpoint's concurrency
+    try:
+        import httpx
+    except ImportError:
+        # the sdk falls back to its own pooled client
+        return None
+    return DefaultAsyncHttpxClient(limits=httpx.Limits(
+        max_connections=max_connections, max_keepalive_connections=max_connections))
+
+
+def load_json_config(value):
+    # LLM_ENDPOINTS / LLM_STAGES hold json, or the path of a json file holding it
+    if not value:
+        return None
+    if os.path.exists(value):
+        with open(value, 'r') as f:
+            return json.load(f)
+    return json.loads(value)
+
+
+class LLMEndpoint(object):
+    """
+    One chat completion endpoint and its routing state: the requests routed to it and not
+    finished yet, an EWMA of its latency, and a circuit breaker. The circuit opens after
+    `failure_threshold` consecutive connection errors, timeouts or 5xx, keeps the endpoint
+    out of rotation for `reset_timeout` seconds, and then lets one probe request through
+    (half open) whose outcome closes or reopens it.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, key, base_url, model_name, max_concurrency=DEFAULT_MAX_CONCURRENCY, weight=1, fallback=False,
+                 timeout=None, failure_threshold=5, reset_timeout=30, ewma_alpha=0.2):
+        if weight <= 0:
+            raise ValueError(f"weight of endpoint {base_url} must be positive")
+        self.key = key
+        self.base_url = base_url
+        self.model_name = model_name
+        self.max_concurrency = max_concurrency
+        self.weight = weight
+        # fallback endpoints only take requests while no primary one is available
+        self.fallback = fallback
+        self.timeout = timeout
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.ewma_alpha = ewma_alpha
+        self.outstanding = 0
+        self.latency_ewma = None
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0
+        self.probing = False
+        self.requests = 0
+        self.failures = 0
+        # created on the event loop that uses them
+        self.client = None
+        self.semaphore = None
+
+    def reopens_at(self):
+        if self.state == self.OPEN:
+            return self.opened_at + self.reset_timeout
+        if self.state == self.HALF_OPEN and self.probing:
+            # poll again shortly, the probe decides
+            return time.monotonic() + 1
+        return 0
+
+    def available(self, now):
+        if self.state == self.CLOSED:
+            return True
+        return not self.probing and now >= self.reopens_at()
+
+    def score(self):
+        # least outstanding requests, scaled by latency and weight; unmeasured endpoints go first
+        return (self.outstanding + 1) * (self.latency_ewma or 1.0) / self.weight
+
+    def dispatch(self):
+        self.outstanding += 1
+        self.requests += 1
+        if self.state != self.CLOSED:
+            self.state = self.HALF_OPEN
+            self.probing = True
+
+    def finish(self, success, latency=None, endpoint_failure=False):
+        self.outstanding -= 1
+        if latency is not None:
+            self.latency_ewma = latency if self.latency_ewma is None else \
+                self.ewma_alpha * latency + (1 - self.ewma_alpha) * self.latency_ewma
+        self.probing = False
+        if success or not endpoint_failure:
+            # any answer, even an error about the request itself, means the endpoint is up
+            self.consecutive_failures = 0
+            self.state = self.CLOSED
+            return
+        self.failures += 1
+        self.consecutive_failures += 1
+        if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                print(f'circuit of llm endpoint {self.base_url} opened')
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+    def metrics(self):
+        return {
+            'state': self.state,
+            'weight': self.weight,
+            'fallback': self.fallback,
+            'outstanding': self.outstanding,
+            'latency_ewma': self.latency_ewma,
+            'requests': self.requests,
+            'failures': self.failures,
+        }
+
+
+class AsyncLLMChat(object):
+    """
+    asyncio client of a pool of chat completion endpoints. Each request goes to the available
+    endpoint with the lowest LLMEndpoint.score (fallback endpoints only when no primary one is
+    available), and a request failing on an endpoint is retried right away on another one
+    if there is one. Every endpoint keeps one pooled client,
+    and requests are bounded by a global AIMD concurrency limit (at most `max_concurrency`,
+    halved on 429 and ramped up again on success) and by the limit of their endpoint, so
+    callers can submit any number of requests without a thread each. Requests also draw
+    from shared requests-per-minute and tokens-per-minute buckets (0 disables them), and
+    retryable errors back off exponentially with jitter, honoring Retry-After.
+
+    `chat_sync` runs a request on a background event loop and blocks until it is done,
+    which keeps the blocking interface of LLMChat.chat for threaded callers. The loop,
+    clients and semaphores are recreated in a forked child process.
+    """
+
+    def __init__(self, endpoints, max_concurrency=DEFAULT_MAX_CONCURRENCY, on_usage=None, on_failure=None, rpm=0, tpm=0,
+                 coalesce=True, recorder=None, stages=None, long_request_tokens=LONG_REQUEST_TOKENS, token_capacity=0,
+                 admit=None):
+        self._endpoints = list(endpoints)
+        self._max_concurrency = max_concurrency
+        self._on_usage = on_usage
+        self._on_failure = on_failure
+        self._coalesce = coalesce
+        self._recorder = recorder
+        # admit(labels, estimated input tokens) -> None, or why the request is refused
+        self._admit = admit
+        self._stages = dict(DEFAULT_STAGES, **(stages or {}))
+        self._long_request_tokens = long_request_tokens
+        self._token_capacity = token_capacity
+        self._scheduler = None
+        # single-flight: key of a deterministic request -> its task, while in flight
+        self._in_flight = {}
+        self._rpm = rpm
+        self._tpm = tpm
+        self._limiter = None
+        self._request_bucket = None
+        self._token_bucket = None
+        self._metrics = {
+            'requests': 0,
+            'succeeded': 0,
+            'throttled': 0,
+            'retries': 0,
+            'concurrency_decreases': 0,
+            'backoff_seconds': 0,
+            'rate_limit_wait_seconds': 0,
+            'failovers': 0,
+            'stopped_at_fence': 0,
+            'coalesced': 0,
+            'budget_refused': 0,
+        }
+        self._loop = None
+        self._loop_thread = None
+        self._loop_pid = None
+        self._loop_lock = threading.Lock()
+
+    @property
+    def endpoints(self):
+        return list(self._endpoints)
+
+    def _connect(self):
+        # runs on the event loop thread
+        # tasks of the loop of a parent process never finish here
+        self._in_flight = {}
+        self._limiter = AIMDLimiter(self._max_concurrency)
+        self._scheduler = StageScheduler(self._limiter, self._stages, long_request_tokens=self._long_request_tokens,
+                                         token_capacity=self._token_capacity)
+        self._request_bucket = TokenBucket(self._rpm)
+        self._token_bucket = TokenBucket(self._tpm)
+        for endpoint in self._endpoints:
+            # retries are ours, so the sdk does not back off a second time
+            options = {'timeout': endpoint.timeout} if endpoint.timeout else {}
+            endpoint.client = AsyncOpenAI(api_key=endpoint.key, base_url=endpoint.base_url, max_retries=0,
+                                          http_client=create_http_client(endpoint.max_concurrency), **options)
+            endpoint.semaphore = asyncio.Semaphore(endpoint.max_concurrency)
+
+    def _ensure_loop(self):
+        with self._loop_lock:
+            if self._loop is not None and self._loop_pid == os.getpid():
+                return self._loop
+            loop = asyncio.new_event_loop()
+            ready = threading.Event()
+
+            def run_loop():
+                asyncio.set_event_loop(loop)
+                loop.call_soon(ready.set)
+                loop.run_forever()
+
+            self._loop_thread = threading.Thread(
+                target=run_loop, name='llm-event-loop', daemon=True)
+            self._loop_thread.start()
+            ready.wait()
+            asyncio.run_coroutine_threadsafe(
+                self._connect_async(), loop).result()
+            self._loop = loop
+            self._loop_pid = os.getpid()
+            return loop
+
+    async def _connect_async(self):
+        self._connect()
+
+    def select_endpoint(self, exclude=None):
+        """The endpoint for the next request, and how long to wait before sending it."""
+        now = time.monotonic()
+        for fallback in (False, True):
+            candidates = [endpoint for endpoint in self._endpoints
+                          if endpoint.fallback == fallback and endpoint is not exclude and endpoint.available(now)]
+            if candidates:
+                return min(candidates, key=lambda endpoint: endpoint.score()), 0
+        if exclude is not None:
+            return None, 0
+        # every circuit is open: wait for the first one to let a probe through
+        endpoint = min(self._endpoints,
+                       key=lambda endpoint: endpoint.reopens_at())
+        return endpoint, max(0, endpoint.reopens_at() - now)
+
+    def metrics(self):
+        metrics = dict(self._metrics)
+        if self._limiter is not None:
+            metrics['concurrency_limit'] = self._limiter.limit
+            metrics['in_flight'] = self._scheduler.in_flight
+            if self._request_bucket.enabled:
+                metrics['rpm_available'] = int(self._request_bucket.level)
+            if self._token_bucket.enabled:
+                metrics['tpm_available'] = int(self._token_bucket.level)
+        if self._scheduler is not None:
+            metrics['stages'] = self._scheduler.metrics()
+        metrics['endpoints'] = {endpoint.base_url: endpoint.metrics()
+                                for endpoint in self._endpoints}
+        return metrics
+
+    async def chat(self, prompt, chat_hist=[], temp=0.1, labels=None, stream=False, stop_at_fence=False, inside_fence=False):
+        """
+        With `stream` the answer is read as it is generated, recording the time to its first
+        token and per output token, and with `stop_at_fence` the stream is closed as soon as
+        the first code block is closed (`inside_fence`: the block was opened by an earlier
+        answer this one continues).
+
+        Deterministic requests (temperature up to COALESCE_MAX_TEMPERATURE) are single-flight:
+        a request identical to one in flight waits for that one's response instead of sending
+        its own.
+        """
+        # labels are taken from the calling thread by chat_sync, the loop thread has its own context
+        labels = labels or current_labels()
+        if not self._coalesce or temp > COALESCE_MAX_TEMPERATURE:
+            return await self._chat(prompt, chat_hist, temp, labels, stream, stop_at_fence, inside_fence)
+
+        # the temperature is part of the key, a 0.0 request does not take the answer of a 0.1 one
+        key = content_hash(chat_hist, prompt, temp, stop_at_fence, inside_fence)
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._chat(
+                prompt, chat_hist, temp, labels, stream, stop_at_fence, inside_fence))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        else:
+            self._metrics['coalesced'] += 1
+        # shielded, a cancelled caller does not cancel the request of the others
+        result = await asyncio.shield(task)
+        return dict(result)
+
+    async def _chat(self, prompt, chat_hist, temp, labels, stream, stop_at_fence, inside_fence):
+        if self._limiter is None:
+            self._connect()
+        messages = chat_hist + [
+            {'role': 'user', 'content': prompt}
+        ]
+        # the token bucket is charged the estimated input up front and settled with the usage
+        estimated_tokens = estimate_token_count(
+            '\n'.join(message.get('content') or '' for message in messages))
+        if self._admit and self._admit(labels, estimated_tokens):
+            self._metrics['budget_refused'] += 1
+            return {
+                "content": None,
+                "error_code": BUDGET_EXCEEDED_ERROR,
+                "output_token_len": 0
+            }
+
+        max_retries = 5  # Number of retries
+
+        for attempt in range(max_retries):
+            endpoint, wait = self.select_endpoint()
+            if wait:
+                self._metrics['backoff_seconds'] += wait
+                await asyncio.sleep(wait)
+            self._metrics['rate_limit_wait_seconds'] += await self._request_bucket.acquire(1)
+            self._metrics['rate_limit_wait_seconds'] += await self._token_bucket.acquire(estimated_tokens)
+            endpoint = None
+            finished = False
+            try:
+                # the slots are only held while the request is in flight, not while backing off,
+                # and handed out by stage (prompt template) and estimated size
+                async with self._scheduler.slot(labels[1], estimated_tokens):
+                    # picked once a slot is free, so queued requests see the current endpoint health
+                    endpoint, _ = self.select_endpoint()
+                    endpoint.dispatch()
+                    async with endpoint.semaphore:
+                        self._metrics['requests'] += 1
+                        start_time = time.monotonic()
+                        if stream:
+                            result = await self._read_stream(
+                                endpoint, messages, temp, stop_at_fence, inside_fence, estimated_tokens)
+                        else:
+                            response = await endpoint.client.chat.completions.create(
+                                model=endpoint.model_name,
+                                messages=messages,
+                                temperature=temp,
+                                stream=False
+                            )
+                            result = {
+                                "content": response.choices[0].message.content,
+                                "error_code": 200,
+                                "output_token_len": response.usage.completion_tokens,
+                                "input_token_len": response.usage.prompt_tokens,
+                                "finish_reason": response.choices[0].finish_reason,
+                            }
+
+                latency = time.monotonic() - start_time
+                endpoint.finish(True, latency=latency)
+                finished = True
+                self._limiter.on_success()
+                # the limit may have grown by a slot
+                self._scheduler.dispatch()
+                self._metrics['succeeded'] += 1
+                if self._recorder:
+                    self._recorder.record(
+                        messages, temp, endpoint.model_name, result, latency)
+                input_tokens = result.pop('input_token_len')
+                self._token_bucket.debit(
+                    input_tokens + result['output_token_len'] - estimated_tokens)
+                if self._on_usage:
+                    self._on_usage(input_tokens, result['output_token_len'], labels=labels, endpoint=endpoint.base_url,
+                                   latency=latency, ttft=result.get('ttft'), tpot=result.get('tpot'))
+
+                return result
+            except asyncio.CancelledError:
+                if endpoint is not None and not finished:
+                    endpoint.finish(False)
+                raise
+            except Exception as e:
+                error_code = extract_error_code(str(e))
+                print(
+                    f"Attempt {attempt+1} on {endpoint.base_url if endpoint else '-'} failed: {e}, error code: {error_code}")
+                connection_error = isinstance(e, APIConnectionError)
+                endpoint_failure = connection_error or error_code in ENDPOINT_ERROR_CODES
+                if endpoint is not None and not finished:
+                    endpoint.finish(False, endpoint_failure=endpoint_failure)
+                if error_code == RATE_LIMIT_ERROR:
+                    self._metrics['throttled'] += 1
+                    if self._limiter.on_throttle():
+                        self._metrics['concurrency_decreases'] += 1
+                if error_code not in RETRY_ERROR_CODES and not connection_error:
+                    print('done chatting with http error')
+                    if self._on_failure:
+                        self._on_failure(labels=labels)
+                    return {
+                        "content": None,
+                        "error_code": error_code,
+                        "output_token_len": 0
+                    }
+                self._metrics['retries'] += 1
+                if endpoint_failure and self.select_endpoint(exclude=endpoint)[0] is not None:
+                    # another endpoint can take it now, no reason to wait on this one
+                    self._metrics['failovers'] += 1
+                    continue
+                delay = backoff_delay(
+                    attempt, retry_after=parse_retry_after(e))
+                self._metrics['backoff_seconds'] += delay
+                await asyncio.sleep(delay)
+        if self._on_failure:
+            self._on_failure(labels=labels)
+        return {
+            "content": None,
+            "error_code": 403,
+            "output_token_len": 0
+        }
+
+    async def _read_stream(self, endpoint, messages, temp, stop_at_fence, inside_fence, estimated_tokens):
+        start_time = time.monotonic()
+        first_token_time = None
+        parts = []
+        usage = None
+        finish_reason = None
+        stream = await endpoint.client.chat.completions.create(
+            model=endpoint.model_name,
+            messages=messages,
+            temperature=temp,
+            stream=True,
+            stream_options={'include_usage': True}
+        )
+        try:
+            async for chunk in stream:
+                if chunk.usage:
+                    usage = chunk.usage
+                if not chunk.choices:
+                    continue
+                choice = chunk.choices[0]
+                if choice.finish_reason:
+                    finish_reason = choice.finish_reason
+                delta = choice.delta.content if choice.delta else None
+                if not delta:
+                    continue
+                if first_token_time is None:
+                    first_token_time = time.monotonic()
+                parts.append(delta)
+                if stop_at_fence and '`' in delta:
+                    content = ''.join(parts)
+                    end = closed_fence_end(content, inside_fence)
+                    if end is not None:
+                        # everything after the block would be thrown away by the caller anyway
+                        parts = [content[:end]]
+                        finish_reason = 'stop_at_fence'
+                        self._metrics['stopped_at_fence'] += 1
+                        break
+        finally:
+            await stream.close()
+        end_time = time.monotonic()
+
+        content = ''.join(parts)
+        # a stream closed early has no usage chunk
+        output_tokens = usage.completion_tokens if usage else estimate_token_count(content)
+        return {
+            "content": content,
+            "error_code": 200,
+            "output_token_len": output_tokens,
+            "input_token_len": usage.prompt_tokens if usage else estimated_tokens,
+            "finish_reason": finish_reason,
+            "ttft": first_token_time - start_time if first_token_time else None,
+            "tpot": (end_time - first_token_time) / max(output_tokens - 1, 1) if first_token_time else None,
+        }
+
+    async def chat_many(self, requests, labels=None):
+        # requests are (prompt, chat_hist, temp[, labels]) tuples, responses come back in the same order
+        return await asyncio.gather(*[self.chat(*request[:3], labels=request[3] if len(request) > 3 else labels)
+                                      for request in requests])
+
+    def submit(self, coroutine):
+        # schedule a coroutine on the background loop, returns a concurrent.futures.Future
+        loop = self._ensure_loop()
+        if threading.current_thread() is self._loop_thread:
+            raise RuntimeError(
+                'blocking llm call from the llm event loop, await AsyncLLMChat.chat instead')
+        return asyncio.run_coroutine_threadsafe(coroutine, loop)
+
+    def chat_sync(self, prompt, chat_hist=[], temp=0.1, stream=False, stop_at_fence=False, inside_fence=False):
+        return self.submit(self.chat(prompt, chat_hist, temp, current_labels(), stream=stream,
+                                     stop_at_fence=stop_at_fence, inside_fence=inside_fence)).result()
+
+    def chat_many_sync(self, requests):
+        return self.submit(self.chat_many(requests, current_labels())).result()
+
+
 class LLMChat(object):
     def __init__(self):
         # statistics
-        self._total_input_tokens = 0
-        self._total_output_tokens = 0
-        self._total_tokens = 0
-        self._total_requests = 0
-        self._input_tokens_per_request = 0
-        self._output_tokens_per_request = 0
-        self._max_input_tokens_per_request = 0
-        self._max_output_tokens_per_request = 0
-        self._min_input_tokens_per_request = 0
-        self._min_output_tokens_per_request = 0
-        self._output_len_over_limit = 0
+        self._accounting = TokenAccounting()
+        self._exporter = None
         self._key = None
         self._model_name = ''
-        self._client = None
+        self._async_chat = None
+        self._budget = None
+        self._stream = False
         self.errors = set()  # error codes
 
     def init(self, key_info):
@@ -79,8 +603,39 @@ class LLMChat(object):
             self._key = key_info['key']
             self._model_name = key_info['model_name']
             self._base_url = key_info['base_url']
-            self._client = OpenAI(api_key=self._key,
-                                  base_url=self._base_url)
+            max_concurrency = key_info.get(
+                'max_concurrency', DEFAULT_MAX_CONCURRENCY)
+            # a pool of endpoints when given, the key/base_url pair otherwise
+            endpoints = [LLMEndpoint(
+                endpoint.get('key', self._key),
+                endpoint['base_url'],
+                endpoint.get('model_name', self._model_name),
+                max_concurrency=endpoint.get(
+                    'max_concurrency', max_concurrency),
+                weight=endpoint.get('weight', 1),
+                fallback=endpoint.get('fallback', False),
+                timeout=endpoint.get('timeout'),
+                failure_threshold=endpoint.get('failure_threshold', 5),
+                reset_timeout=endpoint.get('reset_timeout', 30)) for endpoint in key_info.get('endpoints') or []]
+            if not endpoints:
+                endpoints = [LLMEndpoint(
+                    self._key, self._base_url, self._model_name, max_concurrency)]
+            self._budget = TokenBudget(key_info['budget'], key_info.get(
+                'budget_state_path')) if key_info.get('budget') else None
+            self._async_chat = AsyncLLMChat(
+                endpoints,
+                max_concurrency=max_concurrency,
+                on_usage=self.statistics,
+                on_failure=self._accounting.record_failure,
+                rpm=key_info.get('rpm', 0),
+                tpm=key_info.get('tpm', 0),
+                coalesce=key_info.get('coalesce', True),
+                recorder=LLMRecorder(key_info['record_path']) if key_info.get('record_path') else None,
+                stages=key_info.get('stages'),
+                long_request_tokens=key_info.get(
+                    'long_request_tokens', LONG_REQUEST_TOKENS),
+                token_capacity=key_info.get('token_capacity', 0),
+                admit=self._admit if self._budget else None)
             self.init_statistics(
                 key_info['total_input_tokens'],
                 key_info['total_output_tokens'],
@@ -94,115 +649,128 @@ class LLMChat(object):
                 key_info['min_output_tokens_per_request'],
                 key_info['output_len_over_limit']
             )
+            self._stream = key_info.get('stream', False)
+            if self._exporter:
+                self._exporter.stop()
+            self._exporter = None
+            if key_info.get('metrics_path'):
+                self._exporter = MetricsExporter(
+                    key_info['metrics_path'], self.metrics_snapshot, key_info.get('metrics_interval', 60))
             self.errors.clear()
             return True
         else:
             return False
 
     def init_statistics(self, total_input_tokens, total_output_tokens, total_tokens, total_requests, input_tokens_per_request, output_tokens_per_request, max_input_tokens_per_request, max_output_tokens_per_request, min_input_tokens_per_request, min_output_tokens_per_request, output_len_over_limit):
-        self._total_input_tokens = total_input_tokens
-        self._total_output_tokens = total_output_tokens
-        self._total_tokens = total_tokens
-        self._total_requests = total_requests
-        self._input_tokens_per_request = input_tokens_per_request
-        self._output_tokens_per_request = output_tokens_per_request
-        self._max_input_tokens_per_request = max_input_tokens_per_request
-        self._max_output_tokens_per_request = max_output_tokens_per_request
-        self._min_input_tokens_per_request = min_input_tokens_per_request
-        self._min_output_tokens_per_request = min_output_tokens_per_request
-        self._output_len_over_limit = output_len_over_limit
-
-    def statistics(self, input_tokens, output_tokens):
-        self._total_input_tokens += input_tokens
-        self._total_output_tokens += output_tokens
-        if output_tokens >= 4095:
-            self._output_len_over_limit += 1
-        self._total_tokens = self._total_input_tokens + self._total_output_tokens
-        self._total_requests += 1
-        self._input_tokens_per_request = self._total_input_tokens / self._total_requests
-        self._output_tokens_per_request = self._total_output_tokens / self._total_requests
-        self._max_input_tokens_per_request = max(
-            self._max_input_tokens_per_request, input_tokens)
-        self._max_output_tokens_per_request = max(
-            self._max_output_tokens_per_request, output_tokens)
-        self._min_input_tokens_per_request = min(
-            self._min_input_tokens_per_request, input_tokens)
-        self._min_output_tokens_per_request = min(
-            self._min_output_tokens_per_request, output_tokens)
+        # totals and averages are derived from the token sums and the request count
+        self._accounting.reset(
+            input_tokens=total_input_tokens,
+            output_tokens=total_output_tokens,
+            requests=total_requests,
+            max_input_tokens=max_input_tokens_per_request,
+            max_output_tokens=max_output_tokens_per_request,
+            min_input_tokens=min_input_tokens_per_request,
+            min_output_tokens=min_output_tokens_per_request,
+            output_len_over_limit=output_len_over_limit)
+
+    def statistics(self, input_tokens, output_tokens, labels=None, endpoint=None, latency=None, ttft=None, tpot=None):
+        labels = labels or current_labels()
+        self._accounting.record(input_tokens, output_tokens, labels=labels,
+                                endpoint=endpoint, latency=latency, ttft=ttft, tpot=tpot)
+        if self._budget:
+            self._budget.charge(labels[1], labels[2], input_tokens, output_tokens)
+
+    def _admit(self, labels, estimated_tokens):
+        status, reason = self._budget.status(
+            labels[1], labels[2], estimated_tokens)
+        if status == BUDGET_HARD:
+            print(f'llm request refused, {reason}')
+            return reason
+        return None
+
+    def remaining_budget(self, stage=None, repo=None):
+        """
+        Input and output tokens left under the tightest budget cap of the run, `stage` and
+        `repo` (None where there is no cap), for callers that scale their work to it.
+        """
+        if not self._budget:
+            return {'input_tokens': None, 'output_tokens': None}
+        return self._budget.remaining(stage, repo)
+
+    def budget_status(self, stage=None, repo=None):
+        # (BUDGET_OK | BUDGET_SOFT | BUDGET_HARD, reason)
+        if not self._budget:
+            return BUDGET_OK, None
+        return self._budget.status(stage, repo)
+
+    @property
+    def model_name(self):
+        return self._model_name
+
+    @property
+    def async_chat(self):
+        return self._async_chat
+
+    @property
+    def accounting(self):
+        return self._accounting
+
+    def metrics(self):
+        return self._async_chat.metrics()
+
+    def metrics_snapshot(self):
+        snapshot = self._accounting.snapshot()
+        snapshot.update(time=time.time(), pid=os.getpid(),
+                        model=self._model_name, client=self.metrics())
+        return snapshot
 
     def print_statistics(self):
+        snapshot = self.metrics_snapshot()
+        totals = snapshot['totals']
         print('-------------------------------------')
-        print("Total input tokens used: ", self._total_input_tokens)
-        print("Total output tokens used: ", self._total_output_tokens)
-        print("Total tokens used: ", self._total_tokens)
-        print("Total requests made: ", self._total_requests)
-        print("Output length over limit: ", self._output_len_over_limit)
+        print("Total input tokens used: ", totals['input_tokens'])
+        print("Total output tokens used: ", totals['output_tokens'])
+        print("Total tokens used: ", totals['tokens'])
+        print("Total requests made: ", totals['requests'])
+        print("Failed requests: ", totals['failures'])
+        print("Output length over limit: ", totals['output_len_over_limit'])
         print("Average input tokens per request: ",
-              self._input_tokens_per_request)
+              totals['input_tokens_per_request'])
         print("Average output tokens per request: ",
-              self._output_tokens_per_request)
+              totals['output_tokens_per_request'])
         print("Max input tokens used in a request: ",
-              self._max_input_tokens_per_request)
+              totals['max_input_tokens_per_request'])
         print("Max output tokens used in a request: ",
-              self._max_output_tokens_per_request)
+              totals['max_output_tokens_per_request'])
         print("Min input tokens used in a request: ",
-              self._min_input_tokens_per_request)
+              totals['min_input_tokens_per_request'])
         print("Min output tokens used in a request: ",
-              self._min_output_tokens_per_request)
+              totals['min_output_tokens_per_request'])
+        for counters in snapshot['by_label']:
+            print(f"{counters['caller']}/{counters['template']}: {counters['requests']} requests, "
+                  f"{counters['input_tokens']} input tokens, {counters['output_tokens']} output tokens, "
+                  f"{counters['failures']} failures, {counters['seconds']:.1f}s")
+        for name, histograms in (('latency', snapshot['latency']), ('time to first token', snapshot['ttft']),
+                                 ('time per output token', snapshot['tpot'])):
+            for endpoint, histogram in histograms.items():
+                print(f"{endpoint} {name} p50/p95/p99: "
+                      f"{histogram['p50']:.3f}/{histogram['p95']:.3f}/{histogram['p99']:.3f}s")
+        for key, value in snapshot['client'].items():
+            print(f"{key}: ", value)
+        if self._budget:
+            print("Remaining token budget of the run: ", self.remaining_budget())
         print('-------------------------------------')
 
     def print_response(self, response):
         if response and response.choices and response.choices[0].message and response.choices[0].message.content:
             print(f'** LLM Response:\n\t{response.choices[0].message.content}')
 
-    def chat(self, prompt, chat_hist=[], temp=0.1):
-        messages = chat_hist + [
-            {'role': 'user', 'content': prompt}
-        ]
-
-        max_retries = 5  # Number of retries
-        delay = 20  # Seconds to wait between retries
-
-        for attempt in range(max_retries):
-            try:
-                response = self._client.chat.completions.create(
-                    model=self._model_name,
-                    messages=messages,
-                    # max_tokens=4096,
-                    # frequency_penalty=0.2,
-                    temperature=temp,
-                    stream=False
-                )
-                # self.print_response(response)
-
-                self.statistics(response.usage.prompt_tokens,
-                                response.usage.completion_tokens)
-
-                # self.print_statistics()
-
-                return {
-                    "content": response.choices[0].message.content,
-                    "error_code": 200,
-                    "output_token_len": response.usage.completion_tokens
-                }
-            except Exception as e:
-                print(f"Attempt {attempt+1} failed: {e}", type(e))
-                error_code = extract_error_code(str(e))
-                print(
-                    f"Attempt {attempt+1} failed: {e}, error code: {error_code}")
-                if error_code != INTERNAL_SERVER_ERROR and error_code != GATEWAT_TIMEOUT_ERROR and error_code != MAX_LENGTH_EXCEEDED_ERROR:
-                    print('done chatting with http error')
-                    return {
-                        "content": None,
-                        "error_code": error_code,
-                        "output_token_len": 0
-                    }
-                time.sleep(delay)
-        return {
-            "content": None,
-            "error_code": 403,
-            "output_token_len": 0
-        }
+    def chat(self, prompt, chat_hist=[], temp=0.1, stream=None, stop_at_fence=False, inside_fence=False):
+        # blocking facade over the async client: every thread shares its connection pool and limits
+        if self._exporter:
+            self._exporter.ensure_running()
+        return self._async_chat.chat_sync(prompt, chat_hist, temp, stream=self._stream if stream is None else stream,
+                                          stop_at_fence=stop_at_fence, inside_fence=inside_fence)
 
 
 llm_chat = LLMChat()
@@ -210,6 +778,8 @@ llm_chat.init({
     "key": os.getenv('LLM_KEY'),
     "model_name": os.getenv('MODEL_NAME'),
     "base_url": os.getenv('LLM_BASE_URL'),
+    # e.g. [{"base_url": "http://replica-1/v1", "weight": 2}, {"base_url": "https://paid/v1", "key": "...", "fallback": true}]
+    "endpoints": load_json_config(os.getenv('LLM_ENDPOINTS')),
     "total_input_tokens": 0,
     "total_output_tokens": 0,
     "total_tokens": 0,
@@ -218,16 +788,43 @@ llm_chat.init({
     "output_tokens_per_request": 0,
     "max_input_tokens_per_request": 0,
     "max_output_tokens_per_request": 0,
-    "min_input_tokens_per_request": 0,
-    "min_output_tokens_per_request": 0,
+    "min_input_tokens_per_request": None,
+    "min_output_tokens_per_request": None,
     "output_len_over_limit": 54,
+    "max_concurrency": int(os.getenv('LLM_MAX_CONCURRENCY', DEFAULT_MAX_CONCURRENCY)),
+    "rpm": int(os.getenv('LLM_RPM', 0)),
+    "tpm": int(os.getenv('LLM_TPM', 0)),
+    # e.g. /tmp/llm_metrics_{pid}.prom, prometheus text for .prom files and json otherwise
+    "metrics_path": os.getenv('LLM_METRICS_PATH'),
+    "metrics_interval": float(os.getenv('LLM_METRICS_INTERVAL', 60)),
+    "stream": os.getenv('LLM_STREAM', '0') == '1',
+    "coalesce": os.getenv('LLM_COALESCE', '1') == '1',
+    # answers are appended to this log, `python3 utils/llm_replay.py --recording <log>` replays them
+    "record_path": os.getenv('LLM_RECORD_PATH'),
+    # e.g. {"debug_code_fix": {"weight": 0.5}, "filter_css": {"weight": 2, "deadline": 60}}, merged over DEFAULT_STAGES
+    "stages": load_json_config(os.getenv('LLM_STAGES')),
+    "long_request_tokens": int(os.getenv('LLM_LONG_REQUEST_TOKENS', LONG_REQUEST_TOKENS)),
+    # max estimated prompt tokens in flight, 0 for no limit
+    "token_capacity": int(os.getenv('LLM_TOKEN_CAPACITY', 0)),
+    # token caps per run / stage / repo, see TokenBudget, e.g. {"run": {"output_tokens": 10000000}, "repo": {"input_tokens": 400000}}
+    "budget": load_json_config(os.getenv('LLM_BUDGET')),
+    # usage of the budget survives restarts in this file
+    "budget_state_path": os.getenv('LLM_BUDGET_STATE'),
     "is_available": True,
     "error_code": 0
 })
 
 
-def chat(prompt, temperature=0.1):
-    response = llm_chat.chat(prompt, temp=temperature)
+def chat(prompt, temperature=0.1, assistant=None, max_continue=5, stop_at_fence=False):
+    """
+    Chat completion of `prompt`, continued while the answer is cut at the output limit.
+    A continuation only sends the prompt and the tail of the answer so far, so its input
+    does not grow with the answer. With `stop_at_fence` (streaming only) generation stops
+    at the end of the first code block, for callers that only keep that block.
+    """
+    assistant = assistant or llm_chat
+    response = assistant.chat(prompt, temp=temperature,
+                              stop_at_fence=stop_at_fence)
     if response['error_code'] != SUCCESS_CODE:
         if response['error_code'] == MAX_LENGTH_EXCEEDED_ERROR:
             print('TOO LONG, breaking...')
@@ -237,16 +834,16 @@ def chat(prompt, temperature=0.1):
 
     result = response['content']
 
-    max_continue = 5
     continue_count = 0
     while True:
-        if response['output_token_len'] >= 4095:
+        if is_truncated(response):
             chat_hist = [
                 {'role': 'user', 'content': prompt},
-                {'role': 'assistant', 'content': response['content']}
+                {'role': 'assistant',
+                    'content': result[-CONTINUATION_TAIL_CHARS:]}
             ]
-            response = llm_chat.chat(
-                'continue', chat_hist, temperature)
+            response = assistant.chat(CONTINUE_PROMPT, chat_hist, temperature, stop_at_fence=stop_at_fence,
+                                      inside_fence=stop_at_fence and has_open_fence(result))
             print('--- current output len: ', response['output_token_len'])
             if response['error_code'] != SUCCESS_CODE:
                 if response['error_code'] == MAX_LENGTH_EXCEEDED_ERROR:
@@ -254,7 +851,7 @@ def chat(prompt, temperature=0.1):
                     return result
                 print('Error in generating response, breaking...')
                 return result
-            result += response['content']
+            result = merge_continuation(result, response['content'] or '')
             print('--- current result: ', result)
             continue_count += 1
             if continue_count >= max_continue:
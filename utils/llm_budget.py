@@ -0,0 +1,217 @@
+import atexit
+import json
+import multiprocessing.util
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+BUDGET_OK = 'ok'
+BUDGET_SOFT = 'soft'
+BUDGET_HARD = 'hard'
+TOKEN_KINDS = ('input_tokens', 'output_tokens')
+
+
+def scope_name(key):
+    scope, name = key
+    return f'{scope} {name}' if name else scope
+
+
+class TokenBudget(object):
+    """
+    Caps on the input and output tokens of a run, of each stage (prompt template) and of
+    each repo. `limits` looks like
+
+        {"run": {"input_tokens": 50000000, "output_tokens": 10000000},
+         "stages": {"gen_code_snippet": {"output_tokens": 4000000}},
+         "repo": {"input_tokens": 400000},
+         "repos": {"facebook/react": {"input_tokens": 2000000}},
+         "soft_fraction": 0.8}
+
+    where `repo` caps every repo and `repos` overrides it for some. Past `soft_fraction` of
+    a cap a warning is printed once and `status` turns soft, at the cap it turns hard and
+    requests are refused.
+
+    With a `state_path` the usage is persisted, so a restarted run keeps counting from
+    where it stopped. A background thread of every process adds its usage to the file every
+    `flush_interval` seconds (and at exit) under a file lock, and reads back the usage of the
+    others; `status`, `remaining` and `charge` only read memory, so they never wait for the
+    file, e.g. on the event loop of the llm client.
+    Concurrent requests admitted before a cap is hit can still overshoot it by their size.
+    """
+
+    def __init__(self, limits, state_path=None, flush_interval=10):
+        self._limits = limits or {}
+        self._soft_fraction = self._limits.get('soft_fraction', 0.8)
+        self._state_path = state_path
+        self._flush_interval = flush_interval
+        self._lock = threading.Lock()
+        # (scope, name) -> [input tokens, output tokens]: persisted usage of all processes, and ours not flushed yet
+        self._usage = {}
+        self._pending = {}
+        # taken from pending by a flush still writing it
+        self._flushing = {}
+        self._warned = set()
+        self._flusher_pid = None
+        # one flush at a time per process
+        self._flush_lock = threading.Lock()
+        self._load()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        # the parent flushes its own pending usage
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = {}
+        self._flushing = {}
+
+    def _scopes(self, stage, repo):
+        # (scope key, its limits) of a request
+        scopes = [(('run', ''), self._limits.get('run'))]
+        if stage:
+            scopes.append(
+                (('stage', stage), (self._limits.get('stages') or {}).get(stage)))
+        if repo:
+            scopes.append((('repo', repo), (self._limits.get('repos') or {}).get(
+                repo, self._limits.get('repo'))))
+        return [(key, limits) for key, limits in scopes if limits]
+
+    def _used(self, key):
+        usage = self._usage.get(key, (0, 0))
+        pending = self._pending.get(key, (0, 0))
+        flushing = self._flushing.get(key, (0, 0))
+        return usage[0] + pending[0] + flushing[0], usage[1] + pending[1] + flushing[1]
+
+    def remaining(self, stage=None, repo=None):
+        """Tokens left before the tightest cap applying to (stage, repo), None when uncapped."""
+        remaining = {kind: None for kind in TOKEN_KINDS}
+        with self._lock:
+            for key, limits in self._scopes(stage, repo):
+                used = self._used(key)
+                for i, kind in enumerate(TOKEN_KINDS):
+                    if limits.get(kind) is not None:
+                        left = max(0, limits[kind] - used[i])
+                        remaining[kind] = left if remaining[kind] is None else min(
+                            remaining[kind], left)
+        return remaining
+
+    def status(self, stage=None, repo=None, estimated_input_tokens=0):
+        """(BUDGET_OK, BUDGET_SOFT or BUDGET_HARD, the reason) of a request of (stage, repo)."""
+        status, reason = BUDGET_OK, None
+        with self._lock:
+            for key, limits in self._scopes(stage, repo):
+                used = self._used(key)
+                for i, kind in enumerate(TOKEN_KINDS):
+                    limit = limits.get(kind)
+                    if limit is None:
+                        continue
+                    needed = used[i] + (estimated_input_tokens if i == 0 else 0)
+                    if used[i] >= limit:
+                        return BUDGET_HARD, f'{kind} budget of {scope_name(key)} used up: {used[i]}/{limit}'
+                    if needed > limit:
+                        return BUDGET_HARD, f'{kind} budget of {scope_name(key)} too small for the request: ' \
+                            f'{used[i]} + {estimated_input_tokens}/{limit}'
+                    if used[i] >= self._soft_fraction * limit:
+                        status = BUDGET_SOFT
+                        reason = f'{kind} budget of {scope_name(key)} at {used[i]}/{limit}'
+        return status, reason
+
+    def _ensure_flusher(self):
+        if not self._state_path or self._flusher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._flusher_pid == os.getpid():
+                return
+            self._flusher_pid = os.getpid()
+        threading.Thread(target=self._run, name='llm-budget-flusher',
+                         daemon=True).start()
+        atexit.register(self.flush)
+        # multiprocessing children skip atexit handlers but run their finalizers
+        multiprocessing.util.Finalize(self, self.flush, exitpriority=10)
+
+    def _run(self):
+        while True:
+            time.sleep(self._flush_interval)
+            self.flush()
+
+    def charge(self, stage, repo, input_tokens, output_tokens):
+        self._ensure_flusher()
+        warnings = []
+        with self._lock:
+            for key, limits in self._scopes(stage, repo):
+                pending = self._pending.setdefault(key, [0, 0])
+                pending[0] += input_tokens
+                pending[1] += output_tokens
+                used = self._used(key)
+                for i, kind in enumerate(TOKEN_KINDS):
+                    limit = limits.get(kind)
+                    if limit and used[i] >= self._soft_fraction * limit and (key, kind) not in self._warned:
+                        self._warned.add((key, kind))
+                        warnings.append(
+                            f'{kind} of {scope_name(key)}: {used[i]}/{limit}')
+        for warning in warnings:
+            print(f'WARNING: llm token budget nearly used up, {warning}')
+
+    def _read_state(self):
+        if not os.path.exists(self._state_path):
+            return {}
+        try:
+            with open(self._state_path, 'r') as f:
+                state = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Ignoring unreadable llm budget state {self._state_path}: {e}")
+            return {}
+        return {(scope, name): list(usage) for scope, names in state.get('usage', {}).items()
+                for name, usage in names.items()}
+
+    def _load(self):
+        if self._state_path:
+            self._usage = self._read_state()
+
+    def flush(self):
+        """Add our pending usage to the state file and read back the usage of every process."""
+        if not self._state_path:
+            return
+        with self._flush_lock:
+            # the file is read and written without holding self._lock, the usage being
+            # written keeps counting as `flushing` meanwhile
+            with self._lock:
+                self._flushing, self._pending = self._pending, {}
+                flushing = self._flushing
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(self._state_path)), exist_ok=True)
+                with open(self._state_path + '.lock', 'a') as lock_file:
+                    if fcntl:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX)
+                    usage = self._read_state()
+                    for key, (input_tokens, output_tokens) in flushing.items():
+                        total = usage.setdefault(key, [0, 0])
+                        total[0] += input_tokens
+                        total[1] += output_tokens
+                    if flushing:
+                        state = {'updated_at': time.time(), 'usage': {}}
+                        for (scope, name), total in sorted(usage.items()):
+                            state['usage'].setdefault(scope, {})[name] = total
+                        tmp_path = f'{self._state_path}.{os.getpid()}.tmp'
+                        with open(tmp_path, 'w') as f:
+                            json.dump(state, f, indent=2)
+                        os.replace(tmp_path, self._state_path)
+            except OSError as e:
+                print(f"Failed to write llm budget state {self._state_path}: {e}")
+                with self._lock:
+                    # counted again with the next flush
+                    for key, (input_tokens, output_tokens) in flushing.items():
+                        pending = self._pending.setdefault(key, [0, 0])
+                        pending[0] += input_tokens
+                        pending[1] += output_tokens
+                    self._flushing = {}
+                return
+            with self._lock:
+                self._usage = usage
+                self._flushing = {}
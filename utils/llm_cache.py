@@ -0,0 +1,124 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from threading import Lock
+
+
+# puts between two reads of the total size, which other processes change as well
+SIZE_RESYNC_PUTS = 100
+
+
+def content_hash(*contents):
+    digest = hashlib.sha256()
+    for content in contents:
+        if not isinstance(content, str):
+            content = json.dumps(content, sort_keys=True, ensure_ascii=False)
+        digest.update(content.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class LLMResponseCache(object):
+    """
+    Persistent, content-addressed cache of LLM responses backed by SQLite.
+    Entries are keyed by (prompt template id, model name, content hash) and evicted
+    least-recently-used first once the stored responses exceed `max_size_bytes`.
+    """
+
+    def __init__(self, path, max_size_bytes=1024 * 1024 * 1024):
+        self._path = path
+        self._max_size_bytes = max_size_bytes
+        self._lock = Lock()
+        self._puts = 0
+        self.hits = 0
+        self.misses = 0
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS responses (
+                template_id TEXT NOT NULL,
+                model_name TEXT NOT NULL,
+                content_hash TEXT NOT NULL,
+                response TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL,
+                PRIMARY KEY (template_id, model_name, content_hash)
+            )''')
+        self._conn.execute(
+            'CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)')
+        self._conn.commit()
+        self._size = self._conn.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def get(self, template_id, model_name, key):
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT response FROM responses WHERE template_id = ? AND model_name = ? AND content_hash = ?',
+                (template_id, model_name, key)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute(
+                'UPDATE responses SET last_access = ? WHERE template_id = ? AND model_name = ? AND content_hash = ?',
+                (time.time(), template_id, model_name, key))
+            self._conn.commit()
+            return json.loads(row[0])
+
+    def put(self, template_id, model_name, key, response):
+        value = json.dumps(response, ensure_ascii=False)
+        size = len(value.encode('utf-8'))
+        with self._lock:
+            previous = self._conn.execute(
+                'SELECT size FROM responses WHERE template_id = ? AND model_name = ? AND content_hash = ?',
+                (template_id, model_name, key)).fetchone()
+            self._conn.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+                (template_id, model_name, key, value, size, time.time()))
+            self._size += size - (previous[0] if previous else 0)
+            self._puts += 1
+            if self._puts % SIZE_RESYNC_PUTS == 0:
+                # other processes write to the same file, their entries count towards the limit too
+                self._size = self._conn.execute(
+                    'SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        # drop the least recently used entries in chunks until we are back under the limit
+        while self._size > self._max_size_bytes:
+            rows = self._conn.execute(
+                'SELECT rowid, size FROM responses ORDER BY last_access LIMIT 100').fetchall()
+            if not rows:
+                self._size = 0
+                break
+            freed = 0
+            evicted = []
+            for rowid, size in rows:
+                if self._size - freed <= self._max_size_bytes:
+                    break
+                evicted.append((rowid,))
+                freed += size
+            self._conn.executemany(
+                'DELETE FROM responses WHERE rowid = ?', evicted)
+            self._size -= freed
+
+    def statistics(self):
+        with self._lock:
+            entries = self._conn.execute(
+                'SELECT COUNT(*) FROM responses').fetchone()[0]
+            return {
+                'llm_cache_entries': entries,
+                'llm_cache_bytes': self._size,
+            }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,302 @@
+import atexit
+import contextlib
+import contextvars
+import json
+import math
+import multiprocessing.util
+import os
+import sys
+import threading
+
+
+# latency buckets grow by 10%, so a percentile is off by at most that much
+LATENCY_BUCKET_GROWTH = 1.1
+PERCENTILES = (50, 95, 99)
+# a response this long was most likely cut at the output limit (when the finish reason is
+# unknown), also used by utils.llm
+OUTPUT_LEN_LIMIT = 4095
+
+_llm_labels = contextvars.ContextVar(
+    'llm_labels', default=(None, None, None))
+
+
+def default_caller():
+    # the running script, e.g. distiller_cls or gen_inst
+    script = os.path.basename(os.getenv('LLM_CALLER') or
+                              (sys.argv[0] if sys.argv and sys.argv[0] else 'python'))
+    return os.path.splitext(script)[0] or 'python'
+
+
+@contextlib.contextmanager
+def llm_labels(caller=None, template=None, repo=None):
+    """Attribute the llm requests made inside the block to a caller, a prompt template and a repo."""
+    current_caller, current_template, current_repo = _llm_labels.get()
+    token = _llm_labels.set(
+        (caller or current_caller, template or current_template, repo or current_repo))
+    try:
+        yield
+    finally:
+        _llm_labels.reset(token)
+
+
+def current_labels():
+    # (caller, template, repo), the repo is None outside of a repo
+    caller, template, repo = _llm_labels.get()
+    return (caller or default_caller(), template or 'default', repo)
+
+
+class LatencyHistogram(object):
+    __slots__ = ('count', 'sum', 'min', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+        self.buckets = {}
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        bucket = math.ceil(math.log(value, LATENCY_BUCKET_GROWTH)) if value > 0 else None
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def percentile(self, percentile):
+        # upper bound of the bucket holding the percentile, clamped to the observed range
+        if not self.count:
+            return None
+        rank = percentile / 100 * self.count
+        seen = 0
+        for bucket in sorted(self.buckets, key=lambda bucket: -math.inf if bucket is None else bucket):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                upper = 0 if bucket is None else LATENCY_BUCKET_GROWTH ** bucket
+                return max(self.min, min(upper, self.max))
+        return self.max
+
+    def to_dict(self):
+        summary = {'count': self.count, 'sum': self.sum,
+                   'min': self.min, 'max': self.max}
+        for percentile in PERCENTILES:
+            summary[f'p{percentile}'] = self.percentile(percentile)
+        return summary
+
+
+class TokenAccounting(object):
+    """
+    Token and request counters of an LLMChat, updated under one lock so that concurrent
+    requests neither lose updates nor expose half-updated totals. Besides the totals,
+    requests are attributed to their (caller, template) labels (see `llm_labels`) and their
+    latency (and for streamed requests the time to first token and per output token) is kept
+    per endpoint, from which `snapshot` reports p50/p95/p99.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        # a fork while another thread holds the lock must not leave the child locked out, and
+        # the child counts its own requests only, so the exports of all processes add up
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self, input_tokens=0, output_tokens=0, requests=0, max_input_tokens=0, max_output_tokens=0,
+              min_input_tokens=None, min_output_tokens=None, output_len_over_limit=0):
+        with self._lock:
+            self._input_tokens = input_tokens
+            self._output_tokens = output_tokens
+            self._requests = requests
+            self._failures = 0
+            self._max_input_tokens = max_input_tokens
+            self._max_output_tokens = max_output_tokens
+            # None until the first request, a 0 here would never be raised by min()
+            self._min_input_tokens = min_input_tokens or None
+            self._min_output_tokens = min_output_tokens or None
+            self._output_len_over_limit = output_len_over_limit
+            self._by_label = {}
+            # per endpoint: request latency, time to first token and time per output token (streamed requests)
+            self._latency = {}
+            self._ttft = {}
+            self._tpot = {}
+
+    def _label_counters(self, labels):
+        counters = self._by_label.get(labels)
+        if counters is None:
+            counters = self._by_label[labels] = {
+                'requests': 0, 'input_tokens': 0, 'output_tokens': 0, 'failures': 0, 'seconds': 0}
+        return counters
+
+    def _observe(self, histograms, endpoint, value):
+        histogram = histograms.get(endpoint)
+        if histogram is None:
+            histogram = histograms[endpoint] = LatencyHistogram()
+        histogram.observe(value)
+
+    def record(self, input_tokens, output_tokens, labels=None, endpoint=None, latency=None, ttft=None, tpot=None):
+        labels = labels or current_labels()
+        with self._lock:
+            self._input_tokens += input_tokens
+            self._output_tokens += output_tokens
+            self._requests += 1
+            if output_tokens >= OUTPUT_LEN_LIMIT:
+                self._output_len_over_limit += 1
+            self._max_input_tokens = max(self._max_input_tokens, input_tokens)
+            self._max_output_tokens = max(
+                self._max_output_tokens, output_tokens)
+            self._min_input_tokens = input_tokens if self._min_input_tokens is None else min(
+                self._min_input_tokens, input_tokens)
+            self._min_output_tokens = output_tokens if self._min_output_tokens is None else min(
+                self._min_output_tokens, output_tokens)
+            counters = self._label_counters(labels[:2])
+            counters['requests'] += 1
+            counters['input_tokens'] += input_tokens
+            counters['output_tokens'] += output_tokens
+            if latency is not None:
+                counters['seconds'] += latency
+            if endpoint is not None:
+                for histograms, value in ((self._latency, latency), (self._ttft, ttft), (self._tpot, tpot)):
+                    if value is not None:
+                        self._observe(histograms, endpoint, value)
+
+    def record_failure(self, labels=None):
+        # a request given up on (after its retries), its tokens are unknown
+        labels = labels or current_labels()
+        with self._lock:
+            self._failures += 1
+            self._label_counters(labels[:2])['failures'] += 1
+
+    def totals(self):
+        with self._lock:
+            return {
+                'input_tokens': self._input_tokens,
+                'output_tokens': self._output_tokens,
+                'tokens': self._input_tokens + self._output_tokens,
+                'requests': self._requests,
+                'failures': self._failures,
+                'output_len_over_limit': self._output_len_over_limit,
+                'input_tokens_per_request': self._input_tokens / self._requests if self._requests else 0,
+                'output_tokens_per_request': self._output_tokens / self._requests if self._requests else 0,
+                'max_input_tokens_per_request': self._max_input_tokens,
+                'max_output_tokens_per_request': self._max_output_tokens,
+                'min_input_tokens_per_request': self._min_input_tokens,
+                'min_output_tokens_per_request': self._min_output_tokens,
+            }
+
+    def snapshot(self):
+        totals = self.totals()
+        with self._lock:
+            by_label = [dict(counters, caller=caller, template=template)
+                        for (caller, template), counters in sorted(self._by_label.items())]
+            histograms = {name: {endpoint: histogram.to_dict() for endpoint, histogram in by_endpoint.items()}
+                          for name, by_endpoint in (('latency', self._latency), ('ttft', self._ttft), ('tpot', self._tpot))}
+        return dict(histograms, totals=totals, by_label=by_label)
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _prometheus_labels(**labels):
+    return '{' + ','.join(f'{key}="{_escape_label(value)}"' for key, value in labels.items()) + '}'
+
+
+def to_prometheus(snapshot):
+    """Prometheus text exposition of an LLMChat.metrics_snapshot."""
+    lines = []
+    for key, value in snapshot['totals'].items():
+        if value is None:
+            continue
+        kind = 'gauge' if key.endswith('_per_request') else 'counter'
+        name = f'llm_{key}' + ('_total' if kind == 'counter' else '')
+        lines += [f'# TYPE {name} {kind}', f'{name} {value}']
+    for key in ('requests', 'input_tokens', 'output_tokens', 'failures', 'seconds'):
+        name = f'llm_{key}_by_template_total'
+        lines.append(f'# TYPE {name} counter')
+        for counters in snapshot['by_label']:
+            lines.append(name + _prometheus_labels(caller=counters['caller'],
+                         template=counters['template']) + f' {counters[key]}')
+    for key, name in (('latency', 'llm_endpoint_latency_seconds'), ('ttft', 'llm_endpoint_time_to_first_token_seconds'),
+                      ('tpot', 'llm_endpoint_seconds_per_output_token')):
+        lines.append(f'# TYPE {name} summary')
+        for endpoint, histogram in sorted(snapshot[key].items()):
+            for percentile in PERCENTILES:
+                lines.append(name + _prometheus_labels(
+                    endpoint=endpoint, quantile=percentile / 100) + f' {histogram[f"p{percentile}"]}')
+            lines.append(f'{name}_sum' +
+                         _prometheus_labels(endpoint=endpoint) + f' {histogram["sum"]}')
+            lines.append(f'{name}_count' +
+                         _prometheus_labels(endpoint=endpoint) + f' {histogram["count"]}')
+    for key, value in snapshot.get('client', {}).items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            lines += [f'# TYPE llm_client_{key} gauge', f'llm_client_{key} {value}']
+    return '\n'.join(lines) + '\n'
+
+
+def write_metrics(path, snapshot):
+    # .prom files get the prometheus text format (e.g. for the node exporter textfile collector), others json
+    if path.endswith('.prom'):
+        content = to_prometheus(snapshot)
+    else:
+        content = json.dumps(snapshot, indent=2)
+    # written aside and renamed, a scraper never reads half a file
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+class MetricsExporter(object):
+    """
+    Writes `snapshot_fn()` to `path` every `interval` seconds from a daemon thread, and
+    once more at exit. `{pid}` in the path is replaced by the process id, so that the
+    processes of a pool do not overwrite each other. The thread is started again in a
+    forked child process.
+    """
+
+    def __init__(self, path, snapshot_fn, interval=60):
+        self._path = path
+        self._snapshot_fn = snapshot_fn
+        self._interval = interval
+        self._pid = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    @property
+    def path(self):
+        return self._path.replace('{pid}', str(os.getpid()))
+
+    def ensure_running(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stopped = threading.Event()
+            threading.Thread(target=self._run, name='llm-metrics-exporter',
+                             daemon=True).start()
+            atexit.register(self.flush)
+            # multiprocessing children skip atexit handlers but run their finalizers
+            multiprocessing.util.Finalize(self, self.flush, exitpriority=10)
+
+    def _run(self):
+        while not self._stopped.wait(self._interval):
+            self.flush()
+
+    def flush(self):
+        if self._pid != os.getpid():
+            return
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            write_metrics(self.path, self._snapshot_fn())
+        except Exception as e:
+            print(f'Failed to export llm metrics to {self.path}: {e}')
+
+    def stop(self):
+        self._stopped.set()
+        self.flush()
@@ -0,0 +1,129 @@
+import asyncio
+import email.utils
+import random
+import time
+
+
+def parse_retry_after(error):
+    """Seconds to wait from the Retry-After(-ms) header of an http error, None if absent."""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None)
+    if not headers:
+        return None
+    retry_after_ms = headers.get('retry-after-ms')
+    if retry_after_ms:
+        try:
+            return max(0.0, float(retry_after_ms) / 1000)
+        except ValueError:
+            pass
+    retry_after = headers.get('retry-after')
+    if not retry_after:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    # http-date form
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt, base=2, cap=60, retry_after=None):
+    # full jitter: uniform over [0, base * 2^attempt], capped; Retry-After is a floor
+    delay = random.uniform(0, min(cap, base * 2 ** attempt))
+    if retry_after is not None:
+        delay = retry_after + random.uniform(0, base)
+    return delay
+
+
+class TokenBucket(object):
+    """
+    asyncio token bucket refilled continuously at `rate_per_minute`, holding at most a
+    minute's worth. `acquire` waits until the amount is available (an amount larger than the
+    bucket only waits for a full bucket), `debit` settles a difference afterwards and may
+    leave the bucket in debt. A rate of 0 disables the bucket.
+    """
+
+    def __init__(self, rate_per_minute):
+        self._rate = rate_per_minute / 60
+        self._capacity = rate_per_minute
+        self._level = rate_per_minute
+        self._updated_at = time.monotonic()
+        self._lock = None
+
+    @property
+    def enabled(self):
+        return self._rate > 0
+
+    @property
+    def level(self):
+        self._refill()
+        return self._level
+
+    def _refill(self):
+        now = time.monotonic()
+        self._level = min(self._capacity, self._level +
+                          (now - self._updated_at) * self._rate)
+        self._updated_at = now
+
+    async def acquire(self, amount=1):
+        # returns the seconds spent waiting
+        if not self.enabled:
+            return 0
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        waited = 0
+        # one waiter at a time keeps the bucket first come, first served
+        async with self._lock:
+            needed = min(amount, self._capacity)
+            while True:
+                self._refill()
+                if self._level >= needed:
+                    self._level -= amount
+                    return waited
+                delay = (needed - self._level) / self._rate
+                await asyncio.sleep(delay)
+                waited += delay
+
+    def debit(self, amount):
+        if self.enabled:
+            self._refill()
+            self._level -= amount
+
+
+class AIMDLimiter(object):
+    """
+    Concurrency limit adapted additively-increase / multiplicatively-decrease: every
+    success raises the limit by `increase / limit` (about +1 per round of requests), a
+    throttled request multiplies it by `decrease_factor`, at most once per `cooldown`
+    seconds so one burst of 429s counts as a single congestion signal. The limiter only
+    tracks the limit, the StageScheduler holding the requests enforces it and counts
+    those in flight.
+    """
+
+    def __init__(self, maximum, minimum=1, initial=None, increase=1, decrease_factor=0.5, cooldown=5):
+        self._maximum = maximum
+        self._minimum = minimum
+        self._limit = float(initial if initial is not None else maximum)
+        self._increase = increase
+        self._decrease_factor = decrease_factor
+        self._cooldown = cooldown
+        self._decreased_at = 0
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+    def on_success(self):
+        self._limit = min(self._maximum, self._limit +
+                          self._increase / max(self._limit, 1))
+
+    def on_throttle(self):
+        now = time.monotonic()
+        if now - self._decreased_at < self._cooldown:
+            return False
+        self._decreased_at = now
+        self._limit = max(self._minimum, self._limit * self._decrease_factor)
+        return True
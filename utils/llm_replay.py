@@ -0,0 +1,304 @@
+import argparse
+import json
+import math
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from utils.llm_cache import content_hash
+
+
+def request_key(messages, temperature):
+    # the same key on both sides: the recorder hashes what it sends, the server what it receives
+    return content_hash(messages, temperature)
+
+
+class LLMRecorder(object):
+    """
+    Appends one json line per answered chat completion to a log:
+    `{"key", "model", "content", "prompt_tokens", "completion_tokens", "finish_reason",
+    "latency", "ttft"}`. Requests are only kept as their `request_key`, so the log stays
+    small. Every line is written with a single `write` on an O_APPEND file, so the
+    processes of a pool can record into the same log.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._fd = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def record(self, messages, temperature, model, result, latency):
+        line = json.dumps({
+            'key': request_key(messages, temperature),
+            'model': model,
+            'content': result['content'],
+            'prompt_tokens': result.get('input_token_len'),
+            'completion_tokens': result['output_token_len'],
+            'finish_reason': result.get('finish_reason'),
+            'latency': round(latency, 4),
+            'ttft': round(result['ttft'], 4) if result.get('ttft') is not None else None,
+        }, ensure_ascii=False) + '\n'
+        with self._lock:
+            if self._pid != os.getpid():
+                os.makedirs(os.path.dirname(os.path.abspath(self._path)), exist_ok=True)
+                self._fd = os.open(self._path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                self._pid = os.getpid()
+            os.write(self._fd, line.encode('utf-8'))
+
+
+def load_recording(path):
+    # key -> recorded answers in log order, a key asked several times is replayed round robin
+    recording = {}
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # torn last line of a crashed recorder
+                continue
+            recording.setdefault(entry['key'], []).append(entry)
+    return recording
+
+
+def parse_distribution(value):
+    """
+    Latency distribution of the stand-in server: `recorded` (the latency of the recorded
+    answer, or 0 for a miss), `fixed:S`, `uniform:LOW,HIGH` or `lognormal:MEDIAN,SIGMA`.
+    """
+    name, _, params = value.partition(':')
+    params = [float(param) for param in params.split(',') if param]
+    expected = {'recorded': 0, 'fixed': 1, 'uniform': 2, 'lognormal': 2}
+    if name not in expected or len(params) != expected[name]:
+        raise argparse.ArgumentTypeError(f"Invalid latency distribution {value}")
+    return name, params
+
+
+class ReplayState(object):
+    """
+    What the stand-in server answers and how. Randomness (latency, injected errors) is
+    drawn from a generator seeded by (seed, request key, how often the key was asked), so a
+    run replays the same latencies and errors for the same requests whatever the thread
+    interleaving.
+    """
+
+    def __init__(self, recording, latency=('recorded', []), latency_scale=1.0, error_rate=0.0,
+                 error_codes=(429, 500, 503), retry_after=1, max_concurrency=0, on_miss='echo', seed=0):
+        self.recording = recording
+        self.latency = latency
+        self.latency_scale = latency_scale
+        self.error_rate = error_rate
+        self.error_codes = list(error_codes)
+        self.retry_after = retry_after
+        self.max_concurrency = max_concurrency
+        self.on_miss = on_miss
+        self.seed = seed
+        self._lock = threading.Lock()
+        self._asked = {}
+        self.stats = {'requests': 0, 'hits': 0, 'misses': 0, 'injected_errors': 0,
+                      'throttled': 0, 'in_flight': 0, 'peak_in_flight': 0}
+
+    def begin(self, key):
+        # (random generator of this request, times its key was asked before), None when over max_concurrency
+        with self._lock:
+            self.stats['requests'] += 1
+            if self.max_concurrency and self.stats['in_flight'] >= self.max_concurrency:
+                self.stats['throttled'] += 1
+                return None
+            self.stats['in_flight'] += 1
+            self.stats['peak_in_flight'] = max(
+                self.stats['peak_in_flight'], self.stats['in_flight'])
+            asked = self._asked.get(key, 0)
+            self._asked[key] = asked + 1
+        return random.Random(f'{self.seed}:{key}:{asked}'), asked
+
+    def end(self):
+        with self._lock:
+            self.stats['in_flight'] -= 1
+
+    def count(self, stat):
+        with self._lock:
+            self.stats[stat] += 1
+
+    def answer(self, key, messages, asked):
+        answers = self.recording.get(key)
+        if answers:
+            self.count('hits')
+            return answers[asked % len(answers)]
+        self.count('misses')
+        if self.on_miss == 'error':
+            return None
+        prompt = (messages[-1].get('content') or '') if messages else ''
+        return {'content': f'echo: {prompt[:200]}', 'prompt_tokens': None, 'completion_tokens': None,
+                'finish_reason': 'stop', 'latency': 0, 'ttft': None}
+
+    def sample_latency(self, rng, answer):
+        name, params = self.latency
+        if name == 'recorded':
+            seconds = answer.get('latency') or 0
+        elif name == 'fixed':
+            seconds = params[0]
+        elif name == 'uniform':
+            seconds = rng.uniform(params[0], params[1])
+        else:
+            seconds = params[0] * math.exp(rng.gauss(0, params[1]))
+        return seconds * self.latency_scale
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    state = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_error_json(self, status, message, headers=None):
+        self.send_json(status, {'error': {'message': message, 'type': 'replay', 'code': status}}, headers)
+
+    def do_GET(self):
+        if self.path.rstrip('/').endswith('/models'):
+            self.send_json(200, {'object': 'list', 'data': [{'id': 'replay', 'object': 'model'}]})
+        else:
+            self.send_json(200, self.state.stats)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            request = json.loads(self.rfile.read(length))
+        except ValueError:
+            self.send_error_json(400, 'invalid json')
+            return
+        messages = request.get('messages') or []
+        key = request_key(messages, request.get('temperature'))
+        begun = self.state.begin(key)
+        if begun is None:
+            self.send_error_json(429, 'over the concurrency of the stand-in server',
+                                 {'Retry-After': str(self.state.retry_after)})
+            return
+        rng, asked = begun
+        try:
+            self.answer(request, messages, key, rng, asked)
+        finally:
+            self.state.end()
+
+    def answer(self, request, messages, key, rng, asked):
+        state = self.state
+        if state.error_rate and rng.random() < state.error_rate:
+            state.count('injected_errors')
+            status = rng.choice(state.error_codes)
+            headers = {'Retry-After': str(state.retry_after)} if status == 429 else None
+            self.send_error_json(status, 'injected error', headers)
+            return
+        answer = state.answer(key, messages, asked)
+        if answer is None:
+            self.send_error_json(404, f'no recorded answer for request {key}')
+            return
+
+        seconds = state.sample_latency(rng, answer)
+        content = answer['content'] or ''
+        completion_tokens = answer.get('completion_tokens') or max(1, len(content) // 4)
+        prompt_tokens = answer.get('prompt_tokens') or max(
+            1, sum(len(message.get('content') or '') for message in messages) // 4)
+        usage = {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                 'total_tokens': prompt_tokens + completion_tokens}
+        model = request.get('model') or 'replay'
+        finish_reason = answer.get('finish_reason') or 'stop'
+        if not request.get('stream'):
+            time.sleep(seconds)
+            self.send_json(200, {
+                'id': f'replay-{key[:16]}', 'object': 'chat.completion', 'created': int(time.time()), 'model': model,
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content},
+                             'finish_reason': finish_reason}],
+                'usage': usage})
+            return
+
+        # streamed: the recorded time to first token (or a tenth of the latency), the rest spread over the chunks
+        recorded_ttft = answer.get('ttft')
+        ttft = min(seconds, recorded_ttft * state.latency_scale) if recorded_ttft is not None else seconds / 10
+        chunks = [content[i:i + 16] for i in range(0, len(content), 16)] or ['']
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        try:
+            time.sleep(ttft)
+            for i, chunk in enumerate(chunks):
+                self.send_event({'id': f'replay-{key[:16]}', 'object': 'chat.completion.chunk', 'created': int(time.time()),
+                                 'model': model, 'choices': [{'index': 0, 'delta': {'content': chunk},
+                                                              'finish_reason': finish_reason if i == len(chunks) - 1 else None}]})
+                time.sleep((seconds - ttft) / len(chunks))
+            if (request.get('stream_options') or {}).get('include_usage'):
+                self.send_event({'id': f'replay-{key[:16]}', 'object': 'chat.completion.chunk', 'created': int(time.time()),
+                                 'model': model, 'choices': [], 'usage': usage})
+            self.wfile.write(b'data: [DONE]\n\n')
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # the client stopped reading, e.g. at a closing code fence
+            pass
+
+    def send_event(self, body):
+        self.wfile.write(b'data: ' + json.dumps(body).encode('utf-8') + b'\n\n')
+        self.wfile.flush()
+
+
+def serve(state, host='127.0.0.1', port=8000):
+    handler = type('BoundReplayHandler', (ReplayHandler,), {'state': state})
+    # the default listen backlog of 5 refuses connections of a load test long before the handler does
+    server_class = type('ReplayServer', (ThreadingHTTPServer,), {
+                        'request_queue_size': 1024, 'daemon_threads': True})
+    return server_class((host, port), handler)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='OpenAI compatible stand-in server replaying an LLM_RECORD_PATH log')
+    parser.add_argument('--recording', type=str, default=None,
+                        help='log written with LLM_RECORD_PATH, without it every request is a miss')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=parse_distribution, default=('recorded', []),
+                        help='recorded, fixed:S, uniform:LOW,HIGH or lognormal:MEDIAN,SIGMA')
+    parser.add_argument('--latency_scale', type=float, default=1.0)
+    parser.add_argument('--error_rate', type=float, default=0.0,
+                        help='share of requests answered with one of --error_codes')
+    parser.add_argument('--error_codes', type=lambda value: [int(code) for code in value.split(',')],
+                        default=[429, 500, 503])
+    parser.add_argument('--retry_after', type=int, default=1,
+                        help='Retry-After seconds of 429 answers')
+    parser.add_argument('--max_concurrency', type=int, default=0,
+                        help='answer 429 above this many requests in flight, 0 for no limit')
+    parser.add_argument('--on_miss', type=str, default='echo', choices=['echo', 'error'],
+                        help='answer of a request not in the recording: an echo of the prompt or a 404')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    recording = load_recording(args.recording) if args.recording else {}
+    state = ReplayState(recording, latency=args.latency, latency_scale=args.latency_scale,
+                        error_rate=args.error_rate, error_codes=args.error_codes, retry_after=args.retry_after,
+                        max_concurrency=args.max_concurrency, on_miss=args.on_miss, seed=args.seed)
+    server = serve(state, args.host, args.port)
+    print(f'replaying {sum(len(answers) for answers in recording.values())} answers '
+          f'on http://{args.host}:{args.port}/v1')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(state.stats))
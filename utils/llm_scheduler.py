@@ -0,0 +1,160 @@
+import asyncio
+import collections
+import contextlib
+import time
+
+
+class _Waiter(object):
+    __slots__ = ('stage', 'cost', 'long', 'finish', 'deadline', 'enqueued_at', 'future')
+
+
+class _Stage(object):
+    __slots__ = ('name', 'weight', 'deadline', 'queue', 'last_finish',
+                 'dispatched', 'wait_seconds', 'deadline_misses')
+
+    def __init__(self, name, weight=1, deadline=None):
+        if weight <= 0:
+            raise ValueError(f"Weight of llm stage {name} must be positive")
+        self.name = name
+        self.weight = weight
+        self.deadline = deadline
+        self.queue = collections.deque()
+        self.last_finish = 0
+        self.dispatched = 0
+        self.wait_seconds = 0
+        self.deadline_misses = 0
+
+
+class StageScheduler(object):
+    """
+    Decides which waiting llm request gets the next free slot of a concurrency limit
+    (an AIMDLimiter, whose `limit` may change at any time).
+
+    Requests are queued per stage (the prompt template), and stages share the slots by
+    weighted fair queuing: a request is tagged with a virtual finish time
+    `max(virtual time, finish of the previous request of its stage) + cost / weight`, with
+    its estimated prompt tokens as cost, and the lowest tag goes first. A 200 token
+    classification therefore does not wait behind a queue of 8k token generations, and a
+    stage with twice the weight gets twice the tokens when both are backlogged.
+
+    A stage can have a deadline (seconds): a request whose deadline has come goes before
+    any tag order, earliest deadline first. Admission control keeps
+    `reserved_fraction` of the slots for requests under `long_request_tokens`, and with a
+    `token_capacity` caps the estimated tokens in flight, so long generations only fill
+    what short, pipeline-blocking calls leave.
+    """
+
+    def __init__(self, limiter, stages=None, long_request_tokens=2000, reserved_fraction=0.25, token_capacity=0):
+        self._limiter = limiter
+        self._stages = {}
+        for name, config in (stages or {}).items():
+            self._stages[name] = _Stage(name, config.get('weight', 1), config.get('deadline'))
+        self._long_request_tokens = long_request_tokens
+        self._reserved_fraction = reserved_fraction
+        self._token_capacity = token_capacity
+        self._virtual_time = 0
+        self._waiting = 0
+        self._in_flight = 0
+        self._long_in_flight = 0
+        self._tokens_in_flight = 0
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    def _stage(self, name):
+        stage = self._stages.get(name)
+        if stage is None:
+            stage = self._stages[name] = _Stage(name)
+        return stage
+
+    def _admissible(self, waiter, limit):
+        if waiter.long and self._long_in_flight >= limit - int(limit * self._reserved_fraction):
+            return False
+        # an empty pipe always takes a request, however large
+        if self._token_capacity and self._in_flight and \
+                self._tokens_in_flight + waiter.cost > self._token_capacity:
+            return False
+        return True
+
+    def _next(self, limit, now):
+        def order(waiter):
+            # requests past their deadline first (earliest deadline first), then fair queuing order
+            if waiter.deadline is not None and waiter.deadline <= now:
+                return (0, waiter.deadline)
+            return (1, waiter.finish)
+
+        heads = [stage.queue[0] for stage in self._stages.values() if stage.queue]
+        for waiter in sorted(heads, key=order):
+            if self._admissible(waiter, limit):
+                return waiter
+        return None
+
+    def dispatch(self):
+        """Hand free slots to waiting requests, called whenever a slot or the limit may have changed."""
+        now = time.monotonic()
+        while self._waiting:
+            limit = self._limiter.limit
+            if self._in_flight >= max(1, limit):
+                return
+            waiter = self._next(limit, now)
+            if waiter is None:
+                return
+            stage = self._stages[waiter.stage]
+            stage.queue.popleft()
+            self._waiting -= 1
+            self._virtual_time = max(self._virtual_time, waiter.finish - waiter.cost / stage.weight)
+            self._in_flight += 1
+            self._long_in_flight += waiter.long
+            self._tokens_in_flight += waiter.cost
+            stage.dispatched += 1
+            stage.wait_seconds += now - waiter.enqueued_at
+            if waiter.deadline is not None and now > waiter.deadline:
+                stage.deadline_misses += 1
+            waiter.future.set_result(None)
+
+    def _release(self, waiter):
+        self._in_flight -= 1
+        self._long_in_flight -= waiter.long
+        self._tokens_in_flight -= waiter.cost
+        self.dispatch()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, stage_name, cost):
+        stage = self._stage(stage_name)
+        now = time.monotonic()
+        waiter = _Waiter()
+        waiter.stage = stage_name
+        waiter.cost = cost
+        waiter.long = cost >= self._long_request_tokens
+        waiter.finish = max(self._virtual_time, stage.last_finish) + cost / stage.weight
+        waiter.deadline = now + stage.deadline if stage.deadline is not None else None
+        waiter.enqueued_at = now
+        waiter.future = asyncio.get_running_loop().create_future()
+        stage.last_finish = waiter.finish
+        stage.queue.append(waiter)
+        self._waiting += 1
+        self.dispatch()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # admitted just before the cancellation
+                self._release(waiter)
+            else:
+                stage.queue.remove(waiter)
+                self._waiting -= 1
+            raise
+        try:
+            yield
+        finally:
+            self._release(waiter)
+
+    def metrics(self):
+        return {name: {
+            'weight': stage.weight,
+            'waiting': len(stage.queue),
+            'dispatched': stage.dispatched,
+            'mean_wait_seconds': stage.wait_seconds / stage.dispatched if stage.dispatched else 0,
+            'deadline_misses': stage.deadline_misses,
+        } for name, stage in self._stages.items()}